@@ -28,7 +28,7 @@ from urllib2 import HTTPError
 #from pprint import pformat
 
 from objavi.twiki_wrapper import TWikiBook, get_book_list
-from objavi.cgi_utils import parse_args, optionise, output_blob_and_exit
+from objavi.cgi_utils import parse_args, optionise, output_published_file_and_exit
 from objavi.book_utils import shift_file, log
 from objavi import config
 
@@ -80,10 +80,7 @@ if __name__ == '__main__':
 
         mode = args.get('mode', 'html')
         if mode == 'zip':
-            f = open(fn)
-            data = f.read()
-            f.close()
-            output_blob_and_exit(data, config.BOOKIZIP_MIMETYPE, args['book'] + '.zip')
+            output_published_file_and_exit(fn, config.BOOKIZIP_MIMETYPE, args['book'] + '.zip')
 
     elif 'server' in args and make_all is not None:
         links = []
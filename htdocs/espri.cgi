@@ -24,19 +24,15 @@ sys.path.insert(0, os.path.abspath('.'))
 
 import time
 from urllib2 import urlopen, URLError
-from urllib import urlencode, unquote
-from urlparse import urlsplit
-import traceback, tempfile
-from subprocess import check_call, CalledProcessError
+from urllib import urlencode
+import traceback
 
-from objavi import epub
+from objavi.espri import SOURCES
 from objavi.book_utils import log
-from objavi.cgi_utils import output_blob_and_exit, parse_args, print_template_and_exit, output_blob_and_shut_up
-from objavi.cgi_utils import is_utf8, is_url, super_bleach, path2url
+from objavi.cgi_utils import output_published_file_and_exit, parse_args, print_template_and_exit, output_blob_and_shut_up
+from objavi.cgi_utils import is_utf8, is_url
 from objavi import config
 
-IA_EPUB_URL = "http://www.archive.org/download/%s/%s.epub"
-
 def print_form_and_exit(booklink):
     print_template_and_exit('templates/espri.html',
                             {'booklink': booklink, }
@@ -72,92 +68,6 @@ def async_callback(callback_url, **kwargs):
     os._exit(0)
 
 
-def espri(epuburl, bookid, src_id=None):
-    """Make a bookizip from the epub at <epuburl> and save it as
-    <bookid>.zip."""
-    log("starting espri", epuburl, bookid)
-    f = urlopen(epuburl)
-    s = f.read()
-    f.close()
-    e = epub.Epub()
-    e.load(s)
-    if src_id is not None:
-        #so that booki knows where the book came from, so e.g. archive.org can find it again
-        e.register_source_id(src_id)
-    e.parse_meta()
-    e.parse_opf()
-    e.parse_ncx()
-    zipfile = '%s/%s.zip' % (config.BOOKI_BOOK_DIR, bookid)
-    e.make_bookizip(zipfile)
-
-def ia_espri(bookid):
-    """Import an Internet Archive epub given an archive id"""
-    epuburl = IA_EPUB_URL % (bookid, bookid)
-    log(epuburl)
-    espri(epuburl, bookid, src_id='archive.org')
-    return '%s.zip' % bookid
-
-def inet_espri(epuburl):
-    """Import an epub from an arbitrary url"""
-    tainted_name = unquote(os.path.basename(urlsplit(epuburl).path))
-    filename = super_bleach(tainted_name)
-    if filename.lower().endswith('-epub'):
-        filename = filename[:-5]
-    bookid = '%s-%s' % (filename, time.strftime('%F_%T'))
-    espri(epuburl, bookid, src_id='URI')
-    return '%s.zip' % bookid
-
-
-TIMEOUT_CMD = 'timeout'
-WIKIBOOKS_TIMEOUT = '600'
-WIKIBOOKS_CMD = 'wikibooks2epub'
-WIKIBOOKS_CACHE = 'cache/wikibooks'
-
-class TimeoutError(Exception):
-    pass
-
-def wikibooks_espri(wiki_url):
-    """Wikibooks import using the wikibooks2epub script by Jan Gerber
-    to first convert the wikibook to an epub, which can then be turned
-    into a bookizip via the espri function.
-    """
-    os.environ['oxCACHE'] = os.path.abspath(WIKIBOOKS_CACHE)
-    os.environ['LANG'] = 'en_NZ.UTF-8'
-    tainted_name = unquote(os.path.basename(urlsplit(wiki_url).path))
-    bookid = "%s-%s" % (super_bleach(tainted_name),
-                        time.strftime('%Y.%m.%d-%H.%M.%S'))
-    workdir = tempfile.mkdtemp(prefix=bookid, dir=config.TMPDIR)
-    os.chmod(workdir, 0755)
-    epub_file = os.path.join(workdir, bookid + '.epub')
-    epub_url = path2url(epub_file, full=True)
-
-    #the wikibooks importer is a separate process, so run that, then collect the epub.
-    cmd = [TIMEOUT_CMD, WIKIBOOKS_TIMEOUT,
-           WIKIBOOKS_CMD,
-           '-i', wiki_url,
-           '-o', epub_file
-           ]
-    log(cmd)
-    log(os.environ)
-    log(os.getcwd())
-
-    try:
-        check_call(cmd)
-    except CalledProcessError, e:
-        if e.returncode == 137:
-            raise TimeoutError('Wikibooks took too long (over %s seconds)' % WIKIBOOKS_TIMEOUT)
-        raise
-
-    espri(epub_url, bookid, src_id='wikibooks')
-    return '%s.zip' % bookid
-
-
-
-SOURCES = {
-    'archive.org': {'function': ia_espri},
-    'url': {'function': inet_espri},
-    'wikibooks': {'function': wikibooks_espri},
-}
 ARG_VALIDATORS = {
     "source": SOURCES.__contains__,
     "book": is_utf8,
@@ -209,11 +119,8 @@ if __name__ == '__main__':
         async_callback(callback_url, url=url)
 
     elif mode == 'zip' and filename is not None:
-        f = open(os.path.join(config.BOOKI_BOOK_DIR, filename))
-        data = f.read()
-        f.close()
-        output_blob_and_exit(data, config.BOOKIZIP_MIMETYPE,
-                             filename)
+        output_published_file_and_exit(os.path.join(config.BOOKI_BOOK_DIR, filename),
+                                       config.BOOKIZIP_MIMETYPE, filename)
     else:
         log(book_link)
         print_form_and_exit(book_link)
@@ -25,24 +25,34 @@ import os, sys
 os.chdir('..')
 sys.path.insert(0, os.path.abspath('.'))
 
-import re, time
-#import traceback
+import re
 from pprint import pformat
+from contextlib import contextmanager
+try:
+    import json
+except ImportError:
+    import simplejson as json
 
-from objavi.fmbook import Book, HTTP_HOST, find_archive_urls
 from objavi import config
 
-from objavi import twiki_wrapper, booki_wrapper
-from objavi.book_utils import init_log, log, make_book_name
-from objavi.book_utils import url_fetch, HTTPError
+from objavi.book_utils import init_log, log, make_book_name, set_log_job, WARNING, ERROR
+from objavi.book_utils import read_template, file_stamp
+from objavi.book_utils import url_fetch
 from objavi.cgi_utils import parse_args, optionise, listify, get_server_list
-from objavi.cgi_utils import output_blob_and_exit, output_blob_and_shut_up, output_and_exit
+from objavi.cgi_utils import output_blob_and_shut_up, output_and_exit
+from objavi.cgi_utils import output_published_file_and_exit
 from objavi.cgi_utils import get_size_list, get_default_css, font_links, set_memory_limit
+from objavi.cgi_utils import get_default_css_file
 
 from objavi.form_config import CGI_MODES, CGI_DESTINATIONS
+from objavi import booklist
 from objavi.form_config import FORM_INPUTS, FORM_ELEMENT_TYPES, PROGRESS_POINTS
 
-from objavi.pdf import resize_pdf, count_pdf_pages
+#Most requests are for the form, css, or book list, which only format
+#strings.  The book making modules (objavi.fmbook, and the lxml, booki
+#and pdf code behind it) are slow to import, so they are imported in
+#the functions that use them.  tests/startup_benchmark.py times each
+#mode's startup.
 
 def get_page_settings(args):
     """Find the size and any optional layout settings.
@@ -97,12 +107,7 @@ def get_page_settings(args):
 
 @output_and_exit
 def mode_booklist(args):
-    #XXX need to include booki servers
-    server = args.get('server')
-    if config.SERVER_DEFAULTS[server]['interface'] == 'Booki':
-        books = booki_wrapper.get_book_list(server)
-    else:
-        books = twiki_wrapper.get_book_list(server)
+    books = booklist.get_book_list(args.get('server'))
     return optionise(books, default=args.get('book'))
 
 @output_and_exit
@@ -111,21 +116,32 @@ def mode_css(args):
     return get_default_css(args.get('server'), args.get('pdftype'))
 
 
+#Rendered forms, keyed by (server, size, engine).  Each is kept with
+#the stamps of the files it was made from, and remade if they change.
+_forms = {}
+
 @output_and_exit
 def mode_form(args):
-    f = open(config.FORM_TEMPLATE)
-    template = f.read()
-    f.close()
-    try:
-        f = open(config.FONT_LIST_INCLUDE)
-        font_list = [x.strip() for x in f if x.strip()]
-        f.close()
-    except IOError, e:
-        font_list = ['<i>Font lists not yet generated</i>']
     server = args.get('server')
-    book = args.get('book')
     size = args.get('booksize')
     engine = args.get('engine')
+    stamps = [file_stamp(x) for x in (config.FORM_TEMPLATE, config.FONT_LIST_INCLUDE,
+                                      config.FONT_EXAMPLE_SCRIPT_DIR,
+                                      get_default_css_file(server))]
+    cached = _forms.get((server, size, engine))
+    if cached is not None and cached[0] == stamps:
+        return cached[1]
+    form = render_form(server, size, engine)
+    _forms[(server, size, engine)] = (stamps, form)
+    return form
+
+def render_form(server, size, engine):
+    template = read_template(config.FORM_TEMPLATE)
+    try:
+        font_list = [x.strip() for x in read_template(config.FONT_LIST_INCLUDE).split('\n')
+                     if x.strip()]
+    except IOError, e:
+        font_list = ['<i>Font lists not yet generated</i>']
     d = {
         'server_options': optionise(get_server_list(), default=server),
         'book_options': '',
@@ -179,20 +195,34 @@ class Context(object):
     """
 
     pollfile = None
+    callback_sender = None
+    flight = None
+    ticket = None
+    recorder = None
     def __init__(self, args):
+        from objavi.fmbook import find_archive_urls
+        from objavi.coalesce import Flight
+        from objavi.jobstore import JobRecorder
+        from objavi import profiling
         self.bookid = args.get('book')
         self.server = args.get('server')
         self.mode = args.get('mode', 'book') #XXX default should be configured?
         extension = CGI_MODES.get(self.mode)[1]
         self.bookname = make_book_name(self.bookid, self.server, extension)
+        if config.COALESCE_RENDERS:
+            #if the same book is already being made, this will be its name
+            self.flight = Flight(args, self.bookname)
+            self.bookname = self.flight.bookname
+        profiling.name_job(self.bookname)
+        set_log_job(self.bookname)
+        if config.JOB_STORE:
+            self.recorder = JobRecorder(args, self.bookname)
+        self.http_host = os.environ.get('HTTP_HOST', '')
         self.destination = args.get('destination')
         self.callback = args.get('callback')
         self.method = args.get('method', CGI_DESTINATIONS[self.destination]['default'])
         self.template, self.mimetype = CGI_DESTINATIONS[self.destination][self.method]
-        if HTTP_HOST:
-            self.bookurl = "http://%s/books/%s" % (HTTP_HOST, self.bookname,)
-        else:
-            self.bookurl = "books/%s" % (self.bookname,)
+        self.bookurl = self.book_url(self.bookname)
 
         if args.get('output_format') and args.get('output_profile'):
             self.bookurl = self.bookurl.rsplit(".", 1)[0]+"."+args.get('output_format')
@@ -202,6 +232,12 @@ class Context(object):
         self.booki_user = args.get('booki-user')
         self.start()
 
+    def book_url(self, bookname):
+        """Where the published file <bookname> can be found."""
+        if self.http_host:
+            return "http://%s/books/%s" % (self.http_host, bookname,)
+        return "books/%s" % (bookname,)
+
     def start(self):
         """Begin (and in many cases, finish) http output.
 
@@ -219,9 +255,7 @@ class Context(object):
                 's3url': self.s3url,
                 'bookurl': self.bookurl,
                 }
-            f = open(self.template)
-            content = f.read() % d
-            f.close()
+            content = read_template(self.template) % d
         else:
             content = ''
 
@@ -244,13 +278,65 @@ class Context(object):
         book.publish_shared(self.booki_group, self.booki_user)
         if self.destination == 'archive.org':
             book.publish_s3()
-        elif (self.destination == 'download' and
-              self.method == 'sync' and
-              self.mode != 'templated_html'):
-            f = open(book.publish_file)
-            data = f.read()
-            f.close()
-            output_blob_and_exit(data, CGI_MODES[self.mode][2], self.bookname)
+        if self.flight is not None:
+            self.flight.land(book.publish_file)
+        metrics = None
+        if self.ticket is not None:
+            metrics = self.ticket.release()
+        if self.recorder is not None:
+            self.recorder.save(book.publish_file, metrics)
+        self.deliver(book.publish_file)
+
+    @contextmanager
+    def admitted(self, book, args):
+        """Wait until there is room on this host to make the book,
+        then keep its place until the with block ends, however it
+        ends.  Someone watching a page load comes before batch work.
+        This is also where the job's recorder learns of the book."""
+        if self.recorder is not None:
+            self.recorder.book = book
+        if not config.ADMISSION_CONTROL:
+            yield
+            return
+        from objavi import admission
+        if self.method == 'sync' and self.destination == 'html':
+            priority = 0
+        elif self.method == 'sync':
+            priority = 1
+        else:
+            priority = 2
+        maker = getattr(book, 'maker', None)
+        columns = getattr(maker, 'columns', 1)
+        formats = args.get('formats', 'book').split(',')
+        with admission.admitted(book, self.mode, priority, columns, formats) as self.ticket:
+            yield
+
+    def deliver(self, publish_file):
+        if (self.destination == 'download' and
+            self.method == 'sync' and
+            self.mode != 'templated_html'):
+            output_published_file_and_exit(publish_file, CGI_MODES[self.mode][2],
+                                           self.bookname)
+
+    def follow(self):
+        """If an identical request is already making the book, wait for
+        it, relaying its progress, and deliver its file.  Returns true
+        if that happened, or false if this request has to make the
+        book."""
+        if self.flight is None or not self.flight.following:
+            return False
+        #the leader writes the progress file for everyone, and the
+        #job is recorded once
+        watchers = self.get_watchers() - set([self.pollee_notifier])
+        if self.recorder is not None:
+            watchers.discard(self.recorder.notifier)
+        publish_file = self.flight.follow(watchers)
+        if publish_file is None:
+            return False
+        for w in watchers:
+            w(config.FINISHED_MESSAGE)
+        self.deliver(publish_file)
+        return True
 
 
     def log_notifier(self, message):
@@ -258,30 +344,19 @@ class Context(object):
         log('******* got message "%s"' %message)
 
     def callback_notifier(self, message):
-        """Call the callback url with each message."""
-        log('in callback_notifier')
-        pid = os.fork()
-        if pid:
-            log('child %s is doing callback with message %r' % (pid, message, ))
-            return
-        from urllib2 import urlopen, URLError
-        from urllib import urlencode
-        data = urlencode({'message': message})
-        try:
-            f = urlopen(self.callback, data)
-            time.sleep(2)
-            f.close()
-        except URLError, e:
-            #traceback.print_exc()
-            log("ERROR in callback:\n %r\n %s %s" % (e.url, e.code, e.msg))
-        os._exit(0)
+        """Call the callback url with each message (via a background
+        thread, which sends bursts of messages together)."""
+        if self.callback_sender is None:
+            from objavi.progress import CallbackSender
+            self.callback_sender = CallbackSender(self.callback)
+        self.callback_sender.send(message)
 
     def javascript_notifier(self, message):
         """Print little bits of javascript which will be appended to
         an unfinished html page."""
         try:
             if message.startswith('ERROR:'):
-                log('got an error! %r' % message)
+                log('got an error! %r' % message, level=ERROR)
                 print ('<b class="error-message">'
                        '%s\n'
                        '</b></body></html>' % message
@@ -296,12 +371,13 @@ class Context(object):
 
             sys.stdout.flush()
         except (ValueError, IOError), e:
-            log("failed to send message %r, got exception %r" % (message, e))
+            log("failed to send message %r, got exception %r" % (message, e), level=WARNING)
 
     def pollee_notifier(self, message):
         """Append the message to a file that the remote server can poll"""
         if self.pollfile is None or self.pollfile.closed:
-            self.pollfile = open(config.POLL_NOTIFY_PATH % self.bookname, 'a')
+            from objavi.progress import open_progress_file
+            self.pollfile = open_progress_file(self.bookname)
         self.pollfile.write('%s\n' % message)
         self.pollfile.flush()
         #self.pollfile.close()
@@ -314,78 +390,124 @@ class Context(object):
         log('in get_watchers. method %r, callback %r, destination %r' %
             (self.method, self.callback, self.destination))
         watchers = set()
-        if self.method == 'poll':
-            watchers.add(self.pollee_notifier)
+        #for progress.cgi, whatever the method
+        watchers.add(self.pollee_notifier)
         if self.method == 'async' and self.callback:
             watchers.add(self.callback_notifier)
         if self.method == 'sync' and  self.destination == 'html':
             watchers.add(self.javascript_notifier)
+        if self.flight is not None and self.flight.leader:
+            watchers.add(self.flight.notifier)
+        if self.recorder is not None:
+            watchers.add(self.recorder.notifier)
         watchers.add(self.log_notifier)
         log('watchers are %s' % watchers)
         return watchers
 
-def mode_book(args):
-    # so we're making a pdf.
-    context = Context(args)
-    page_settings = get_page_settings(args)
+def build_pdf(book, args, mode):
+    """Make a pdf of a loaded book, in 'book', 'web', or 'newspaper'
+    mode, and perhaps send it to lulu.com."""
+    if 'allow-breaks' not in args:
+        book.fake_no_break_after()
 
-    with Book(context.bookid, context.server, context.bookname,
-              page_settings=page_settings,
-              watchers=context.get_watchers(), isbn=args.get('isbn'),
-              license=args.get('license'), title=args.get('title'),
-              max_age=float(args.get('max-age')),
-              page_number_style=args.get('page-numbers'),
-              ) as book:
+    book.add_css(args.get('css'), mode)
+    book.add_section_titles()
+
+    if mode == 'book':
+        book.make_book_pdf()
+    elif mode in ('web', 'newspaper'):
+        book.make_simple_pdf(mode)
+    if "rotate" in args:
+        book.rotate180()
+
+    if args.get('embed-fonts'):
+        log("embedding fonts!")
+        book.embed_fonts()
+
+    book.publish_pdf()
+
+    if mode == 'book':
+        if args.get('to_lulu') and args.get('lulu_api_key') and args.get('lulu_user') and args.get('lulu_password'):
+            from objavi.pdf import resize_pdf, count_pdf_pages
+            if args.get('cover_url'):
+                pdfbody = url_fetch(args.get('cover_url'))
+                with file(book.cover_pdf_file, "wb") as pdffile:
+                    pdffile.write(pdfbody)
 
-        book.spawn_x()
+                n_pages = count_pdf_pages(book.publish_file)
 
-        if 'toc_header' in args:
-            book.toc_header = args['toc_header']
-        book.load_book()
-        if 'allow-breaks' not in args:
-            book.fake_no_break_after()
+                (w, h, spine_width) = book.maker.calculate_cover_size(args.get("lulu_api_key"), args.get("booksize"), n_pages)
 
-        book.add_css(args.get('css'), context.mode)
-        book.add_section_titles()
+                resize_pdf(book.cover_pdf_file, 2*w+spine_width, h)
+            else:
+                book.make_cover_pdf(args['lulu_api_key'], args.get('booksize'))
+            
+            metadata = {}
+            for key in "copyright_year copyright_citation description authors isbn".split():
+                metadata[key] = args.get(key)
+
+            for key in "license access allow_ratings color drm paper_type binding_type language keywords currency_code download_price print_price".split():
+                metadata[key] = args.get("lulu_"+key)
 
-        if context.mode == 'book':
-            book.make_book_pdf()
-        elif context.mode in ('web', 'newspaper'):
-            book.make_simple_pdf(context.mode)
-        if "rotate" in args:
-            book.rotate180()
+            book.upload_to_lulu(args['lulu_api_key'], args['lulu_user'], args['lulu_password'], args.get('booksize'), args.get('lulu_project'), args.get('title'), metadata)
 
-        if args.get('embed-fonts'):
-            log("embedding fonts!")
-            book.embed_fonts()
+def build_openoffice(book, args, mode):
+    """Make an openoffice document of a loaded book."""
+    book.add_css(args.get('css'), 'openoffice')
+    book.add_section_titles()
+    book.make_oo_doc()
 
-        book.publish_pdf()
+def build_epub(book, args, mode):
+    book.make_epub(use_cache=config.USE_CACHED_IMAGES, css=args.get('css'), cover_url=args.get('cover_url'))
+    if args.get('output_format') and args.get('output_profile'):
+        book.convert_with_calibre(args.get('output_profile'), args.get('output_format'))
 
-        if context.mode == 'book':
-            if args.get('to_lulu') and args.get('lulu_api_key') and args.get('lulu_user') and args.get('lulu_password'):
-                if args.get('cover_url'):
-                    pdfbody = url_fetch(args.get('cover_url'))
-                    with file(book.cover_pdf_file, "wb") as pdffile:
-                        pdffile.write(pdfbody)
+def build_bookizip(book, args, mode):
+    book.publish_bookizip()
 
-                    n_pages = count_pdf_pages(book.publish_file)
+def build_templated_html(book, args, mode):
+    template = args.get('html_template')
+    log(template)
+    book.make_templated_html(template=template)
+
+#The functions that make each format once the book is fetched.  The
+#ones in LOADED_BUILDERS need book.load_book() to have been called.
+BUILDERS = {
+    'book': build_pdf,
+    'newspaper': build_pdf,
+    'web': build_pdf,
+    'openoffice': build_openoffice,
+    'epub': build_epub,
+    'bookizip': build_bookizip,
+    'templated_html': build_templated_html,
+}
+LOADED_BUILDERS = ('book', 'newspaper', 'web', 'openoffice')
 
-                    (w, h, spine_width) = book.maker.calculate_cover_size(args.get("lulu_api_key"), args.get("booksize"), n_pages)
 
-                    resize_pdf(book.cover_pdf_file, 2*w+spine_width, h)
-                else:
-                    book.make_cover_pdf(args['lulu_api_key'], args.get('booksize'))
-                
-                metadata = {}
-                for key in "copyright_year copyright_citation description authors isbn".split():
-                    metadata[key] = args.get(key)
+def mode_book(args):
+    # so we're making a pdf.
+    from objavi.fmbook import Book
+    context = Context(args)
+    if context.follow():
+        return
+    page_settings = get_page_settings(args)
 
-                for key in "license access allow_ratings color drm paper_type binding_type language keywords currency_code download_price print_price".split():
-                    metadata[key] = args.get("lulu_"+key)
+    with Book(context.bookid, context.server, context.bookname,
+              page_settings=page_settings,
+              watchers=context.get_watchers(), isbn=args.get('isbn'),
+              license=args.get('license'), title=args.get('title'),
+              max_age=float(args.get('max-age')),
+              page_number_style=args.get('page-numbers'),
+              ) as book:
+        with context.admitted(book, args):
 
-                book.upload_to_lulu(args['lulu_api_key'], args['lulu_user'], args['lulu_password'], args.get('booksize'), args.get('lulu_project'), args.get('title'), metadata)
+            book.spawn_x()
 
-        context.finish(book)
+            if 'toc_header' in args:
+                book.toc_header = args['toc_header']
+            book.load_book()
+            build_pdf(book, args, context.mode)
+            context.finish(book)
 
 #These ones are similar enough to be handled by the one function
 mode_newspaper = mode_book
@@ -395,62 +517,161 @@ mode_web = mode_book
 def mode_openoffice(args):
     """Make an openoffice document.  A whole lot of the inputs have no
     effect."""
+    from objavi.fmbook import Book
     context = Context(args)
+    if context.follow():
+        return
     with Book(context.bookid, context.server, context.bookname,
               watchers=context.get_watchers(), isbn=args.get('isbn'),
               license=args.get('license'), title=args.get('title'),
               max_age=float(args.get('max-age')),
               page_number_style=args.get('page-numbers'),
               ) as book:
+        with context.admitted(book, args):
 
-        book.spawn_x()
-        book.load_book()
-        book.add_css(args.get('css'), 'openoffice')
-        book.add_section_titles()
-        book.make_oo_doc()
-        context.finish(book)
+            if not os.path.exists(config.HTML2ODT_SOCKET):
+                #soffice is started for this book, and wants X
+                book.spawn_x()
+            book.load_book()
+            build_openoffice(book, args, context.mode)
+            context.finish(book)
 
 def mode_epub(args):
+    from objavi.fmbook import Book
     log('making epub with\n%s' % pformat(args))
     #XXX need to catch and process lack of necessary arguments.
     context = Context(args)
+    if context.follow():
+        return
 
     with Book(context.bookid, context.server, context.bookname,
               watchers=context.get_watchers(), title=args.get('title'),
               max_age=float(args.get('max-age')),
               page_number_style=args.get('page-numbers'),
               ) as book:
-
-        book.make_epub(use_cache=config.USE_CACHED_IMAGES, css=args.get('css'), cover_url=args.get('cover_url'))
-        if args.get('output_format') and args.get('output_profile'):
-            book.convert_with_calibre(args.get('output_profile'), args.get('output_format'))
-
-        context.finish(book)
+        with context.admitted(book, args):
+            build_epub(book, args, context.mode)
+            context.finish(book)
 
 
 def mode_bookizip(args):
+    from objavi.fmbook import Book
     log('making bookizip with\n%s' % pformat(args))
     context = Context(args)
+    if context.follow():
+        return
 
     with Book(context.bookid, context.server, context.bookname,
               watchers=context.get_watchers(), title=args.get('title'),
               max_age=float(args.get('max-age')),
               page_number_style=args.get('page-numbers'),
               ) as book:
-        book.publish_bookizip()
-        context.finish(book)
+        with context.admitted(book, args):
+            build_bookizip(book, args, context.mode)
+            context.finish(book)
 
 def mode_templated_html(args):
+    from objavi.fmbook import Book
     log('making templated html with\n%s' % pformat(args))
     context = Context(args)
-    template = args.get('html_template')
-    log(template)
+    if context.follow():
+        return
     with Book(context.bookid, context.server, context.bookname,
               watchers=context.get_watchers(), title=args.get('title'),
               max_age=float(args.get('max-age'))) as book:
+        with context.admitted(book, args):
+            build_templated_html(book, args, context.mode)
+            context.finish(book)
+
+
+def make_one_format(book, args, mode, bookname, results):
+    """Make one format for mode_multi, in a child process, and put
+    (mode, published file or None) on the results queue."""
+    import traceback
+    try:
+        page_settings = None
+        if mode in ('book', 'newspaper', 'web'):
+            page_settings = get_page_settings(dict(args, mode=mode))
+        book.start_output(bookname, page_settings)
+        BUILDERS[mode](book, args, mode)
+        book.publish_shared(args.get('booki-group'), args.get('booki-user'))
+        results.put((mode, book.publish_file))
+    except Exception:
+        traceback.print_exc()
+        log("could not make %s as %s" % (mode, bookname), level=ERROR)
+        results.put((mode, None))
+
+def mode_multi(args):
+    """Make several formats (a comma separated list in args['formats'])
+    from one fetch of the book.  The book is loaded once if any of
+    the formats need it, then each format is made in its own process,
+    a few at a time.  The published file is a JSON manifest mapping
+    each format to the URL of its output (or null if it failed)."""
+    from objavi.fmbook import Book
+    from multiprocessing import Process, Queue
+    from Queue import Empty
+    import time
+    log('making multiple formats with\n%s' % pformat(args))
+    context = Context(args)
+    if context.follow():
+        return
+    formats = args.get('formats', 'book').split(',')
+    stem = context.bookname[:-len(CGI_MODES['multi'][1])]
 
-        book.make_templated_html(template=template)
-        context.finish(book)
+    with Book(context.bookid, context.server, context.bookname,
+              watchers=context.get_watchers(), isbn=args.get('isbn'),
+              license=args.get('license'), title=args.get('title'),
+              max_age=float(args.get('max-age')),
+              page_number_style=args.get('page-numbers'),
+              ) as book:
+        with context.admitted(book, args):
+
+            if [x for x in formats if x in LOADED_BUILDERS]:
+                book.spawn_x()
+                if 'toc_header' in args:
+                    book.toc_header = args['toc_header']
+                book.load_book()
+
+            results = Queue()
+            waiting = list(formats)
+            running = []
+            started = 0
+            while waiting or running:
+                while waiting and len(running) < config.MULTI_FORMAT_PROCESSES:
+                    mode = waiting.pop(0)
+                    bookname = '%s-%s%s' % (stem, mode, CGI_MODES[mode][1])
+                    p = Process(target=make_one_format,
+                                args=(book, args, mode, bookname, results))
+                    p.start()
+                    running.append(p)
+                    started += 1
+                #the next format starts when any one finishes, not the oldest
+                finished = [x for x in running if not x.is_alive()]
+                if not finished:
+                    time.sleep(config.MULTI_FORMAT_POLL_INTERVAL)
+                for p in finished:
+                    p.join()
+                    running.remove(p)
+
+            #each process sends one result, unless it was killed
+            manifest = dict((x, None) for x in formats)
+            for i in range(started):
+                try:
+                    mode, fn = results.get(timeout=config.MULTI_FORMAT_RESULT_TIMEOUT)
+                except Empty:
+                    log("%d formats sent no result" % (started - i), level=WARNING)
+                    break
+                if fn is not None:
+                    manifest[mode] = context.book_url(os.path.basename(fn))
+            book.notify_watcher('make_multi')
+
+            f = open(book.publish_file, 'w')
+            json.dump({'book': context.bookid,
+                       'server': context.server,
+                       'formats': manifest,
+                       }, f, indent=2)
+            f.close()
+            context.finish(book)
 
 def mode_templated_html_zip(args):
     pass
@@ -467,6 +688,11 @@ def main():
         mode = 'book'
 
     output_function = globals().get('mode_%s' % mode, mode_form)
+    if output_function is not mode_form:
+        from objavi import profiling
+        if profiling.wanted(args):
+            profiling.JobProfile(mode).run(output_function, args)
+            return
     output_function(args)
 
 if __name__ == '__main__':
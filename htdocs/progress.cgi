@@ -0,0 +1,72 @@
+#!/usr/bin/python
+#
+# Part of Objavi2, which turns html manuals into books.  This script
+# tells clients how a book is coming along.
+#
+# Copyright (C) 2009 Douglas Bagnall
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Progress of the book called <bookname>.
+
+With 'stream' set (or if the client accepts text/event-stream), the
+messages are sent as server-sent events until the book is finished.
+Otherwise the response is JSON -- {"messages": [...], "next": N,
+"finished": bool} -- holding the messages after the first <since>,
+which waits (a long poll) until there is at least one."""
+
+import os, sys
+os.chdir('..')
+sys.path.insert(0, os.path.abspath('.'))
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from objavi.progress import wait_for_progress, stream_progress
+from objavi.cgi_utils import parse_args, is_bookname, is_int, output_blob_and_exit
+
+ARG_VALIDATORS = {
+    'bookname': is_bookname,
+    'since': (is_int, '0'),
+    'stream': None,
+}
+
+def main():
+    args = parse_args(ARG_VALIDATORS)
+    bookname = args.get('bookname')
+    if bookname is None:
+        output_blob_and_exit('no bookname given', 'text/plain')
+    since = int(args['since'])
+    if ('stream' in args or
+        'text/event-stream' in os.environ.get('HTTP_ACCEPT', '')):
+        last_id = os.environ.get('HTTP_LAST_EVENT_ID', '')
+        if is_int(last_id):
+            since = int(last_id)
+        print 'Content-type: text/event-stream'
+        print 'Cache-Control: no-cache'
+        print
+        sys.stdout.flush()
+        stream_progress(bookname, since)
+    else:
+        messages, finished = wait_for_progress(bookname, since)
+        output_blob_and_exit(json.dumps({'messages': messages,
+                                         'next': since + len(messages),
+                                         'finished': finished,
+                                         }), 'application/json')
+
+if __name__ == '__main__':
+    main()
@@ -1,54 +1,56 @@
 
 
-function objavi_poller(url){
-    var index = 0;
-    var polling = true;
+function objavi_watch(bookname){
+    var url = "/progress.cgi?bookname=" + encodeURIComponent(bookname);
+    var finished = false;
     var colour_toggle = 0;
-    //var counter = 0;
 
-    function poll(msg){
+    function show(m){
         colour_toggle = ! colour_toggle;
-        //counter += 1;
-        //$("body").css('background-position', "" + (4 * counter) + "px " + (3 * counter) + "px");
-        if (colour_toggle){
-            $("h1").css('color', '#f70');
-            //$("body").css('background-image', "url(/static/background-2.png)");
-        }
-        else {
-            $("h1").css('color', '#d50');
-            //$("body").css('background-image', "url(/static/background-1.png)");
-            //$("body").css('background-position', "" + (1 * counter) + "px " + (3 * counter) + "px");
+        $("h1").css('color', colour_toggle ? '#f70' : '#d50');
+        if (m){
+            objavi_show_progress(m);
+            if (m == 'FINISHED'){
+                finished = true;
+                $("h1").css('color', '#f70');
+            }
         }
+    }
 
-        if (msg){
-            var messages = msg.split('\n');
-            for (var i = Math.max(0, index - 1); i < messages.length; i++){
-                var m = messages[i];
-                if (m){
-                    objavi_show_progress(m);
-                    if (m == 'FINISHED'){
-                        polling = false;
-                        $("h1").css('color', '#f70');
-                    }
-                }
+    if (window.EventSource){
+        //the server sends messages as they happen; if the connection
+        //drops, the browser reconnects and carries on from the last one.
+        var source = new EventSource(url + "&stream=1");
+        source.onmessage = function(e){
+            show(e.data);
+            if (finished){
+                source.close();
             }
-            index = messages.length;
-        }
-        if (polling){
-            window.setTimeout(function(){
-                                  $.ajax({
-                                             type: "GET",
-                                             url: url,
-                                             cache: false,
-                                             success: poll,
-                                             beforeSend: function(r){
-                                                 r.setRequestHeader('X-hello', 'hi');
-                                             }
-                                         });
-                                  },
-                              300);
-        }
+        };
+        return;
     }
-    return poll;
-}
 
+    //otherwise long poll: each request waits until there is news.
+    var since = 0;
+    function poll(){
+        $.ajax({
+                   type: "GET",
+                   url: url + "&since=" + since,
+                   cache: false,
+                   dataType: "json",
+                   success: function(r){
+                       for (var i = 0; i < r.messages.length; i++){
+                           show(r.messages[i]);
+                       }
+                       since = r.next;
+                       if (! finished){
+                           poll();
+                       }
+                   },
+                   error: function(){
+                       window.setTimeout(poll, 3000);
+                   }
+               });
+    }
+    poll();
+}
@@ -0,0 +1,272 @@
+# Part of Objavi2, which turns html manuals into books.  This module
+# decides when a book may start being made.
+#
+# Copyright (C) 2009 Douglas Bagnall
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Admission control for book making.
+
+Once a book is fetched, its cost (peak memory and the number of CPUs
+it keeps busy) is estimated from its html and image bytes, the mode,
+and the number of columns.  The job then waits until the jobs already
+running leave room for it in the host's budget, and no job with a
+better claim is waiting.  Jobs are ordered by priority (lower
+first; synchronous html requests are 0), then by arrival.
+
+The estimates start from config.ADMISSION_COSTS and are refitted from
+the finished jobs in the job store (see objavi/jobstore.py).
+
+The running and waiting jobs are kept in a small JSON file, locked
+while it is read and changed, so that all the CGI processes on a host
+share it.  Jobs belonging to processes that have died are dropped,
+but a job should not rely on that: admitted() releases its place
+however the job ends."""
+
+from __future__ import with_statement
+
+import os
+import time
+import fcntl
+import errno
+import resource
+from contextlib import contextmanager
+from multiprocessing import cpu_count
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from objavi.book_utils import log, ensure_dir, atomic_write
+from objavi.jobstore import load_jobs
+from objavi import config
+
+def book_bytes(book):
+    """Sizes of the html and of the images in the book's zip."""
+    html = images = 0
+    for details in book.manifest.values():
+        try:
+            size = book.store.getinfo(details['url']).file_size
+        except KeyError:
+            continue
+        if details['mimetype'].startswith('image'):
+            images += size
+        elif details['mimetype'] in ('text/html', 'application/xhtml+xml'):
+            html += size
+    return html, images
+
+def work_size(html, images, columns=1):
+    """The quantity the costs scale with."""
+    return (html + images * config.ADMISSION_IMAGE_WEIGHT) * (
+        1 + config.ADMISSION_COLUMN_WEIGHT * (columns - 1))
+
+
+def read_metrics():
+    """The most recent successful jobs that admission control
+    measured."""
+    try:
+        return load_jobs("status = 'ok' AND estimated_memory IS NOT NULL",
+                         limit=config.ADMISSION_CALIBRATION_JOBS)
+    except Exception, e:
+        log("could not read the job store: %s" % e)
+        return []
+
+def fit(metrics):
+    """Least squares fit of peak memory against work size, and the
+    mean CPU use, for each mode that has enough recorded jobs."""
+    samples = {}
+    for m in metrics:
+        x = work_size(m['html_bytes'], m['image_bytes'], m['columns'] or 1)
+        samples.setdefault(m['mode'], []).append((x, m['peak_memory'],
+                                                  m['cpu_time'], m['run_time']))
+    costs = {}
+    for mode, s in samples.iteritems():
+        n = len(s)
+        if n < config.ADMISSION_CALIBRATION_MIN_JOBS:
+            continue
+        mean_x = sum(x[0] for x in s) / float(n)
+        mean_y = sum(x[1] for x in s) / float(n)
+        var_x = sum((x[0] - mean_x) ** 2 for x in s)
+        if var_x:
+            slope = max(sum((x[0] - mean_x) * (x[1] - mean_y) for x in s) / var_x, 0)
+        else:
+            slope = 0
+        base = max(mean_y - slope * mean_x, 0)
+        wall = sum(x[3] for x in s)
+        cpus = sum(x[2] for x in s) / wall if wall else 1.0
+        costs[mode] = (base * config.ADMISSION_SAFETY_MARGIN,
+                       slope * config.ADMISSION_SAFETY_MARGIN,
+                       cpus)
+    return costs
+
+def estimate(book, mode, columns=1, formats=None):
+    """The (memory, cpus) that making <book> in <mode> will probably
+    take.  For mode 'multi', this is for the most expensive formats
+    that run at once."""
+    costs = dict(config.ADMISSION_COSTS)
+    costs.update(fit(read_metrics()))
+    html, images = book_bytes(book)
+    size = work_size(html, images, columns)
+    def cost(mode):
+        base, per_byte, cpus = costs.get(mode, costs['book'])
+        return (base + per_byte * size, cpus)
+    if mode == 'multi':
+        parts = sorted((cost(x) for x in formats or ()), reverse=True)
+        parts = parts[:config.MULTI_FORMAT_PROCESSES]
+        return (sum(x[0] for x in parts), sum(x[1] for x in parts))
+    return cost(mode)
+
+
+def host_budget():
+    """The memory and CPUs that all the jobs together may use."""
+    memory = config.ADMISSION_MEMORY_BUDGET
+    if memory is None:
+        memory = 2 * 1024 * 1024 * 1024
+        try:
+            f = open('/proc/meminfo')
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    memory = int(line.split()[1]) * 1024 * 0.75
+                    break
+            f.close()
+        except IOError:
+            pass
+    cpus = config.ADMISSION_CPU_BUDGET
+    if cpus is None:
+        cpus = cpu_count()
+    return memory, cpus
+
+@contextmanager
+def locked_state():
+    """The shared list of running and waiting jobs, which is saved
+    when the block ends."""
+    ensure_dir(config.ADMISSION_DIR)
+    fn = os.path.join(config.ADMISSION_DIR, 'jobs.json')
+    lock = open(fn + '.lock', 'w')
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    try:
+        try:
+            f = open(fn)
+            state = json.load(f)
+            f.close()
+        except (IOError, ValueError):
+            state = {'running': {}, 'waiting': {}}
+        for jobs in state.values():
+            for pid in jobs.keys():
+                try:
+                    os.kill(int(pid), 0)
+                except OSError, e:
+                    if e.errno == errno.ESRCH:
+                        log("forgetting job %s, which has died" % pid)
+                        del jobs[pid]
+        yield state
+        atomic_write(fn, json.dumps(state))
+    finally:
+        lock.close()
+
+def may_start(pid, state):
+    """Whether job <pid> (which is waiting) fits in now, and is at the
+    head of the queue."""
+    waiting = state['waiting']
+    me = waiting[pid]
+    if (me['priority'], me['arrived'], pid) != min(
+        (v['priority'], v['arrived'], k) for k, v in waiting.iteritems()):
+        return False
+    running = state['running'].values()
+    if not running:
+        #a job that is too big for the budget still gets to run alone
+        return True
+    memory, cpus = host_budget()
+    return (sum(x['memory'] for x in running) + me['memory'] <= memory and
+            sum(x['cpus'] for x in running) + me['cpus'] <= cpus)
+
+
+class Ticket(object):
+    """An admitted job, which should be released when it is done."""
+    metrics = None
+
+    def __init__(self, mode, memory, cpus, html, images, columns):
+        self.pid = str(os.getpid())
+        self.mode = mode
+        self.memory = memory
+        self.cpus = cpus
+        self.html = html
+        self.images = images
+        self.columns = columns
+        self.start = time.time()
+        r = resource.getrusage(resource.RUSAGE_SELF)
+        c = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.start_cpu = r.ru_utime + r.ru_stime + c.ru_utime + c.ru_stime
+
+    def release(self):
+        """Leave the running jobs, and return what this one used since
+        it was admitted, for the job's record.  Releasing again does
+        nothing more, and returns the same figures."""
+        if self.metrics is not None:
+            return self.metrics
+        r = resource.getrusage(resource.RUSAGE_SELF)
+        c = resource.getrusage(resource.RUSAGE_CHILDREN)
+        #ru_maxrss is in kilobytes.  The children's figure is the
+        #biggest child, which is near enough.
+        metrics = {'html_bytes': self.html,
+                   'image_bytes': self.images,
+                   'columns': self.columns,
+                   'peak_memory': (r.ru_maxrss + c.ru_maxrss) * 1024,
+                   'cpu_time': (r.ru_utime + r.ru_stime + c.ru_utime + c.ru_stime
+                                - self.start_cpu),
+                   'run_time': time.time() - self.start,
+                   'estimated_memory': self.memory,
+                   }
+        with locked_state() as state:
+            state['running'].pop(self.pid, None)
+        self.metrics = metrics
+        return metrics
+
+
+def admit(book, mode, priority, columns=1, formats=None):
+    """Wait until <book> can be made, and return a Ticket."""
+    memory, cpus = estimate(book, mode, columns, formats)
+    html, images = book_bytes(book)
+    pid = str(os.getpid())
+    arrived = time.time()
+    log("%s needs about %d MB and %.1f CPUs (priority %s)" %
+        (book.bookname, memory // 1048576, cpus, priority))
+    notified = False
+    while True:
+        with locked_state() as state:
+            state['waiting'][pid] = {'memory': memory, 'cpus': cpus,
+                                     'priority': priority, 'arrived': arrived}
+            if (may_start(pid, state) or
+                time.time() - arrived > config.ADMISSION_MAX_WAIT):
+                del state['waiting'][pid]
+                state['running'][pid] = {'memory': memory, 'cpus': cpus,
+                                         'mode': mode, 'since': time.time()}
+                break
+        if not notified:
+            log("%s is queued" % book.bookname)
+            notified = True
+        time.sleep(config.ADMISSION_POLL_INTERVAL)
+    book.notify_watcher('admit')
+    return Ticket(mode, memory, cpus, html, images, columns)
+
+@contextmanager
+def admitted(book, mode, priority, columns=1, formats=None):
+    """admit() the book for the length of a with block, releasing the
+    ticket when it ends, even by an exception."""
+    ticket = admit(book, mode, priority, columns, formats)
+    try:
+        yield ticket
+    finally:
+        ticket.release()
@@ -20,11 +20,18 @@ General utility functions.
 """
 
 import os, sys
+import errno
 import shutil
 import time, re
-from subprocess import Popen, PIPE
-from urllib2 import urlopen, HTTPError
+import fcntl
+import thread
 import htmlentitydefs
+#subprocess and urllib2 (which is slow to import) are imported where
+#they are used, so that the light CGI modes don't pay for them.
+try:
+    import json
+except ImportError:
+    import simplejson as json
 
 #from objavi.fmbook import log
 from objavi import config
@@ -32,21 +39,33 @@ from objavi import config
 #general, non-cgi functions
 def init_log(logname='objavi'):
     """Try to redirect stderr to the log file.  If it doesn't work,
-    leave stderr as it is."""
+    leave stderr as it is.
+
+    The log is rotated when it gets bigger than LOG_ROTATE_SIZE.
+    Many processes share it, so this is done under a lock, and only
+    if the file is still too big once the lock is held (another
+    process may have just rotated it)."""
     if config.REDIRECT_LOG:
         logfile = os.path.join(config.LOGDIR, logname + '.log')
         try:
-            size = os.stat(logfile).st_size
-            if size > config.LOG_ROTATE_SIZE:
-                oldlog = os.path.join(config.LOGDIR, time.strftime(logname + '-%Y-%m-%d+%H-%M-%S.log'))
-                f = open(logfile, 'a')
-                print >> f, "CLOSING LOG at size %s, renaming to %s" % (size, oldlog)
-                f.close()
-                os.rename(logfile, oldlog)
-        except OSError, e:
+            if os.stat(logfile).st_size > config.LOG_ROTATE_SIZE:
+                lock = open(logfile + '.lock', 'w')
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                    size = os.stat(logfile).st_size
+                    if size > config.LOG_ROTATE_SIZE:
+                        oldlog = os.path.join(config.LOGDIR, time.strftime(logname + '-%Y-%m-%d+%H-%M-%S.log'))
+                        f = open(logfile, 'a')
+                        print >> f, "CLOSING LOG at size %s, renaming to %s" % (size, oldlog)
+                        f.close()
+                        os.rename(logfile, oldlog)
+                finally:
+                    lock.close()
+        except (IOError, OSError), e:
             log(e) # goes to original stderr
         try:
-            f = open(logfile, 'a')
+            #unbuffered, so each message is written (and appended) whole
+            f = open(logfile, 'a', 0)
             sys.stderr.flush()
             os.dup2(f.fileno(), sys.stderr.fileno())
             # reassign the object as well as dup()ing, in case it closes down out of scope.
@@ -55,20 +74,105 @@ def init_log(logname='objavi'):
             log(e)
             return
 
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LEVEL_NAMES = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING', ERROR: 'ERROR'}
+LEVELS = dict((v, k) for k, v in LEVEL_NAMES.items())
+
+#config.LOG_LEVEL, and the threshold it gives
+_log_threshold = (None, INFO)
+
+_log_job = None
+
+def set_log_job(job):
+    """Mark the following log messages as belonging to <job>."""
+    global _log_job
+    _log_job = job
+
+def log_enabled(level=INFO, debug=None):
+    """Would a message at <level> (or about the debug topic <debug>)
+    be logged?  For guarding expensive logging that log()'s laziness
+    doesn't cover."""
+    if debug is not None:
+        return config.DEBUG_ALL or debug in config.DEBUG_MODES
+    setting, threshold = _log_threshold
+    if config.LOG_LEVEL != setting:
+        threshold = _set_log_threshold(config.LOG_LEVEL)
+    return level >= threshold
+
+def _set_log_threshold(setting):
+    """Work out the threshold for config.LOG_LEVEL, which is a level
+    or its name.  Anything else means INFO."""
+    global _log_threshold
+    known = True
+    if isinstance(setting, (int, long)):
+        threshold = setting
+    elif isinstance(setting, basestring) and setting.upper() in LEVELS:
+        threshold = LEVELS[setting.upper()]
+    else:
+        threshold = INFO
+        known = False
+    #set before logging, which asks for it
+    _log_threshold = (setting, threshold)
+    if not known:
+        log("unknown LOG_LEVEL %r; using INFO" % (setting,), level=WARNING)
+    return threshold
+
+def _log_text(m):
+    if callable(m):
+        m = m()
+    if isinstance(m, unicode):
+        m = m.encode('utf-8')
+    elif not isinstance(m, str):
+        try:
+            m = str(m)
+        except Exception:
+            m = repr(m)
+    if len(m) > config.LOG_MAX_LENGTH:
+        m = '%s... [%d more bytes]' % (m[:config.LOG_MAX_LENGTH], len(m) - config.LOG_MAX_LENGTH)
+    return m
+
 def log(*messages, **kwargs):
-    """Send the messages to the appropriate place (stderr, or syslog).
-    If a <debug> keyword is specified, the message is only printed if
-    its value is in the global DEBUG_MODES."""
-    if 'debug' not in kwargs or config.DEBUG_ALL or kwargs['debug'] in config.DEBUG_MODES:
-        for m in messages:
-            try:
-                print >> sys.stderr, m
-            except Exception:
-                print >> sys.stderr, repr(m)
+    """Send the messages to the log (stderr, which init_log may have
+    pointed at a file).
+
+    Messages below config.LOG_LEVEL are dropped; the level is given by
+    the <level> keyword (default INFO).  If a <debug> keyword is
+    specified, the message is only logged if its value is in the
+    global DEBUG_MODES.  A message that is callable is only called
+    (to get the real message) if it is going to be logged, so
+    log(lambda: pformat(x), level=DEBUG) costs nothing when debug
+    messages are off.  Messages longer than config.LOG_MAX_LENGTH are
+    cut short.
+
+    With config.LOG_FORMAT = 'json', each call writes one JSON object
+    per line, with the time, level, process, and the job set by
+    set_log_job()."""
+    level = kwargs.get('level', INFO)
+    if not log_enabled(level, kwargs.get('debug')):
+        return
+    text = '\n'.join(_log_text(m) for m in messages)
+    if config.LOG_FORMAT == 'json':
+        now = time.time()
+        text = json.dumps({'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(now)) +
+                           ('.%03d' % (now % 1 * 1000)),
+                           'level': LEVEL_NAMES.get(level, level),
+                           'pid': os.getpid(),
+                           'job': _log_job,
+                           'msg': text.decode('utf-8', 'replace'),
+                           })
+    #one write per message, so messages from different processes
+    #don't get mixed up.
+    try:
         sys.stderr.flush()
+        os.write(sys.stderr.fileno(), text + '\n')
+    except (AttributeError, ValueError, OSError, IOError):
+        sys.stderr.write(text + '\n')
 
 def log_types(*args, **kwargs):
-    """Log the type of the messages as well as their value (size constrained)."""
+    """Log the type of the messages as well as their value (size
+    constrained), as debug messages."""
+    if not log_enabled(DEBUG):
+        return
     size = kwargs.get('size', 50)
     for a in args:
         try:
@@ -78,7 +182,7 @@ def log_types(*args, **kwargs):
                 s = ("%r" % (a,))
             except Exception:
                 s = '<UNPRINTABLE!>'
-        log("%s: %s" % (type(a), s[:size]))
+        log("%s: %s" % (type(a), s[:size]), level=DEBUG)
 
 def make_book_name(book, server, suffix='.pdf', timestamp=None):
     lang = guess_lang(server, book)
@@ -137,16 +241,42 @@ def get_number_localiser(locale):
     return _localiser
 
 
-def run(cmd):
+#Counts of what the process has done, for the job records (see
+#objavi/jobstore.py): {command: [runs, seconds]} for commands started
+#by run(), and {cache name: [hits, misses]}.
+_subprocess_times = {}
+_cache_counts = {}
+
+def note_cache(name, hit):
+    """Count a hit (or a miss) for the named cache."""
+    counts = _cache_counts.setdefault(name, [0, 0])
+    counts[not hit] += 1
+
+def job_counters():
+    """A copy of the subprocess times and cache counts so far."""
+    return {'subprocess': dict((k, list(v)) for k, v in _subprocess_times.items()),
+            'cache': dict((k, list(v)) for k, v in _cache_counts.items()),
+            }
+
+def run(cmd, env=None):
+    """Run the command, logging its output, and return its exit
+    status.  If <env> is given it is the command's environment."""
+    from subprocess import Popen, PIPE
+    start = time.time()
     try:
-        p = Popen(cmd, stdout=PIPE, stderr=PIPE)
+        p = Popen(cmd, stdout=PIPE, stderr=PIPE, env=env)
         out, err = p.communicate()
     except Exception:
         log("Failed on command: %r" % cmd)
         raise
-    log("%s\n%s returned %s and produced\nstdout:%s\nstderr:%s" %
-        (' '.join(cmd), cmd[0], p.poll(), out, err))
-    return p.poll()
+    times = _subprocess_times.setdefault(os.path.basename(cmd[0]), [0, 0.0])
+    times[0] += 1
+    times[1] += time.time() - start
+    status = p.poll()
+    log("%s returned %s" % (' '.join(cmd), status))
+    #the output is usually only interesting when something went wrong
+    log(lambda: "stdout:%s\nstderr:%s" % (out, err), level=(status and WARNING or DEBUG))
+    return status
 
 def shift_file(fn, dir, backup='~'):
     """Shift a file and save backup (only works on same filesystem)"""
@@ -158,6 +288,79 @@ def shift_file(fn, dir, backup='~'):
     shutil.move(fn, dest)
     return dest
 
+def ensure_dir(d):
+    """Make directory <d> and its parents, unless another process
+    already has (or <d> is '', meaning the current directory)."""
+    if d and not os.path.exists(d):
+        try:
+            os.makedirs(d)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+def atomic_write(fn, data):
+    """Replace <fn> in one go, so readers never see it half written.
+    <data> is a string, or a function that writes the file it is given
+    the name of.  The directory is made if need be."""
+    ensure_dir(os.path.dirname(fn))
+    #books can be made in threads, which may write the same file
+    tmp = '%s.%s-%s.tmp' % (fn, os.getpid(), thread.get_ident())
+    if callable(data):
+        data(tmp)
+    else:
+        f = open(tmp, 'wb')
+        f.write(data)
+        f.close()
+    os.rename(tmp, fn)
+
+def remove_old_files(dir, max_age, suffixes=None):
+    """Delete the files in <dir> (those ending in one of <suffixes>,
+    if given) that have not been modified for <max_age> seconds.
+    Files another process removes first are skipped.  Returns the
+    number removed."""
+    try:
+        names = os.listdir(dir)
+    except OSError:
+        return 0
+    cutoff = time.time() - max_age
+    removed = 0
+    for name in names:
+        if suffixes is not None and not name.endswith(suffixes):
+            continue
+        fn = os.path.join(dir, name)
+        try:
+            if os.stat(fn).st_mtime < cutoff:
+                os.unlink(fn)
+                removed += 1
+        except OSError:
+            continue
+    return removed
+
+_templates = {}
+
+def file_stamp(fn):
+    """The modification time and size of <fn>, or None if it doesn't
+    exist.  Anything made from the file is stale once this changes."""
+    try:
+        s = os.stat(fn)
+    except OSError:
+        return None
+    return (s.st_mtime, s.st_size)
+
+def read_template(fn):
+    """Return the contents of the template file <fn>.  Each template
+    is read once per process, and read again only if its file_stamp
+    changes.  Raises IOError if the file can't be read."""
+    stamp = file_stamp(fn)
+    cached = _templates.get(fn)
+    if cached is not None and stamp is not None and cached[0] == stamp:
+        return cached[1]
+    f = open(fn)
+    s = f.read()
+    f.close()
+    _templates[fn] = (stamp, s)
+    return s
+
 class ObjaviError(Exception):
     pass
 
@@ -184,6 +387,7 @@ def decode_html_entities(text):
     return re.sub("&#x[0-9a-fA-F]+;|&#[0-9]+;|&[0-9a-zA-Z]+;", fixup, text).encode('utf-8')
 
 def url_fetch(url, suppress_error=False):
+    from urllib2 import urlopen, HTTPError
     try:
         f = urlopen(url)
         s = f.read()
@@ -196,6 +400,7 @@ def url_fetch(url, suppress_error=False):
     #returns None is error is suppressed
 
 def url_fetch2(url, suppress_error=False):
+    from urllib2 import urlopen, HTTPError
     try:
         f = urlopen(url)
         s = f.read()
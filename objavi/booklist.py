@@ -0,0 +1,186 @@
+# Part of Objavi2, which turns html manuals into books.  This module
+# keeps the lists of books on each server.
+#
+# Copyright (C) 2009 Douglas Bagnall
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""The lists of books on Booki and TWiki servers, for the form's book
+menu, cached in config.BOOK_LIST_CACHE_DIR.
+
+A cached list is always used straight away.  If it is more than
+config.BOOK_LIST_CACHE seconds old, a background process asks the
+server for a new one, so the next request will get that.  The server
+is asked conditionally (with the ETag and Last-Modified headers of its
+last answer), so an unchanged list costs it little.  Only a request
+for a server with no cached list waits for the server.
+
+The server's answer is cached as it came, and parsed for each request,
+so the lists are the same as those the servers would give directly.
+This module is kept free of lxml and the other heavy modules, as the
+booklist mode is one of the light ones."""
+
+import os
+import re
+import time
+import fcntl
+import urllib
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from objavi.book_utils import log, atomic_write
+from objavi import config
+
+
+def booki_url(server):
+    return 'http://%s/list-books.json' % server
+
+def parse_booki(s):
+    """Booki offers its list as json, and we want (url, title) pairs."""
+    items = []
+    for book in json.loads(s):
+        items.append((book['fields']['url_title'], book['fields']['title']))
+    return items
+
+def twiki_url(server):
+    """Floss Manual TWikis keep their list at
+    /bin/view/TWiki/WebLeftBarWebsList?skin=text"""
+    return config.CHAPTER_URL % (server, 'TWiki', 'WebLeftBarWebsList')
+
+def parse_twiki(s):
+    #XXX should use lxml
+    return sorted(x for x in re.findall(r'/bin/view/([\w/]+)/WebHome', s)
+                  if x not in config.IGNORABLE_TWIKI_BOOKS)
+
+INTERFACES = {
+    'Booki': (booki_url, parse_booki),
+    'TWiki': (twiki_url, parse_twiki),
+}
+
+
+def fetch(url, validators=None):
+    """Fetch <url>, asking for it only if it has changed since the
+    answer with the headers in <validators>.  Returns the body (or
+    None if it hasn't changed) and the new answer's validators."""
+    from urllib2 import Request, urlopen, HTTPError
+    log('getting booklist: %s' % url)
+    req = Request(url)
+    if validators:
+        if validators.get('etag'):
+            req.add_header('If-None-Match', validators['etag'])
+        if validators.get('last_modified'):
+            req.add_header('If-Modified-Since', validators['last_modified'])
+    try:
+        f = urlopen(req, timeout=config.BOOK_LIST_TIMEOUT)
+    except HTTPError, e:
+        if e.code == 304:
+            log('booklist %s has not changed' % url)
+            return None, validators
+        raise
+    body = f.read()
+    info = f.info()
+    f.close()
+    return body, {'etag': info.get('ETag'), 'last_modified': info.get('Last-Modified')}
+
+
+def _cache_name(server, interface):
+    #some servers have paths in their names
+    return os.path.join(config.BOOK_LIST_CACHE_DIR, '%s.%s.booklist' %
+                        (urllib.quote(server, ''), interface))
+
+def _read(fn):
+    try:
+        f = open(fn)
+    except IOError:
+        return None
+    s = f.read()
+    f.close()
+    return s
+
+def refresh(server, interface):
+    """Fetch the book list for <server> and update the cache.  The
+    cached list's mtime is when the server last vouched for it."""
+    make_url, parse = INTERFACES[interface]
+    fn = _cache_name(server, interface)
+    validators = None
+    if os.path.exists(fn):
+        s = _read(fn + '.validators')
+        if s:
+            validators = json.loads(s)
+    body, validators = fetch(make_url(server), validators)
+    if body is None:
+        os.utime(fn, None)
+        return
+    #don't keep an error page
+    parse(body)
+    atomic_write(fn + '.validators', json.dumps(validators))
+    atomic_write(fn, body)
+
+def refresh_in_background(server, interface):
+    """Refresh the cached list in a detached process, unless another
+    one is already doing it."""
+    fn = _cache_name(server, interface)
+    lock = open(fn + '.lock', 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        lock.close()
+        return
+    pid = os.fork()
+    if pid:
+        #the grandchild holds the lock now
+        lock.close()
+        os.waitpid(pid, 0)
+        return
+    #fork again, so the refreshing process is nobody's zombie, and let
+    #go of the web server's pipes, so it isn't kept waiting.
+    try:
+        if os.fork():
+            os._exit(0)
+        devnull = os.open(os.devnull, os.O_RDWR)
+        os.dup2(devnull, 0)
+        os.dup2(devnull, 1)
+        refresh(server, interface)
+    except Exception, e:
+        log("could not refresh the book list for %s: %s" % (server, e))
+    os._exit(0)
+
+
+def get_book_list(server, interface=None):
+    """Return the list of books on <server>.  <interface> ('Booki' or
+    'TWiki') defaults to the one in the server's configuration.
+
+    If BOOK_LIST_CACHE is zero, the list is fetched every time."""
+    if interface is None:
+        interface = config.SERVER_DEFAULTS[server]['interface']
+    make_url, parse = INTERFACES[interface]
+    if not config.BOOK_LIST_CACHE:
+        return parse(fetch(make_url(server))[0])
+
+    fn = _cache_name(server, interface)
+    try:
+        age = time.time() - os.stat(fn).st_mtime
+        body = _read(fn)
+    except OSError:
+        body = None
+    if body is None:
+        refresh(server, interface)
+        body = _read(fn)
+    elif age > config.BOOK_LIST_CACHE:
+        log('booklist for %s is %d seconds old; refreshing' % (server, age))
+        refresh_in_background(server, interface)
+    return parse(body)
@@ -21,7 +21,7 @@ import cgi, re
 import urllib
 from getopt import gnu_getopt
 
-from objavi.book_utils import log
+from objavi.book_utils import log, read_template
 from objavi import config
 
 def parse_args(arg_validators):
@@ -69,7 +69,14 @@ def super_bleach(dirty_name):
 def get_server_list():
     return sorted(k for k, v in config.SERVER_DEFAULTS.items() if v['display'])
 
+_size_list = None
+
 def get_size_list():
+    """The displayed page sizes, ordered by area.  They come from the
+    configuration, so are only worked out once."""
+    global _size_list
+    if _size_list is not None:
+        return _size_list
     #order by increasing areal size.
     def calc_size(name, pointsize, klass):
         if pointsize:
@@ -80,9 +87,11 @@ def get_size_list():
 
         return (0, name, klass, name) # presumably 'custom'
 
-    return [x[1:] for x in sorted(calc_size(k, v.get('pointsize'), v.get('class', ''))
-                                  for k, v in config.PAGE_SIZE_DATA.iteritems() if v.get('display'))
-            ]
+    _size_list = [x[1:] for x in sorted(calc_size(k, v.get('pointsize'), v.get('class', ''))
+                                        for k, v in config.PAGE_SIZE_DATA.iteritems()
+                                        if v.get('display'))
+                  ]
+    return _size_list
 
 def url2path(url):
     """convert htdocs-relative addresses to local file paths"""
@@ -106,15 +115,16 @@ def path2url(path, default='/missing_path?%(path)s', full=False):
     return path
 
 
+def get_default_css_file(server=config.DEFAULT_SERVER, mode='book'):
+    """Where the default CSS for the selected server is."""
+    return url2path(config.SERVER_DEFAULTS[server]['css-%s' % mode])
+
 def get_default_css(server=config.DEFAULT_SERVER, mode='book'):
     """Get the default CSS text for the selected server"""
     log(server)
-    cssfile = url2path(config.SERVER_DEFAULTS[server]['css-%s' % mode])
+    cssfile = get_default_css_file(server, mode)
     log(cssfile)
-    f = open(cssfile)
-    s = f.read()
-    f.close()
-    return s
+    return read_template(cssfile)
 
 def font_links():
     """Links to various example pdfs."""
@@ -170,6 +180,9 @@ def is_url(s):
 def is_name(s):
     return re.match(r'^[\w-]+$', s)
 
+def is_bookname(s):
+    return re.match(r'^\w[\w.-]*$', s)
+
 def is_utf8(s):
     try:
         s.decode('utf-8')
@@ -231,6 +244,123 @@ def output_blob_and_shut_up(blob, content_type="application/octet-stream", filen
     os.dup2(devnull.fileno(), sys.stdout.fileno())
     log(sys.stdout)
 
+def parse_range(header, size):
+    """Parse an HTTP Range header, returning (first, last) byte
+    offsets, or None if it should be ignored (absent, or asking for
+    more than one range).  Raises ValueError if the range can't be
+    satisfied."""
+    m = re.match(r'^bytes=(\d*)-(\d*)$', header.strip())
+    if m is None:
+        return None
+    first, last = m.groups()
+    if first:
+        first = int(first)
+        last = min(int(last), size - 1) if last else size - 1
+    elif last:
+        #the last <last> bytes
+        first = max(size - int(last), 0)
+        last = size - 1
+    else:
+        return None
+    if first > last:
+        raise ValueError("unsatisfiable range %r of %s bytes" % (header, size))
+    return first, last
+
+def redirect_and_exit(url):
+    """Send the client to <url>.  A path is made into a full url, so
+    that the web server doesn't quietly serve it in place of this
+    response, with this request's headers."""
+    if url.startswith('/'):
+        url = 'http://%s%s' % (os.environ.get('HTTP_HOST', SERVER_NAME), url)
+    print 'Status: 302 Found\nLocation: %s\n' % url
+    sys.exit()
+
+def output_published_file_and_exit(fn, content_type="application/octet-stream",
+                                   filename=None):
+    """Deliver <fn>, a file this request has just made, by sending the
+    client to its published url (or, if it is not in the web tree,
+    with output_file_and_exit).
+
+    Each request makes a new file with a new ETag, so a download
+    interrupted part way could never be resumed from this request's
+    url.  The published file stays as it is, and the web server
+    answers Range and If-Range requests for it itself.  A client that
+    resumes from the original url rather than the one it was sent to
+    gets a fresh build, which is sent whole: a range of it wouldn't
+    fit what it already has."""
+    if 'HTTP_RANGE' in os.environ:
+        output_file_and_exit(fn, content_type, filename, ranges=False)
+    url = path2url(fn, default='')
+    if url:
+        redirect_and_exit(url)
+    output_file_and_exit(fn, content_type, filename)
+
+def output_file_and_exit(fn, content_type="application/octet-stream", filename=None,
+                         ranges=True):
+    """Send the file <fn> as the CGI response, in chunks, honouring
+    If-None-Match and single Range requests.  A Range with an If-Range
+    that doesn't name the current ETag gets the whole file.  A Range
+    without one is trusted, so this is for files that don't change
+    under their names (see output_published_file_and_exit for ones
+    that are made afresh for each request).  If <ranges> is false,
+    the whole file is always sent (by this process, even if
+    config.SENDFILE_HEADER is set).  Otherwise, if SENDFILE_HEADER is
+    set, the web server is told to send the file."""
+    st = os.stat(fn)
+    size = st.st_size
+    etag = '"%x-%x-%x"' % (st.st_ino, size, int(st.st_mtime))
+    headers = ['Content-type: %s' % content_type,
+               'ETag: %s' % etag,
+               'Accept-Ranges: bytes']
+    if filename is not None:
+        headers.append('Content-Disposition: attachment; filename="%s"' % filename)
+
+    #the web server would honour the Range itself
+    if config.SENDFILE_HEADER is not None and ranges:
+        if config.SENDFILE_HEADER == 'X-Accel-Redirect':
+            #nginx wants a uri
+            headers.append('X-Accel-Redirect: %s' % path2url(fn))
+        else:
+            headers.append('%s: %s' % (config.SENDFILE_HEADER, os.path.abspath(fn)))
+        print '\n'.join(headers) + '\n'
+        sys.exit()
+
+    if os.environ.get('HTTP_IF_NONE_MATCH') == etag:
+        print 'Status: 304 Not Modified\nETag: %s\n' % etag
+        sys.exit()
+
+    first, last = 0, size - 1
+    if ranges and 'HTTP_RANGE' in os.environ and os.environ.get('HTTP_IF_RANGE', etag) == etag:
+        try:
+            r = parse_range(os.environ['HTTP_RANGE'], size)
+        except ValueError, e:
+            log(e)
+            print 'Status: 416 Requested Range Not Satisfiable\nContent-Range: bytes */%s\n' % size
+            sys.exit()
+        if r is not None:
+            first, last = r
+            headers.insert(0, 'Status: 206 Partial Content')
+            headers.append('Content-Range: bytes %s-%s/%s' % (first, last, size))
+
+    headers.append('Content-length: %s' % (last + 1 - first))
+    sys.stdout.write('\n'.join(headers) + '\n\n')
+    f = open(fn, 'rb')
+    f.seek(first)
+    remaining = last + 1 - first
+    try:
+        while remaining > 0:
+            data = f.read(min(remaining, config.DOWNLOAD_CHUNK_SIZE))
+            if not data:
+                break
+            sys.stdout.write(data)
+            remaining -= len(data)
+        sys.stdout.flush()
+    except IOError, e:
+        #the client went away
+        log("download of %s stopped: %s" % (fn, e))
+    f.close()
+    sys.exit()
+
 ##Decorator function for output
 def output_and_exit(f, content_type="text/html; charset=utf-8"):
     """Decorator: prefix function output with http headers and exit
@@ -248,10 +378,7 @@ def output_and_exit(f, content_type="text/html; charset=utf-8"):
 
 @output_and_exit
 def print_template_and_exit(template, mapping):
-    f = open(template)
-    string = f.read()
-    f.close()
-    return string % mapping
+    return read_template(template) % mapping
 
 def try_to_kill(pid, signal=15):
     log('kill -%s %s ' % (signal, pid))
@@ -0,0 +1,217 @@
+# Part of Objavi2, which turns html manuals into books.  This module
+# lets identical render requests share one build.
+#
+# Copyright (C) 2009 Douglas Bagnall
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Coalesce identical concurrent render requests onto one build.
+
+The first request for a book with a given set of options is the
+leader.  It holds a lock on a file named for the request, containing
+the book's name, and another on a file named for the book, while it
+works.  It writes its progress messages, and eventually the name of
+the published file, beside the book's lock.  Requests that find the
+request's lock taken are followers: they take the leader's book name
+(so the urls they print are the leader's), relay its progress
+messages to their own watchers, and deliver its published file as
+their own.
+
+Only builds that are running when a request arrives are joined, so a
+follower gets the book as it was fetched moments before.  If the
+leader dies without publishing, the first follower to get the book's
+lock makes the book itself, under the same name, and the others
+follow it instead.  Files in COALESCE_DIR are removed once they are
+config.COALESCE_MAX_AGE seconds old."""
+
+import os
+import time
+import fcntl
+import errno
+from hashlib import sha1
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from objavi.book_utils import log, remove_old_files, ensure_dir, atomic_write
+from objavi import config
+
+#arguments that say how the caller hears of the result, not what it
+#is.  'destination' isn't one: the leader does the publishing (an
+#upload to archive.org, say), so followers must want the same.
+DELIVERY_ARGS = ('method', 'callback')
+
+def request_key(args):
+    """A name for the book and options that determine the output."""
+    items = sorted((k, v) for k, v in args.iteritems() if k not in DELIVERY_ARGS)
+    return sha1(repr(items)).hexdigest()
+
+
+class Flight(object):
+    """One request's part in a (perhaps shared) build.  If
+    self.following is true, another request is making the book and
+    this one should call follow(); otherwise it makes the book
+    itself."""
+    fd = None
+    flight_fd = None
+    leader = False
+    following = False
+
+    def __init__(self, args, bookname):
+        ensure_dir(config.COALESCE_DIR)
+        self.key = request_key(args)
+        self.lockfile = os.path.join(config.COALESCE_DIR, self.key + '.lock')
+        self.bookname = bookname
+        #someone else may be making it.  They write their bookname as
+        #soon as they have the lock, but we might be quicker, or they
+        #might be letting go.
+        for i in range(20):
+            if self._take_lock():
+                return
+            name = self._read_leader()
+            if name:
+                self.bookname = name
+                self.following = True
+                log("following %s for %s" % (name, self.key))
+                return
+            time.sleep(0.05)
+        log("%s is locked but has no leader; making %s anyway" % (self.key, bookname))
+
+    def _path(self, suffix):
+        return os.path.join(config.COALESCE_DIR, self.bookname + suffix)
+
+    def _lock(self, fn):
+        """Open and lock <fn> without waiting, returning the file
+        descriptor, or None if someone else has the lock."""
+        fd = os.open(fn, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            os.close(fd)
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return None
+            raise
+        #forked children share the lock, but not the programs they run
+        fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        return fd
+
+    def _take_lock(self):
+        """Try to become the leader, without waiting."""
+        fd = self._lock(self.lockfile)
+        if fd is None:
+            return False
+        #followers watch the book's lock, so it is taken before they
+        #can learn the name.  A follower taking over already has it.
+        if self.flight_fd is None:
+            self.flight_fd = self._lock(self._path('.lock'))
+            if self.flight_fd is None:
+                os.close(fd)
+                return False
+        os.ftruncate(fd, 0)
+        os.write(fd, self.bookname)
+        self.fd = fd
+        self.leader = True
+        #after the write, which makes the lock file new
+        remove_old_files(config.COALESCE_DIR, config.COALESCE_MAX_AGE)
+        return True
+
+    def _read_leader(self):
+        try:
+            f = open(self.lockfile)
+        except IOError:
+            return ''
+        name = f.read().strip()
+        f.close()
+        return name
+
+    def _read_result(self):
+        try:
+            f = open(self._path('.done'))
+        except IOError:
+            return None
+        result = f.read()
+        f.close()
+        return result
+
+    def notifier(self, message):
+        """A Book watcher that records the leader's progress for the
+        followers."""
+        if self.leader:
+            f = open(self._path('.progress'), 'a')
+            f.write(json.dumps(message) + '\n')
+            f.close()
+
+    def land(self, publish_file):
+        """The leader has published; tell the followers where and let
+        go of the locks, so later requests start a new build."""
+        if not self.leader:
+            return
+        atomic_write(self._path('.done'), publish_file)
+        if self.fd is not None:
+            #nobody is making it now
+            os.ftruncate(self.fd, 0)
+            os.close(self.fd)
+            self.fd = None
+        os.close(self.flight_fd)
+        self.flight_fd = None
+        self.leader = False
+
+    def follow(self, watchers):
+        """Pass the leader's progress messages on to <watchers> until
+        it publishes, and return the published file name.  If the
+        leader disappears without publishing, take over the book's
+        lock and return None: the caller should make the book."""
+        offset = 0
+        while True:
+            result = self._read_result()
+            offset = self._relay(offset, watchers)
+            if result is not None:
+                return result
+            fd = self._lock(self._path('.lock'))
+            if fd is not None:
+                #the leader is gone, but did it finish on the way out?
+                result = self._read_result()
+                if result is not None:
+                    os.close(fd)
+                    self._relay(offset, watchers)
+                    return result
+                log("leader of %s vanished, making it here" % self.bookname)
+                self.flight_fd = fd
+                self.leader = True
+                self.following = False
+                #identical requests arriving now should follow this
+                #build, unless a new one has already started
+                self._take_lock()
+                return None
+            time.sleep(config.COALESCE_POLL_INTERVAL)
+
+    def _relay(self, offset, watchers):
+        try:
+            f = open(self._path('.progress'))
+        except IOError:
+            return offset
+        f.seek(offset)
+        while True:
+            line = f.readline()
+            if not line.endswith('\n'):
+                break
+            offset += len(line)
+            message = json.loads(line)
+            if message != config.FINISHED_MESSAGE:
+                for w in watchers:
+                    w(message)
+        f.close()
+        return offset
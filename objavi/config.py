@@ -43,6 +43,34 @@ TMPDIR = 'htdocs/tmp'
 LOGDIR = 'log'
 REDIRECT_LOG = True
 LOG_ROTATE_SIZE = 1000000
+#messages below this level ('DEBUG', 'INFO', 'WARNING', 'ERROR') are
+#not logged.  Longer messages are cut to LOG_MAX_LENGTH bytes.
+LOG_LEVEL = 'INFO'
+LOG_MAX_LENGTH = 2000
+#'text' (plain messages) or 'json' (one object per line, with the
+#time, level, process id and job)
+LOG_FORMAT = 'text'
+
+#Every job is recorded in this sqlite database (see objavi/jobstore.py
+#and bin/job-report), which keeps the last JOB_STORE_MAX_JOBS.
+#Admission control fits its estimates to these records.  None turns
+#the recording off.
+JOB_STORE = 'cache/jobs.sqlite'
+JOB_STORE_MAX_JOBS = 100000
+
+#Profiling (see objavi/profiling.py).  A job runs under cProfile if
+#its request has profile=yes (and PROFILE_ON_REQUEST is set), or at
+#random for PROFILE_SAMPLE_PERCENT of jobs.  The stats and a summary
+#of the top PROFILE_TOP_N functions are saved in PROFILE_DIR, and
+#added to the totals for the mode in PROFILE_AGGREGATE_DIR.  Neither
+#should be served: profiles show the server's paths and code.  Leave
+#PROFILE_ON_REQUEST off on public servers, as anyone can ask.
+PROFILE_ON_REQUEST = False
+PROFILE_SAMPLE_PERCENT = 0
+PROFILE_TOP_N = 40
+PROFILE_SORT = ('cumulative', 'time')
+PROFILE_DIR = 'cache/profiles/jobs'
+PROFILE_AGGREGATE_DIR = 'cache/profiles'
 
 SHOW_BOOKI_SERVERS = bool(_environ.get("SHOW_BOOKI_SERVERS", False))
 
@@ -50,6 +78,13 @@ HTDOCS = 'htdocs'
 BOOKI_BOOK_DIR = 'htdocs/booki-books'
 BOOKI_BOOK_URL = '/booki-books'
 
+#bin/espri-batch: concurrent downloads, overall and per host, and
+#conversion processes (None means one per CPU).
+ESPRI_BATCH_DOWNLOADS = 8
+ESPRI_BATCH_DOWNLOADS_PER_HOST = 2
+ESPRI_BATCH_PROCESSES = None
+ESPRI_BATCH_PROGRESS_FILE = 'espri-batch-progress.json'
+
 BOOKI_SHARED_DIRECTORY = 'htdocs/shared'
 BOOKI_SHARED_LONELY_USER_PREFIX = 'lonely-user-'
 
@@ -61,12 +96,17 @@ USE_DUMP_OUTLINE = True
 CONTENTS_DEPTH = 1
 
 HTML2ODT = 'bin/html2odt'
+#socket of the soffice pool started by 'bin/html2odt --serve' (if it is running)
+HTML2ODT_SOCKET = 'cache/html2odt.sock'
 
 #CGITB_DOMAINS = ('203.97.236.46', '202.78.240.7')
 CGITB_DOMAINS = False
 
-#bookland is used to make isbn barcodes
+#isbn barcodes are drawn using bookland's productcode.py, found beside
+#BOOKLAND.  Those pages and blank covers are cached in PDF_PAGE_CACHE_DIR
+#(set it to None to make them every time).
 BOOKLAND = 'bookland/bookland'
+PDF_PAGE_CACHE_DIR = 'cache/pdf-pages'
 
 # how many pages to number in one pdfedit process (which has
 # exponential memory leak)
@@ -75,9 +115,50 @@ PDFEDIT_MAX_PAGES = 20
 #maximum memory for objavi.cgi
 OBJAVI_CGI_MEMORY_LIMIT = 1600 * 1024 * 1024
 
-#keep book lists around for this time without refetching
+#how many formats the multi mode makes at once (each in its own process)
+MULTI_FORMAT_PROCESSES = 3
+#how often (seconds) it looks for finished format processes
+MULTI_FORMAT_POLL_INTERVAL = 0.2
+#how long it waits for the result of a process that has exited
+#(one that was killed never sends one)
+MULTI_FORMAT_RESULT_TIMEOUT = 5
+
+#Admission control (see objavi/admission.py).  Books wait to be made
+#until the estimated memory and CPU use of all the running jobs fits
+#in these budgets.  None means 3/4 of the RAM and all the CPUs.
+ADMISSION_CONTROL = True
+ADMISSION_MEMORY_BUDGET = None
+ADMISSION_CPU_BUDGET = None
+ADMISSION_DIR = 'cache/admission'
+ADMISSION_POLL_INTERVAL = 1.0
+#after this many seconds waiting, a job starts regardless
+ADMISSION_MAX_WAIT = 600
+#cost of each mode until there are metrics to fit:
+#(base bytes, bytes per byte of work, CPUs kept busy)
+ADMISSION_COSTS = {
+    'book': (250 * 1024 * 1024, 30, 1.5),
+    'newspaper': (250 * 1024 * 1024, 30, 1.5),
+    'web': (200 * 1024 * 1024, 25, 1.2),
+    'openoffice': (300 * 1024 * 1024, 20, 1.0),
+    'epub': (60 * 1024 * 1024, 4, 1.0),
+    'bookizip': (30 * 1024 * 1024, 1, 0.3),
+    'templated_html': (80 * 1024 * 1024, 6, 1.0),
+}
+#a byte of image costs this many bytes of html; each extra column adds this fraction
+ADMISSION_IMAGE_WEIGHT = 4
+ADMISSION_COLUMN_WEIGHT = 0.25
+#fit the costs to this many recent jobs, once a mode has enough
+ADMISSION_CALIBRATION_JOBS = 500
+ADMISSION_CALIBRATION_MIN_JOBS = 10
+ADMISSION_SAFETY_MARGIN = 1.2
+
+#book lists older than this are refreshed in the background (but
+#still used).  If it is 0, the lists are fetched for every request.
 BOOK_LIST_CACHE = 3600 * 2
 CACHE_DIR = 'cache'
+BOOK_LIST_CACHE_DIR = 'cache/booklists'
+#seconds to wait for a server's book list
+BOOK_LIST_TIMEOUT = 30
 
 #for twiki import
 TOC_URL = "http://%s/pub/%s/_index/TOC.txt"
@@ -103,8 +184,39 @@ TEMPLATING_INDEX_MODES = {  # contents file, first file
 }
 
 TAR_TEMPLATED_HTML = True
+#write <file>.gz beside templated html and css files for the web server
+#(the apache-config-* examples send them; other servers need setting up)
+PRECOMPRESS_TEMPLATED_HTML = True
+#threads writing templated html pages to disk
+TEMPLATING_WRITE_THREADS = 4
+
+#Downloads are sent from the file in chunks of this size, unless
+#SENDFILE_HEADER is set, in which case the web server sends the file:
+#'X-Sendfile' for Apache mod_xsendfile or lighttpd, 'X-Accel-Redirect'
+#for nginx (with an internal location matching the htdocs urls).
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+SENDFILE_HEADER = None
 
 POLL_NOTIFY_PATH = 'htdocs/progress/%s.txt'
+#progress.cgi waits this long for news before answering a long poll
+PROGRESS_LONGPOLL_TIMEOUT = 25
+PROGRESS_CHECK_INTERVAL = 0.25
+#progress files are removed when they are this many seconds old
+PROGRESS_MAX_AGE = 24 * 3600
+#callbacks: messages arriving within this time are sent together
+CALLBACK_COALESCE_DELAY = 0.5
+CALLBACK_TIMEOUT = 20
+CALLBACK_RETRY_DELAYS = (1, 4, 16)
+#how long a finished job waits for its last callbacks to go
+CALLBACK_FLUSH_TIMEOUT = 60
+
+#requests for a book with the same options as one being made wait for
+#that one rather than making another copy (see objavi/coalesce.py)
+COALESCE_RENDERS = True
+COALESCE_DIR = 'cache/inflight'
+COALESCE_POLL_INTERVAL = 0.5
+#finished builds' files are tidied away after this many seconds
+COALESCE_MAX_AGE = 24 * 3600
 #POLL_NOTIFY_URL = 'http://%(HTTP_HOST)s/progress/%(bookname)s.txt'
 
 ZIP_URLS = {
@@ -337,6 +449,7 @@ DEBUG_MODES = (
     #'PDFEDIT',
     #'PDFGEN',
     #'HTMLGEN',
+    #'HTMLDUMP',   #save intermediate html in the book's workdir
     )
 DEBUG_ALL = False
 
@@ -428,6 +541,9 @@ END_MATTER_TEMPLATE = 'templates/end_matter.%s.html'
 FONT_LIST_INCLUDE = 'cache/font-list.inc'
 FONT_LIST_URL = '/font-list.cgi.pdf'
 FONT_EXAMPLE_SCRIPT_DIR = 'templates/font-list'
+#font programs prepared for embedding in PDFs, and where fontconfig
+#found them
+FONT_CACHE_DIR = 'cache/fonts'
 
 # for the license field, with a view to making it a drop down.
 LICENSES = {
@@ -469,6 +585,11 @@ CLAIM_UNAUTHORED = False
 
 IMG_CACHE = 'cache/images/'
 
+#Parsed (and for epub, cleaned) chapters are kept here, so that other
+#output modes and other jobs using the same chapter needn't reparse it.
+USE_CHAPTER_CACHE = True
+CHAPTER_CACHE = 'cache/chapters/'
+
 USE_IMG_CACHE_ALWAYS_HOSTS = ['objavi.halo.gen.nz']
 USE_ZIP_CACHE_ALWAYS_HOSTS = ['objavi.halo.gen.nz']
 
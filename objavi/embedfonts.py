@@ -0,0 +1,373 @@
+# Part of Objavi2, which turns html manuals into books.  This module
+# puts missing fonts into PDFs.
+#
+# Copyright (C) 2009 Douglas Bagnall
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Embed the fonts that a PDF uses but doesn't contain.
+
+embed_fonts() finds the fonts used on the pages that have no font
+program, finds each one on this machine (asking fontconfig's
+fc-match), and adds the programs to the PDF as an incremental update.
+The pages and everything else in the PDF stay as they were, and a PDF
+with nothing missing isn't touched at all.  The standard 14 PDF fonts
+are embedded using their URW equivalents, as Ghostscript does.
+
+Prepared font programs (compressed, with the numbers the PDF needs)
+are kept in config.FONT_CACHE_DIR, keyed by the font's name and its
+file's path, size and mtime.  fontconfig's answers are kept there too,
+so a print run needing the same fonts as the last one does little more
+than copy them in."""
+
+import os
+import re
+import zlib
+import struct
+from hashlib import sha1
+from subprocess import Popen, PIPE
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from objavi.book_utils import log, note_cache, file_stamp, atomic_write, WARNING
+from objavi.simplepdf import PDFReader, PDFError, Name, Ref, Stream, append_objects
+from objavi import config
+
+#change this when prepared programs change, so old cached ones aren't used
+VERSION = 1
+
+#the standard 14 fonts, and the PostScript names of the URW fonts that
+#stand in for them, in urw-base35 and in the older gsfonts.
+STANDARD_FONTS = {
+    'Times-Roman': ('NimbusRoman-Regular', 'NimbusRomNo9L-Regu'),
+    'Times-Bold': ('NimbusRoman-Bold', 'NimbusRomNo9L-Medi'),
+    'Times-Italic': ('NimbusRoman-Italic', 'NimbusRomNo9L-ReguItal'),
+    'Times-BoldItalic': ('NimbusRoman-BoldItalic', 'NimbusRomNo9L-MediItal'),
+    'Helvetica': ('NimbusSans-Regular', 'NimbusSanL-Regu'),
+    'Helvetica-Bold': ('NimbusSans-Bold', 'NimbusSanL-Bold'),
+    'Helvetica-Oblique': ('NimbusSans-Italic', 'NimbusSanL-ReguItal'),
+    'Helvetica-BoldOblique': ('NimbusSans-BoldItalic', 'NimbusSanL-BoldItal'),
+    'Courier': ('NimbusMonoPS-Regular', 'NimbusMonL-Regu'),
+    'Courier-Bold': ('NimbusMonoPS-Bold', 'NimbusMonL-Bold'),
+    'Courier-Oblique': ('NimbusMonoPS-Italic', 'NimbusMonL-ReguObli'),
+    'Courier-BoldOblique': ('NimbusMonoPS-BoldItalic', 'NimbusMonL-BoldObli'),
+    'Symbol': ('StandardSymbolsPS', 'StandardSymL'),
+    'ZapfDingbats': ('D050000L', 'Dingbats'),
+}
+
+#the kinds of font program each kind of PDF font can have
+ACCEPTED_PROGRAMS = {
+    'Type1': ('pfb', 'pfa', 'opentype'),
+    'MMType1': ('pfb', 'pfa'),
+    'TrueType': ('truetype', 'opentype'),
+    'CIDFontType0': ('opentype',),
+    'CIDFontType2': ('truetype',),
+}
+
+#font descriptor flags
+FIXED_PITCH = 1
+SERIF = 2
+SYMBOLIC = 4
+NONSYMBOLIC = 32
+ITALIC = 64
+
+FONT_FILE_KEYS = ('FontFile', 'FontFile2', 'FontFile3')
+
+
+_font_files = None
+#fonts fontconfig didn't have, this time
+_not_found = set()
+
+def _font_file_index():
+    global _font_files
+    if _font_files is None:
+        try:
+            f = open(os.path.join(config.FONT_CACHE_DIR, 'font-files.json'))
+            _font_files = json.load(f)
+            f.close()
+        except (IOError, ValueError):
+            _font_files = {}
+    return _font_files
+
+def find_font(name):
+    """The file of the installed font with the PostScript name <name>,
+    or None.  Fonts that fontconfig would only substitute for don't
+    count."""
+    index = _font_file_index()
+    path = index.get(name)
+    if path is not None and os.path.exists(path):
+        note_cache('font_file', True)
+        return path
+    note_cache('font_file', False)
+    if name in _not_found:
+        return None
+    pattern = ':postscriptname=' + re.sub(r'([\\:,])', r'\\\1', name)
+    try:
+        p = Popen(['fc-match', '-f', '%{file}\n%{postscriptname}\n', pattern],
+                  stdout=PIPE, stderr=PIPE)
+        out, err = p.communicate()
+    except OSError, e:
+        log("can't run fc-match: %s" % e, level=WARNING)
+        return None
+    lines = out.split('\n')
+    if len(lines) < 2 or lines[1] != name or not lines[0]:
+        _not_found.add(name)
+        return None
+    index[name] = lines[0]
+    atomic_write(os.path.join(config.FONT_CACHE_DIR, 'font-files.json'), json.dumps(index))
+    return lines[0]
+
+
+def font_kind(data):
+    """What sort of font program is in <data>?  (or None)"""
+    if data[:4] in ('\x00\x01\x00\x00', 'true'):
+        return 'truetype'
+    if data[:4] == 'OTTO':
+        return 'opentype'
+    if data[:2] == '\x80\x01':
+        return 'pfb'
+    if data[:2] == '%!':
+        return 'pfa'
+    return None
+
+def type1_parts(data, kind):
+    """The cleartext, encrypted, and trailing parts of a Type 1 font
+    program, as the PDF wants them (the encrypted part in binary)."""
+    if kind == 'pfb':
+        parts = ([], [], [])
+        part = 0
+        pos = 0
+        while data[pos:pos + 1] == '\x80' and data[pos + 1] in '\x01\x02':
+            segment = ord(data[pos + 1])
+            length = struct.unpack('<I', data[pos + 2:pos + 6])[0]
+            if segment == 2:
+                part = 1
+            elif part == 1:
+                part = 2
+            parts[part].append(data[pos + 6:pos + 6 + length])
+            pos += 6 + length
+        return [''.join(x) for x in parts]
+    m = re.compile(r'eexec[\r\n]+').search(data)
+    if m is None:
+        raise PDFError("no eexec section in Type 1 font")
+    rest = data[m.end():]
+    end = re.compile(r'0{64}').search(rest)
+    end = end and end.start() or len(rest)
+    h = re.sub(r'[^0-9a-fA-F]', '', rest[:end])
+    return data[:m.end()], h.decode('hex'), rest[end:]
+
+
+def _sfnt_tables(data):
+    count = struct.unpack('>H', data[4:6])[0]
+    tables = {}
+    for i in range(count):
+        tag, checksum, offset, length = struct.unpack('>4sIII', data[12 + 16 * i:28 + 16 * i])
+        tables[tag] = data[offset:offset + length]
+    return tables
+
+def _sfnt_metrics(data):
+    tables = _sfnt_tables(data)
+    head = tables['head']
+    scale = 1000.0 / struct.unpack('>H', head[18:20])[0]
+    bbox = [int(round(x * scale)) for x in struct.unpack('>4h', head[36:44])]
+    italic_angle, fixed = 0, False
+    if 'post' in tables:
+        italic_angle = struct.unpack('>i', tables['post'][4:8])[0] / 65536.0
+        fixed = struct.unpack('>I', tables['post'][12:16])[0] != 0
+    ascent, descent = bbox[3], bbox[1]
+    cap_height = ascent
+    if 'hhea' in tables:
+        a, d = struct.unpack('>2h', tables['hhea'][4:8])
+        ascent, descent = int(round(a * scale)), int(round(d * scale))
+    os2 = tables.get('OS/2', '')
+    if len(os2) >= 90 and struct.unpack('>H', os2[:2])[0] >= 2:
+        cap_height = int(round(struct.unpack('>h', os2[88:90])[0] * scale))
+    return bbox, italic_angle, fixed, ascent, descent, cap_height
+
+def _type1_metrics(clear):
+    m = re.search(r'/FontBBox\s*[\[{]([^\]}]*)[\]}]', clear)
+    bbox = [int(round(float(x))) for x in m.group(1).split()]
+    m = re.search(r'/ItalicAngle\s+([-+\d.]+)', clear)
+    italic_angle = m and float(m.group(1)) or 0
+    fixed = re.search(r'/isFixedPitch\s+true', clear) is not None
+    return bbox, italic_angle, fixed, bbox[3], bbox[1], bbox[3]
+
+def prepare_font(data):
+    """Make the PDF stream for the font program in <data>.  Returns a
+    dict of the stream's PDF details and metrics (for fonts that have
+    no descriptor), and the compressed program."""
+    kind = font_kind(data)
+    if kind in ('pfb', 'pfa'):
+        clear, encrypted, trailer = type1_parts(data, kind)
+        metrics = _type1_metrics(clear)
+        program = clear + encrypted + trailer
+        info = {'key': 'FontFile', 'Length1': len(clear), 'Length2': len(encrypted),
+                'Length3': len(trailer)}
+    elif kind == 'truetype':
+        metrics = _sfnt_metrics(data)
+        program = data
+        info = {'key': 'FontFile2', 'Length1': len(data)}
+    elif kind == 'opentype':
+        metrics = _sfnt_metrics(data)
+        program = data
+        info = {'key': 'FontFile3', 'Subtype': 'OpenType'}
+    else:
+        raise PDFError("unknown kind of font program")
+    info['kind'] = kind
+    info['metrics'] = metrics
+    return info, zlib.compress(program, 9)
+
+def font_program(path, name):
+    """The prepared program of the font file at <path> (see
+    prepare_font), from the cache if possible."""
+    key = sha1(repr((VERSION, name, path, file_stamp(path)))).hexdigest()
+    fn = os.path.join(config.FONT_CACHE_DIR, key + '.font')
+    try:
+        f = open(fn, 'rb')
+        info = dict((str(k), isinstance(v, unicode) and str(v) or v)
+                    for k, v in json.loads(f.readline()).iteritems())
+        program = f.read()
+        f.close()
+        note_cache('font_program', True)
+        return info, program
+    except (IOError, ValueError):
+        note_cache('font_program', False)
+    f = open(path, 'rb')
+    data = f.read()
+    f.close()
+    info, program = prepare_font(data)
+    log("prepared %s font %s from %s" % (info['kind'], name, path))
+    atomic_write(fn, json.dumps(info) + '\n' + program)
+    return info, program
+
+
+def used_fonts(reader):
+    """The object numbers of the fonts used on the pages (including in
+    forms and Type 3 glyphs)."""
+    fonts = set()
+    seen = set()
+    def look(resources):
+        resources = reader.resolve(resources)
+        if not isinstance(resources, dict) or id(resources) in seen:
+            return
+        seen.add(id(resources))
+        for k, ref in (reader.resolve(resources.get('Font')) or {}).iteritems():
+            if not isinstance(ref, Ref):
+                log("font %s is not an indirect object; leaving it be" % k)
+            elif ref.num not in fonts:
+                fonts.add(ref.num)
+                font = reader.resolve(ref)
+                if isinstance(font, dict):
+                    look(font.get('Resources'))
+        for category in ('XObject', 'Pattern'):
+            for x in (reader.resolve(resources.get(category)) or {}).itervalues():
+                x = reader.resolve(x)
+                if isinstance(x, Stream):
+                    look(x.dict.get('Resources'))
+    for page in reader.pages():
+        look(page.get('Resources'))
+    return fonts
+
+def _descriptor(name, info):
+    bbox, italic_angle, fixed, ascent, descent, cap_height = info['metrics']
+    flags = ((fixed and FIXED_PITCH) |
+             (name.startswith('Times') and SERIF) |
+             (name in ('Symbol', 'ZapfDingbats') and SYMBOLIC or NONSYMBOLIC) |
+             (italic_angle and ITALIC))
+    return {'Type': Name('FontDescriptor'), 'FontName': Name(name), 'Flags': flags,
+            'FontBBox': bbox, 'ItalicAngle': italic_angle, 'Ascent': ascent,
+            'Descent': descent, 'CapHeight': cap_height, 'StemV': 80}
+
+def embed_fonts(pdf_file):
+    """Add the programs of the fonts that <pdf_file> uses but lacks,
+    changing the file in place.  Returns the names of the fonts that
+    are still missing."""
+    reader = PDFReader(pdf_file)
+    if reader.startxref is None:
+        raise PDFError("%s has no usable cross references" % pdf_file)
+    objects = {}
+    programs = {}
+    missing = []
+    next_num = [max([reader.trailer.get('Size', 0)] + [x + 1 for x in reader.xref])]
+    def new_object(obj):
+        num = next_num[0]
+        next_num[0] += 1
+        objects[num] = obj
+        return num
+
+    for num in sorted(used_fonts(reader)):
+        font = reader.get(num)
+        #the font with the descriptor, and the object it is written in
+        owner = num
+        if font.get('Subtype') == 'Type0':
+            descendant = reader.resolve(font['DescendantFonts'])[0]
+            if isinstance(descendant, Ref):
+                owner = descendant.num
+            font = reader.resolve(descendant)
+        subtype = font.get('Subtype')
+        if subtype not in ACCEPTED_PROGRAMS:
+            continue
+        descriptor = font.get('FontDescriptor')
+        name = re.sub(r'^[A-Z]{6}\+', '', reader.resolve(font.get('BaseFont', '')))
+        if descriptor is None:
+            if name not in STANDARD_FONTS:
+                missing.append(name)
+                continue
+        else:
+            if isinstance(descriptor, Ref):
+                owner = descriptor.num
+            descriptor = reader.resolve(descriptor)
+            if [k for k in FONT_FILE_KEYS if k in descriptor]:
+                continue
+
+        for candidate in (name,) + STANDARD_FONTS.get(name, ()):
+            path = find_font(candidate)
+            if path is not None:
+                break
+        else:
+            log("can't find font %s" % name, level=WARNING)
+            missing.append(name)
+            continue
+        if path not in programs:
+            programs[path] = font_program(path, candidate) + (None,)
+        info, program, program_num = programs[path]
+        if info['kind'] not in ACCEPTED_PROGRAMS[subtype]:
+            log("%s is a %s font, but %s is %s" % (name, subtype, path, info['kind']),
+                level=WARNING)
+            missing.append(name)
+            continue
+        if program_num is None:
+            d = {'Filter': Name('FlateDecode')}
+            d.update((k, v) for k, v in info.iteritems() if k.startswith('Length'))
+            if 'Subtype' in info:
+                d['Subtype'] = Name(info['Subtype'])
+            program_num = new_object(Stream(d, program))
+            programs[path] = info, program, program_num
+        log("embedding %s from %s" % (name, path))
+        if descriptor is None:
+            descriptor = _descriptor(name, info)
+            descriptor[info['key']] = Ref(program_num)
+            font['FontDescriptor'] = Ref(new_object(descriptor))
+        else:
+            descriptor[info['key']] = Ref(program_num)
+        objects[owner] = reader.get(owner)
+
+    if objects:
+        append_objects(pdf_file, reader, objects)
+    else:
+        log("%s has no fonts to embed" % pdf_file)
+    return missing
@@ -13,7 +13,7 @@ except ImportError:
 import lxml.html, lxml.cssselect
 from lxml import etree
 
-from objavi.xhtml_utils import split_tree, utf8_html_parser
+from objavi.xhtml_utils import split_tree, utf8_html_parser, Section
 from objavi.book_utils import log
 from objavi.config import MARKER_CLASS_INFO, MARKER_CLASS_SPLIT
 from objavi.constants import DC, XHTML, XHTMLNS, FM
@@ -105,6 +105,24 @@ class Epub(object):
         self.info = self.zip.infolist()
         self.origin = src
 
+    def load_file(self, fn):
+        """Load the epub from a file, which is read as needed rather
+        than all at once.  As in load(), anything after the end of the
+        zip is cut off (here by truncating the file)."""
+        f = open(fn, 'r+b')
+        f.seek(0, 2)
+        size = f.tell()
+        #the end record is 22 bytes plus a comment of up to 64k
+        tail_start = max(size - 65536 - 22, 0)
+        f.seek(tail_start)
+        tail = f.read()
+        zipend = tail.rfind('PK\x05\x06')
+        if zipend >= 0 and zipend + 22 != len(tail):
+            log('Bad zipfile?')
+            f.truncate(tail_start + zipend + 22)
+        f.seek(0)
+        self.load(f)
+
     def register_source_id(self, src_id):
         self.source_id = src_id
 
@@ -166,20 +184,7 @@ class Epub(object):
         # done early to detect clashes (e.g. '/images/hello.jpg' and
         # '/images/big/hello.jpg' would both reduce to
         # 'static/hello.jpg').
-        self.media_map = {}
-        for k, v in self.manifest.items():
-            fn, mimetype = v
-            if isinstance(fn, unicode):
-                log('Stupid unicode: %r' % fn)
-
-            if mimetype not in MARKUP_TYPES:
-                oldfn = fn
-                if '/' in fn:
-                    fn = fn.rsplit('/', 1)[1]
-                while fn in self.media_map.values():
-                    fn = '_' + fn
-                newfn = 'static/%s' % fn
-                self.media_map[oldfn] = newfn
+        self.media_map = make_media_map(self.manifest)
 
         ncxid, self.spine = parse_spine(spine)
         self.ncxfile = self.manifest[ncxid][0]
@@ -247,51 +252,103 @@ class Epub(object):
         indicating where the splits should be.
         """
         lang = self.find_language()
-        points = self.ncxdata['navmap']['points']
-        pwd = os.path.dirname(self.ncxfile)
-        serial_points, chapter_markers = get_chapter_breaks(points, pwd)
+        chapter_markers = self._chapter_markers()
         doc = new_doc(lang=lang)
         #log(chapter_markers)
         for ID in self.spine:
-            fn, mimetype = self.manifest[ID]
-            if mimetype.startswith('image'):
-                root = lxml.html.Element('html')
-                body = etree.SubElement(root, 'body')
-                first_el = etree.SubElement(body, 'img', src=self.media_map.get(fn, fn), alt='')
-            else:
-                tree = self.gettree(fn, parse=_html_parse)
-                root = tree.getroot()
-                body = _find_tag(root, 'body')
-                if not len(body) and ADD_INFO_MARKERS:
-                    add_marker(body, 'espri-empty-file-%s' % ID, title=fn, child=True)
-                first_el = body[0]
-            #point the links to the new names. XXX probably fragile
-            root.rewrite_links(lambda x: self.media_map.get(os.path.join(self.opfdir, x), x))
-
-            for depth, fragment, point in chapter_markers.get(fn, ()):
-                if fragment:
-                    start = root.xpath("//*[@id='%s']" % fragment)[0]
-                else:
-                    start = first_el
-                labels = point['labels']
-                add_marker(start, '%(id)s' % point,
-                           klass=MARKER_CLASS_SPLIT,
-                           title=find_good_label(labels, lang) or 'untitled',
-                           subsections=str(bool(point['points'])))
-
-            if ADD_INFO_MARKERS:
-                add_marker(first_el, 'espri-new-file-%s' % ID, title=fn)
-            add_guts(root, doc)
+            add_guts(self._marked_spine_item(ID, lang, chapter_markers), doc)
         return doc
 
-
-    def make_bookizip(self, zfn):
-        """Split up the document and construct a booki-toc for it."""
-        doc = self.concat_document()
+    def _chapter_markers(self):
+        points = self.ncxdata['navmap']['points']
+        pwd = os.path.dirname(self.ncxfile)
+        serial_points, chapter_markers = get_chapter_breaks(points, pwd)
+        return chapter_markers
+
+    def _marked_spine_item(self, ID, lang, chapter_markers):
+        """Get the root of the spine item's html, with links pointing
+        to the new media names and markers where chapters begin."""
+        fn, mimetype = self.manifest[ID]
+        if mimetype.startswith('image'):
+            root = lxml.html.Element('html')
+            body = etree.SubElement(root, 'body')
+            first_el = etree.SubElement(body, 'img', src=self.media_map.get(fn, fn), alt='')
+        else:
+            tree = self.gettree(fn, parse=_html_parse)
+            root = tree.getroot()
+            body = _find_tag(root, 'body')
+            if not len(body) and ADD_INFO_MARKERS:
+                add_marker(body, 'espri-empty-file-%s' % ID, title=fn, child=True)
+            first_el = body[0]
+        #point the links to the new names. XXX probably fragile
+        root.rewrite_links(lambda x: self.media_map.get(os.path.join(self.opfdir, x), x))
+
+        for depth, fragment, point in chapter_markers.get(fn, ()):
+            if fragment:
+                start = root.xpath("//*[@id='%s']" % fragment)[0]
+            else:
+                start = first_el
+            labels = point['labels']
+            add_marker(start, '%(id)s' % point,
+                       klass=MARKER_CLASS_SPLIT,
+                       title=find_good_label(labels, lang) or 'untitled',
+                       subsections=str(bool(point['points'])))
+
+        if ADD_INFO_MARKERS:
+            add_marker(first_el, 'espri-new-file-%s' % ID, title=fn)
+        return root
+
+    def iter_chapters(self):
+        """Yield the non-empty chapters as Sections, like
+        drop_empty_chapters(split_tree(self.concat_document())), but
+        splitting one spine item at a time and yielding each chapter
+        as soon as it is complete, so the whole book is never in
+        memory at once."""
+        lang = self.find_language()
+        chapter_markers = self._chapter_markers()
+
+        def new_chapter(ID, title, head=False):
+            root = new_doc(lang=lang).getroot()
+            if not head:
+                #only the front matter gets the concatenated document's head
+                root.remove(_find_tag(root, 'head'))
+            return Section(root, ID, title)
+
+        #In the concatenated document the body tails all end up in
+        #the last chapter, so they are collected and put there.
+        body_tails = []
+        chapter = new_chapter('unidentified-front-matter', None, head=True)
+        for ID in self.spine:
+            root = self._marked_spine_item(ID, lang, chapter_markers)
+            body = _find_tag(root, 'body')
+            body_tails.append(body.tail or '')
+            body.tail = None
+            sections = split_tree(root)
+            #the first section continues the chapter from the last file
+            add_guts(sections[0].tree, chapter.tree)
+            for section in sections[1:]:
+                if drop_empty_chapters([chapter]):
+                    yield chapter
+                chapter = new_chapter(section.ID, section.title)
+                add_guts(section.tree, chapter.tree)
+        _find_tag(chapter.tree, 'body').tail = ''.join(body_tails) or None
+        if drop_empty_chapters([chapter]):
+            yield chapter
+
+
+    def make_bookizip(self, zfn, streaming=False):
+        """Split up the document and construct a booki-toc for it.  If
+        streaming is true, the chapters are made and written one spine
+        item at a time (see iter_chapters), which uses much less
+        memory for large books."""
+        if streaming:
+            real_chapters = self.iter_chapters()
+        else:
+            doc = self.concat_document()
+            chapters = split_tree(doc) #destroys doc.
+            real_chapters = drop_empty_chapters(chapters)
         bz = BookiZip(zfn)
 
-        chapters = split_tree(doc) #destroys doc.
-        real_chapters = drop_empty_chapters(chapters)
         rightsholders = [c for c, extra in self.metadata[DC].get('creator', ())]
         contributors = rightsholders + [c for c, extra in self.metadata[DC].get('contributor', ())]
         primary_id = self.metadata[DC].get('identifier', [[None]])[0][0]
@@ -409,6 +466,41 @@ class Epub(object):
         bz.finish()
 
 
+def make_media_map(manifest):
+    """Map the manifest's non-markup files to flat 'static/' names.
+    Clashing names get a numbered suffix ('static/hello_1.jpg'),
+    given in manifest id order so the result is repeatable."""
+    media_map = {}
+    used = set()
+    counts = {}
+    for k, v in sorted(manifest.items()):
+        fn, mimetype = v
+        if isinstance(fn, unicode):
+            log('Stupid unicode: %r' % fn)
+
+        if mimetype not in MARKUP_TYPES:
+            oldfn = fn
+            if oldfn in media_map:
+                #two manifest items for one file
+                continue
+            if '/' in fn:
+                fn = fn.rsplit('/', 1)[1]
+            #start counting after the suffixes already given to this name
+            n = counts.get(fn, 0)
+            newfn = fn
+            if n or newfn in used:
+                base, ext = os.path.splitext(fn)
+                n = max(n, 1)
+                newfn = '%s_%d%s' % (base, n, ext)
+                while newfn in used:
+                    n += 1
+                    newfn = '%s_%d%s' % (base, n, ext)
+            counts[fn] = n + 1
+            used.add(newfn)
+            media_map[oldfn] = 'static/%s' % newfn
+    return media_map
+
+
 def find_good_label(labels, lang=None):
     """Try to find a suitable label from a dictionary mapping
     languages to labels, resorting to a random label if need be."""
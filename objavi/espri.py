@@ -0,0 +1,168 @@
+# Part of the Objavi2 package.  This module imports e-books into Booki
+#
+# Copyright (C) 2009 Douglas Bagnall
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Turn epubs from various sources into bookizips (used by espri.cgi
+and bin/espri-batch).
+
+Each source has a 'locate' function, which finds (or makes) the epub
+and returns its url along with a book id and a source id.  The epub is
+then fetched to a temporary file (fetch_epub) and converted
+(epub_to_bookizip).  These steps are separate so that a batch import
+can do the network and CPU bound parts in different pools."""
+
+import os
+import time
+import shutil
+import tempfile
+from hashlib import sha1
+from urllib2 import urlopen
+from urllib import unquote
+from urlparse import urlsplit
+from subprocess import check_call, CalledProcessError
+
+from objavi import epub
+from objavi.book_utils import log
+from objavi.cgi_utils import super_bleach, path2url
+from objavi import config
+
+IA_EPUB_URL = "http://www.archive.org/download/%s/%s.epub"
+ESPRI_DOWNLOAD_CHUNK = 256 * 1024
+
+TIMEOUT_CMD = 'timeout'
+WIKIBOOKS_TIMEOUT = '600'
+WIKIBOOKS_CMD = 'wikibooks2epub'
+WIKIBOOKS_CACHE = 'cache/wikibooks'
+
+class TimeoutError(Exception):
+    pass
+
+
+def fetch_epub(epuburl, bookid):
+    """Save the epub at <epuburl> in a temporary file, without holding
+    it all in memory, and return the file name."""
+    f = urlopen(epuburl)
+    fd, epubfile = tempfile.mkstemp(prefix=bookid, suffix='.epub', dir=config.TMPDIR)
+    out = os.fdopen(fd, 'wb')
+    try:
+        shutil.copyfileobj(f, out, ESPRI_DOWNLOAD_CHUNK)
+    finally:
+        out.close()
+        f.close()
+    return epubfile
+
+def epub_to_bookizip(epubfile, bookid, src_id=None):
+    """Make a bookizip from the epub file and save it as <bookid>.zip.
+    The bookizip is made a chapter at a time, so that big books don't
+    need to fit in memory."""
+    e = epub.Epub()
+    e.load_file(epubfile)
+    if src_id is not None:
+        #so that booki knows where the book came from, so e.g. archive.org can find it again
+        e.register_source_id(src_id)
+    e.parse_meta()
+    e.parse_opf()
+    e.parse_ncx()
+    zipfile = '%s/%s.zip' % (config.BOOKI_BOOK_DIR, bookid)
+    e.make_bookizip(zipfile, streaming=True)
+    return '%s.zip' % bookid
+
+def espri(epuburl, bookid, src_id=None):
+    """Make a bookizip from the epub at <epuburl> and save it as
+    <bookid>.zip."""
+    log("starting espri", epuburl, bookid)
+    epubfile = fetch_epub(epuburl, bookid)
+    try:
+        return epub_to_bookizip(epubfile, bookid, src_id)
+    finally:
+        os.unlink(epubfile)
+
+
+def ia_locate(bookid):
+    """Find an Internet Archive epub given an archive id"""
+    epuburl = IA_EPUB_URL % (bookid, bookid)
+    log(epuburl)
+    return epuburl, bookid, 'archive.org'
+
+def _url_tag(url):
+    """A short tag for <url>, so that books with the same name from
+    different places, fetched in the same second, get different ids."""
+    return sha1(url).hexdigest()[:8]
+
+def inet_locate(epuburl):
+    """An epub at an arbitrary url"""
+    tainted_name = unquote(os.path.basename(urlsplit(epuburl).path))
+    filename = super_bleach(tainted_name)
+    if filename.lower().endswith('-epub'):
+        filename = filename[:-5]
+    bookid = '%s-%s-%s' % (filename, time.strftime('%F_%T'), _url_tag(epuburl))
+    return epuburl, bookid, 'URI'
+
+def wikibooks_locate(wiki_url):
+    """Wikibooks import using the wikibooks2epub script by Jan Gerber
+    to first convert the wikibook to an epub, which can then be turned
+    into a bookizip via the espri function.
+    """
+    #the environment is the importer's own, as batch imports locate
+    #books in several threads at once.
+    env = dict(os.environ, oxCACHE=os.path.abspath(WIKIBOOKS_CACHE), LANG='en_NZ.UTF-8')
+    tainted_name = unquote(os.path.basename(urlsplit(wiki_url).path))
+    bookid = "%s-%s-%s" % (super_bleach(tainted_name),
+                           time.strftime('%Y.%m.%d-%H.%M.%S'), _url_tag(wiki_url))
+    workdir = tempfile.mkdtemp(prefix=bookid, dir=config.TMPDIR)
+    os.chmod(workdir, 0755)
+    epub_file = os.path.join(workdir, bookid + '.epub')
+    epub_url = path2url(epub_file, full=True)
+
+    #the wikibooks importer is a separate process, so run that, then collect the epub.
+    cmd = [TIMEOUT_CMD, WIKIBOOKS_TIMEOUT,
+           WIKIBOOKS_CMD,
+           '-i', wiki_url,
+           '-o', epub_file
+           ]
+    log(cmd)
+    log(env)
+    log(os.getcwd())
+
+    try:
+        check_call(cmd, env=env)
+    except CalledProcessError, e:
+        if e.returncode == 137:
+            raise TimeoutError('Wikibooks took too long (over %s seconds)' % WIKIBOOKS_TIMEOUT)
+        raise
+
+    return epub_url, bookid, 'wikibooks'
+
+
+def ia_espri(bookid):
+    """Import an Internet Archive epub given an archive id"""
+    return espri(*ia_locate(bookid))
+
+def inet_espri(epuburl):
+    """Import an epub from an arbitrary url"""
+    return espri(*inet_locate(epuburl))
+
+def wikibooks_espri(wiki_url):
+    """Import a wikibook, via wikibooks2epub"""
+    return espri(*wikibooks_locate(wiki_url))
+
+
+SOURCES = {
+    'archive.org': {'function': ia_espri, 'locate': ia_locate},
+    'url': {'function': inet_espri, 'locate': inet_locate},
+    'wikibooks': {'function': wikibooks_espri, 'locate': wikibooks_locate},
+}
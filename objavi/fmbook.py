@@ -19,9 +19,14 @@
 
 """Library module representing a complete FM book being turned into a
 PDF"""
+from __future__ import with_statement
 
 import os, sys
 import tempfile
+import shutil
+import gzip, tarfile
+import threading
+from multiprocessing.pool import ThreadPool
 import re, time
 import random
 import copy
@@ -45,19 +50,31 @@ from lxml import etree
 from objavi import config, epub_utils
 from objavi.book_utils import log, run, make_book_name, guess_lang, guess_text_dir, url_fetch, url_fetch2
 from objavi.book_utils import ObjaviError, log_types, guess_page_number_style, get_number_localiser
+from objavi.book_utils import note_cache, read_template, ensure_dir, DEBUG, WARNING, ERROR
 from objavi.pdf import PageSettings, count_pdf_pages, concat_pdfs, rotate_pdf
 from objavi.pdf import parse_outline, parse_extracted_outline, embed_all_fonts
 from objavi.epub import add_guts, _find_tag
 from objavi.xhtml_utils import EpubChapter, split_tree, empty_html_tree
-from objavi.xhtml_utils import utf8_html_parser, localise_local_links
+from objavi.xhtml_utils import utf8_html_parser, add_local_link_handlers, TreeTransform
+from objavi.xhtml_utils import ChapterCache, normalise_newlines
 from objavi.cgi_utils import url2path, path2url, try_to_kill
 from objavi.constants import DC, DCNS, FM
 
 from booki.bookizip import get_metadata, add_metadata
 
 TMPDIR = os.path.abspath(config.TMPDIR)
-DOC_ROOT = os.environ.get('DOCUMENT_ROOT', config.HTDOCS)
-HTTP_HOST = os.environ.get('HTTP_HOST', '')
+
+#X display numbers chosen by books in this process but perhaps not
+#yet locked by their Xvfb.
+_x_displays = set()
+_x_displays_lock = threading.Lock()
+
+#The order in which the structural changes of the preparation steps
+#are made, after the shared traversal (see Book.apply_transforms).
+TRANSFORM_ORDER_LOCAL_LINKS = 0
+TRANSFORM_ORDER_HEADINGS = 10
+TRANSFORM_ORDER_NO_BREAK = 20
+TRANSFORM_ORDER_SECTIONS = 30
 
 def find_archive_urls(bookid, bookname):
     s3url = 'http://s3.us.archive.org/booki-%s/%s' % (bookid, bookname)
@@ -138,6 +155,50 @@ def filename_toc_map(rtoc):
     traverse(rtoc)
     return tocmap
 
+class PageTemplate(object):
+    """A templated html page compiled into fixed string segments with
+    slots for the page content and title.  Filling it gives the same
+    bytes as replacing the placeholders in a copy of the template
+    tree and serialising that, without copying or searching the
+    template for every page."""
+    def __init__(self, template_tree, dir, cookie):
+        content_comment = 'objavi-content-%s' % cookie
+        self.content_marker = '<!--%s-->' % content_comment
+        self.title_marker = 'objavi-title-%s' % cookie
+        tree = copy.deepcopy(template_tree)
+        tree.set('dir', dir)
+        for e in tree.iterdescendants(config.TEMPLATING_REPLACED_ELEMENT):
+            e.getparent().replace(e, etree.Comment(content_comment))
+        for e in tree.iterdescendants('title'):
+            e.text = self.title_marker
+        html = lxml.html.tostring(tree, encoding="UTF-8")
+        self.parts = re.split('(%s|%s)' % (self.content_marker, self.title_marker), html)
+
+    def fill(self, content, title):
+        """Put the content element (which becomes <div
+        id="TEMPLATING_CONTENTS_ID">) and title into the page, and
+        return the html string."""
+        if not isinstance(title, unicode):
+            title = title.decode('utf-8')
+        content.set('id', config.TEMPLATING_CONTENTS_ID)
+        content.tag = 'div'
+        if content.find('.//title') is not None:
+            #titles in the content get the page title too
+            content = copy.deepcopy(content)
+            for e in content.iterdescendants('title'):
+                e.text = title
+        e = etree.Element('title')
+        e.text = title
+        slots = {
+            self.content_marker: lxml.html.tostring(content, encoding="UTF-8"),
+            self.title_marker: lxml.html.tostring(e, encoding="UTF-8")[7:-8],
+        }
+        parts = self.parts[:]
+        for i in range(1, len(parts), 2):
+            parts[i] = slots[parts[i]]
+        return ''.join(parts)
+
+
 def save_data(fn, data):
     """Save without tripping up on unicode"""
     if isinstance(data, unicode):
@@ -146,6 +207,15 @@ def save_data(fn, data):
     f.write(data)
     f.close()
 
+def save_gzipped(fn, data):
+    """Save a compressed copy of the data as <fn>.gz, which web
+    servers can send instead of compressing <fn> for every request."""
+    if isinstance(data, unicode):
+        data = data.encode('utf8', 'ignore')
+    f = gzip.open(fn + '.gz', 'wb')
+    f.write(data)
+    f.close()
+
 
 class Book(object):
     def notify_watcher(self, message=None):
@@ -169,8 +239,15 @@ class Book(object):
     def __init__(self, book, server, bookname,
                  page_settings=None, watchers=None, isbn=None,
                  license=config.DEFAULT_LICENSE, title=None,
-                 max_age=0, page_number_style=None):
+                 max_age=0, page_number_style=None, http_host=None):
         log("*** Starting new book %s ***" % bookname)
+        #Everything particular to this book is kept here rather than
+        #in the process (environment, current directory), so that
+        #several books can be made at once in threads.
+        if http_host is None:
+            http_host = os.environ.get('HTTP_HOST', '')
+        self.http_host = http_host
+        self.env = dict(os.environ)
         self.watchers = set()
         if watchers is not None:
             self.watchers.update(watchers)
@@ -179,10 +256,16 @@ class Book(object):
         self.book = book
         self.server = server
         self.cookie = ''.join(random.sample(ascii_letters, 10))
+        if config.USE_CHAPTER_CACHE:
+            self.chapter_cache = ChapterCache()
+        else:
+            self.chapter_cache = None
         try:
-            blob, self.bookizip_file = fetch_zip(server, book, save=True, max_age=max_age)
+            blob, self.bookizip_file = fetch_zip(server, book, save=True, max_age=max_age,
+                                                 http_host=http_host)
         except HTTPError, e:
             traceback.print_exc()
+            log("couldn't get %r: %s %s" % (e.url, e.code, e.msg), level=ERROR)
             self.notify_watcher("ERROR:\n Couldn't get %r\n %s %s" % (e.url, e.code, e.msg))
             #not much to do?
             #raise 502 Bad Gateway ?
@@ -201,7 +284,7 @@ class Book(object):
         self.spine = self.info['spine']
         self.manifest = self.info['manifest']
 
-        log(pformat(self.metadata))
+        log(lambda: pformat(self.metadata), level=DEBUG)
         self.lang = get_metadata(self.metadata, 'language', default=[None])[0]
         if not self.lang:
             self.lang = guess_lang(server, book)
@@ -243,25 +326,12 @@ class Book(object):
         self.toc = self.info['TOC']
         expand_toc(self.toc)
 
-        self.workdir = tempfile.mkdtemp(prefix=bookname, dir=TMPDIR)
-        os.chmod(self.workdir, 0755)
-
-        self.body_html_file = self.filepath('body.html')
-        self.body_pdf_file = self.filepath('body.pdf')
-        self.preamble_html_file = self.filepath('preamble.html')
-        self.preamble_pdf_file = self.filepath('preamble.pdf')
-        self.tail_html_file = self.filepath('tail.html')
-        self.tail_pdf_file = self.filepath('tail.pdf')
-        self.isbn_pdf_file = None
-        self.pdf_file = self.filepath('final.pdf')
-        self.body_odt_file = self.filepath('body.odt')
-        self.outline_file = self.filepath('outline.txt')
-        self.cover_pdf_file = self.filepath('cover.pdf')
-        self.epub_cover = None
-        self.publish_file = os.path.abspath(os.path.join(config.PUBLISH_DIR, bookname))
+        workdir = tempfile.mkdtemp(prefix=bookname, dir=TMPDIR)
+        os.chmod(workdir, 0755)
+        self._set_paths(workdir)
 
         if page_settings is not None:
-            self.maker = PageSettings(self.workdir, **page_settings)
+            self.maker = PageSettings(self.workdir, env=self.env, **page_settings)
 
         if title is not None:
             self.title = title
@@ -295,13 +365,12 @@ class Book(object):
             if s == '':
                 log('html ID %r is empty! Not parsing' % (id,))
                 tree = empty_html_tree()
+            elif self.chapter_cache is not None:
+                tree = self.chapter_cache.get(s, 'html',
+                                              lambda: self._parse_html(f, id, name))
+                tree = tree.getroottree()
             else:
-                try:
-                    tree = lxml.html.parse(f, parser=utf8_html_parser)
-                except etree.XMLSyntaxError, e:
-                    log('Could not parse html ID %r, filename %r, string %r... exception %s' %
-                        (id, name, s[:20], e))
-                    tree = empty_html_tree()
+                tree = self._parse_html(f, id, name)
         elif 'xml' in mimetype: #XXX or is this just asking for trouble?
             tree = etree.parse(f)
         else:
@@ -309,6 +378,51 @@ class Book(object):
         f.close()
         return tree
 
+    def _parse_html(self, f, id, name):
+        try:
+            tree = lxml.html.parse(f, parser=utf8_html_parser)
+            #as the chapter cache would give it
+            normalise_newlines(tree.getroot())
+            return tree
+        except etree.XMLSyntaxError, e:
+            log('Could not parse html ID %r, filename %r, string %r... exception %s' %
+                (id, name, f.getvalue()[:20], e), level=ERROR)
+            return empty_html_tree()
+
+    def _set_paths(self, workdir):
+        """Set the working directory and the names of the files made
+        in it and published from it."""
+        self.workdir = workdir
+        self.body_html_file = self.filepath('body.html')
+        self.body_pdf_file = self.filepath('body.pdf')
+        self.preamble_html_file = self.filepath('preamble.html')
+        self.preamble_pdf_file = self.filepath('preamble.pdf')
+        self.tail_html_file = self.filepath('tail.html')
+        self.tail_pdf_file = self.filepath('tail.pdf')
+        self.isbn_pdf_file = None
+        self.pdf_file = self.filepath('final.pdf')
+        self.body_odt_file = self.filepath('body.odt')
+        self.outline_file = self.filepath('outline.txt')
+        self.cover_pdf_file = self.filepath('cover.pdf')
+        self.epub_cover = None
+        self.publish_file = os.path.abspath(os.path.join(config.PUBLISH_DIR, self.bookname))
+
+    def start_output(self, bookname, page_settings=None):
+        """Prepare to make another output from the already fetched
+        (and perhaps loaded) book.  It gets its own subdirectory of the
+        workdir, and will be published as <bookname>.  Because making
+        an output alters the book, each one should be made in its own
+        process (see the multi mode of objavi.cgi)."""
+        subdir = self.filepath(bookname)
+        os.mkdir(subdir)
+        static = self.filepath('static')
+        if os.path.exists(static):
+            os.symlink(static, os.path.join(subdir, 'static'))
+        self.bookname = bookname
+        self._set_paths(subdir)
+        if page_settings is not None:
+            self.maker = PageSettings(self.workdir, env=self.env, **page_settings)
+
     def filepath(self, fn):
         return os.path.join(self.workdir, fn)
 
@@ -320,11 +434,15 @@ class Book(object):
         return fn
 
     def make_oo_doc(self):
-        """Make an openoffice document, using the html2odt script."""
+        """Make an openoffice document, using the html2odt script.  If
+        the html2odt server is running, its pool of soffice instances
+        does the conversion; otherwise a new soffice is started."""
+        self.apply_transforms()
         self.wait_for_xvfb()
         html_text = etree.tostring(self.tree, method="html", encoding="UTF-8")
         save_data(self.body_html_file, html_text)
-        run([config.HTML2ODT, self.workdir, self.body_html_file, self.body_odt_file])
+        run([config.HTML2ODT, '--socket=' + config.HTML2ODT_SOCKET,
+             self.workdir, self.body_html_file, self.body_odt_file], env=self.env)
         log("Publishing %r as %r" % (self.body_odt_file, self.publish_file))
         os.rename(self.body_odt_file, self.publish_file)
         self.notify_watcher()
@@ -372,7 +490,7 @@ class Book(object):
                     if tag == 'h1':
                         e = lxml.etree.SubElement(e, "strong", Class="initial")
                     e.text = key
-                    log("key: %r, text: %r, value: %r" %(key, e.text, titlemap[key]))
+                    log("key: %r, text: %r, value: %r" %(key, e.text, titlemap[key]), level=DEBUG)
 
             ascii_html_file = self.filepath('body-ascii-headings.html')
             ascii_pdf_file = self.filepath('body-ascii-headings.pdf')
@@ -392,7 +510,7 @@ class Book(object):
                 if ' ' in ascii_title:
                     ascii_title = ascii_title.rsplit(' ', 1)[1]
                 title = titlemap.get(ascii_title, '')
-                log((ascii_title, title, depth, pageno))
+                log((ascii_title, title, depth, pageno), level=DEBUG)
 
                 self.outline_contents.append((title, depth, pageno))
 
@@ -463,6 +581,7 @@ class Book(object):
 
     def make_book_pdf(self):
         """A convenient wrapper of a few necessary steps"""
+        self.apply_transforms()
         # now the Xvfb server is needed. make sure it has had long enough to get going
         self.wait_for_xvfb()
         self.make_body_pdf()
@@ -488,10 +607,40 @@ class Book(object):
     def make_templated_html(self, template=None, zip=False, index=config.TEMPLATING_INDEX_FIRST):
         """Make a templated html version of the book."""
         #set up the directory and static files
-        self.unpack_static()
+        static_files = self.unpack_static()
         destdir = self.filepath(os.path.basename(self.publish_file))
         os.mkdir(destdir)
-        os.rename(self.filepath('static'), os.path.join(destdir, 'static'))
+        if static_files:
+            os.rename(self.filepath('static'), os.path.join(destdir, 'static'))
+
+        #The tarball is written as the pages are made, rather than
+        #by rereading the finished directory.
+        tar = None
+        if config.TAR_TEMPLATED_HTML:
+            tarname = self.filepath('html.tar.gz')
+            tardir = os.path.basename(destdir)
+            tar = tarfile.open(tarname, 'w:gz')
+            tar_time = time.time()
+            def tar_add(name, data=None):
+                info = tarfile.TarInfo(os.path.join(tardir, name).rstrip('/'))
+                info.mtime = tar_time
+                if data is None:
+                    info.type = tarfile.DIRTYPE
+                    info.mode = 0755
+                    tar.addfile(info)
+                else:
+                    info.size = len(data)
+                    info.mode = 0644
+                    tar.addfile(info, StringIO(data))
+            tar_add('')
+            tar_add('static')
+            for name in static_files:
+                tar_add(name, self.store.read(name))
+
+        if config.PRECOMPRESS_TEMPLATED_HTML:
+            for name in static_files:
+                if name.endswith('.css'):
+                    save_gzipped(os.path.join(destdir, name), self.store.read(name))
 
         if not template:
             template_tree = lxml.html.parse(config.TEMPLATING_DEFAULT_TEMPLATE, parser=utf8_html_parser).getroot()
@@ -515,9 +664,11 @@ class Book(object):
         savename = first_name
         for ID in self.spine:
             filename = self.manifest[ID]['url']
-            #handle any TOC points in this file.
-            for point in tocmap[filename]:
-                if point['type'] == 'booki-section':
+            #handle any TOC points in this file.  Imported books
+            #can have files that aren't in the TOC, and TOC points
+            #without a type.
+            for point in tocmap.get(filename, ()):
+                if point.get('type') == 'booki-section':
                     etree.SubElement(contents, 'h2').text = point['title']
                     etree.SubElement(menu, 'li', Class='booki-section').text = point['title']
                 else:
@@ -543,32 +694,32 @@ class Book(object):
             for e in template_tree.iterdescendants(config.TEMPLATING_DOWNLOAD_LINK_ELEMENT):
                 e.getparent().replace(e, copy.deepcopy(download_link))
 
-        #function to template content and write to disk
-        def save_content(content, title, filename):
-            if not isinstance(title, unicode):
-                title = title.decode('utf-8')
-            content.set('id', config.TEMPLATING_CONTENTS_ID)
-            content.tag = 'div'
-            dest = copy.deepcopy(template_tree)
-            dest.set('dir', self.dir)
-            for e in dest.iterdescendants(config.TEMPLATING_REPLACED_ELEMENT):
-                #copy only if there are more than 2
-                if content.getparent() is not None:
-                    content = copy.deepcopy(content)
-                e.getparent().replace(e, content)
-
-            chaptertitle = etree.Element('div', Class=config.TEMPLATING_CHAPTER_TITLE_ELEMENT)
-            chaptertitle.text = title
-            for e in template_tree.iterdescendants(config.TEMPLATING_CHAPTER_TITLE_ELEMENT):
-                e.getparent().replace(e, copy.deepcopy(chaptertitle))
-            for e in dest.iterdescendants('title'):
-                #log(type(title), title)
-                e.text = title
-            self.save_tempfile(os.path.join(destdir, filename), lxml.html.tostring(dest, encoding="UTF-8"))
+        #The contents page is made before the chapter title is set
+        #in the template; every other page gets the contents page's
+        #title (i.e. the book title).
+        page = PageTemplate(template_tree, self.dir, self.cookie)
+        chaptertitle = etree.Element('div', Class=config.TEMPLATING_CHAPTER_TITLE_ELEMENT)
+        chaptertitle.text = self.title.decode('utf-8')
+        for e in template_tree.iterdescendants(config.TEMPLATING_CHAPTER_TITLE_ELEMENT):
+            e.getparent().replace(e, copy.deepcopy(chaptertitle))
+
+        #pages are filled here and written to disk by a pool of threads
+        pool = ThreadPool(config.TEMPLATING_WRITE_THREADS)
+        writes = []
+        def save_page(fn, html):
+            save_data(fn, html)
+            if config.PRECOMPRESS_TEMPLATED_HTML:
+                save_gzipped(fn, html)
 
+        def save_content(content, title, filename):
+            html = page.fill(content, title)
+            writes.append(pool.apply_async(save_page, (os.path.join(destdir, filename), html)))
+            if tar is not None:
+                tar_add(filename, html)
 
         #write the contents to a file. (either index.html or contents.html)
         save_content(contents, self.title, contents_name)
+        page = PageTemplate(template_tree, self.dir, self.cookie)
 
         savename = first_name
         #and now write each chapter to a file
@@ -578,12 +729,13 @@ class Book(object):
                 root = self.get_tree_by_id(ID).getroot()
                 body = root.find('body')
             except Exception, e:
-                log("hit %s when trying book.get_tree_by_id(%s).getroot().find('body')" % (e, ID))
+                log("hit %s when trying book.get_tree_by_id(%s).getroot().find('body')" % (e, ID),
+                    level=ERROR)
                 body = etree.Element('body')
 
             #handle any TOC points in this file.  There should only be one!
-            for point in tocmap[filename]:
-                if point['type'] != 'booki-section':
+            for point in tocmap.get(filename, ()):
+                if point.get('type') != 'booki-section':
                     title = point['title']
                     break
             else:
@@ -593,11 +745,12 @@ class Book(object):
                 savename = filename
             save_content(body, title, savename)
             savename = None
-        if config.TAR_TEMPLATED_HTML:
-            tarname = self.filepath('html.tar.gz')
-            workdir, tardir = os.path.split(destdir)
-            #workdir == self.workdir, and tardir <Book>-<date>.tar.gz
-            run(['tar', 'czf', tarname, '-C', workdir, tardir])
+        pool.close()
+        pool.join()
+        for w in writes:
+            w.get() #raises any exception from the write
+        if tar is not None:
+            tar.close()
             os.rename(tarname, self.publish_file + '.tar.gz')
         log(destdir, self.publish_file)
         os.rename(destdir, self.publish_file)
@@ -608,6 +761,7 @@ class Book(object):
         """Make a simple pdf document without contents or separate
         title page.  This is used for multicolumn newspapers and for
         web-destined pdfs."""
+        self.apply_transforms()
         self.wait_for_xvfb()
         #0. Add heading to begining of html
         body = list(self.tree.cssselect('body'))[0]
@@ -679,7 +833,8 @@ class Book(object):
 
     def concat_html(self):
         """Join all the chapters together into one tree.  Keep the TOC
-        up-to-date along the way."""
+        up-to-date along the way.  Each chapter's local links are
+        localised by the shared traversal (see load_book())."""
 
         #each manifest item looks like:
         #{'contributors': []
@@ -696,15 +851,16 @@ class Book(object):
 <body dir="%s" onload="prettyPrint()"></body>
 </html>""" % (self.dir, self.dir))
         tocmap = filename_toc_map(self.toc)
+        chapters = {}
         for ID in self.spine:
             details = self.manifest[ID]
             try:
                 root = self.get_tree_by_id(ID).getroot()
             except Exception, e:
-                log("hit %s when trying book.get_tree_by_id(%s).getroot()" % (e, ID))
+                log("hit %s when trying book.get_tree_by_id(%s).getroot()" % (e, ID), level=ERROR)
                 continue
             #handle any TOC points in this file
-            for point in tocmap[details['url']]:
+            for point in tocmap.get(details['url'], ()):
                 #if the url has a #identifier, use it. Otherwise, make
                 #one up, using a hidden element at the beginning of
                 #the inserted document.
@@ -739,52 +895,89 @@ class Book(object):
                                                   id=fragment)
                         body.insert(0, marker)
                 point['html_id'] = fragment
-            localise_local_links(root, ID[6:])
+            body = _find_tag(root, 'body')
+            if len(body):
+                chapters[body[0]] = ID[6:]
             add_guts(root, doc)
+        add_local_link_handlers(self.transform, chapters, TRANSFORM_ORDER_LOCAL_LINKS)
         return doc
 
     def fake_no_break_after(self, tags=config.NO_BREAK_AFTER_TAGS):
         """Workaround lack of page-break-after:avoid support by wrapping
-        headings and their following elements in divs."""
-        for tag in tags:
-            for e in self.tree.iter(tag):
-                follower = e.getnext()
-                #log(e, follower)
-                if follower is not None: #and in whitelist? e.g. ['p']
-                    wrapper = e.makeelement('div', Class='objavi-no-page-break')
-                    e.addprevious(wrapper)
-                    wrapper.append(e) #append() removes existing copy.
-                    wrapper.append(follower)
+        headings and their following elements in divs.
+
+        The headings are found by the shared traversal in
+        apply_transforms(), and wrapped after it."""
+        found = dict((tag, []) for tag in tags)
+        def collect(e):
+            found[e.tag].append(e)
+
+        def wrap():
+            for tag in tags:
+                for e in found[tag]:
+                    follower = e.getnext()
+                    #log(e, follower)
+                    if follower is not None: #and in whitelist? e.g. ['p']
+                        wrapper = e.makeelement('div', Class='objavi-no-page-break')
+                        e.addprevious(wrapper)
+                        wrapper.append(e) #append() removes existing copy.
+                        wrapper.append(follower)
+
+        self.transform.add_handler(tags, collect)
+        self.transform.add_finisher(wrap, TRANSFORM_ORDER_NO_BREAK)
 
     def unpack_static(self):
-        """Extract static files from the zip for the html to refer to."""
+        """Extract static files from the zip for the html to refer to,
+        and return their names."""
         static_files = [x['url'] for x in self.manifest.values()
                         if x['url'].startswith('static/')]
+        if os.path.islink(self.filepath('static')):
+            #shared with other outputs (see start_output); make a private copy.
+            os.unlink(self.filepath('static'))
         if static_files:
             os.mkdir(self.filepath('static'))
 
+        static_files = [x.encode('utf8') if isinstance(x, unicode) else x
+                        for x in static_files]
         for name in static_files:
-            if isinstance(name, unicode):
-                name = name.encode('utf8')
             s = self.store.read(name)
             f = open(self.filepath(name), 'w')
             f.write(s)
             f.close()
         self.notify_watcher()
+        return static_files
 
     def load_book(self):
-        """"""
+        """Concatenate the chapters into self.tree, and start a
+        TreeTransform so that this and the following preparation steps
+        can share a single traversal (see apply_transforms())."""
         #XXX concatenate the HTML to match how TWiki version worked.
         # This is perhaps foolishly early -- throwing away useful boundaries.
         self.unpack_static()
+        self.transform = TreeTransform()
         self.tree = self.concat_html()
-        self.save_tempfile('raw.html', etree.tostring(self.tree, method='html'))
-        self.headings = [x for x in self.tree.iter('h1')]
+        if config.DEBUG_ALL or 'HTMLDUMP' in config.DEBUG_MODES:
+            self.save_tempfile('raw.html', etree.tostring(self.tree, method='html'))
+
+        self.headings = []
+        self.transform.add_handler(('h1',), self.headings.append)
+        self.transform.add_finisher(self._mark_headings, TRANSFORM_ORDER_HEADINGS)
+        self.notify_watcher()
+
+    def _mark_headings(self):
         if self.headings:
             self.headings[0].set('class', "first-heading")
         for h1 in self.headings:
             h1.title = h1.text_content().strip()
-        self.notify_watcher()
+
+    def apply_transforms(self):
+        """Run the tree alterations requested by load_book(),
+        fake_no_break_after() and add_section_titles() in one pass.
+        This is called automatically before the tree is rendered."""
+        if self.transform.pending():
+            self.transform.apply(self.tree)
+            if config.DEBUG_ALL or 'HTMLDUMP' in config.DEBUG_MODES:
+                self.save_tempfile('transformed.html', etree.tostring(self.tree, method='html'))
 
     def make_contents(self):
         """Generate HTML containing the table of contents.  This can
@@ -836,40 +1029,58 @@ class Book(object):
         specifies.  These are sub-book, super-chapter groupings.
 
         Also add initial numbers to chapters.
+
+        The chapter and section anchors are found in the shared
+        traversal (see apply_transforms()), rather than searching the
+        tree for each one.
         """
-        chapter = 1
-        section_n = 1
-        #log(self.toc)
-        localiser = get_number_localiser(self.page_number_style)
+        wanted = set()
         for t in self.toc:
-            #only top level sections get a subsection page,
-            #and only if they have children.
             if t.get('children'):
-                ID = "section-%d" % section_n
-                section_n += 1
-                section = self.tree.makeelement('div', Class="objavi-subsection", id=ID)
-                heading = etree.SubElement(section, 'div', Class="objavi-subsection-heading")
-                heading.text = t['title']
-                for child in t['children']:
-                    item = etree.SubElement(section, 'div', Class="objavi-chapter")
-                    if 'html_title' in child:
-                        item.text = child['html_title']
-                        heading = self.tree.cssselect('#'+ child['html_id'])
-                        if heading:
-                            _add_initial_number(heading[0], chapter, localiser)
-                    else:
-                        item.text = child['title']
-                    _add_initial_number(item, chapter, localiser)
-                    log(item.text, debug='HTMLGEN')
-                    chapter += 1
-                log("#%s is %s" % (t['html_id'], self.tree.cssselect('#'+ t['html_id'])))
-                location = self.tree.cssselect('#'+ t['html_id'])[0]
-                container = location.getparent()
-                if container.tag == 'div' and container[0] is location:
-                    location = container
-                location.addprevious(section)
-
-
+                wanted.add(t['html_id'])
+                wanted.update(child['html_id'] for child in t['children']
+                              if 'html_title' in child)
+        anchors = {}
+        def collect(e):
+            ID = e.get('id')
+            if ID in wanted and ID not in anchors:
+                anchors[ID] = e
+
+        def insert_sections():
+            chapter = 1
+            section_n = 1
+            #log(self.toc)
+            localiser = get_number_localiser(self.page_number_style)
+            for t in self.toc:
+                #only top level sections get a subsection page,
+                #and only if they have children.
+                if t.get('children'):
+                    ID = "section-%d" % section_n
+                    section_n += 1
+                    section = self.tree.makeelement('div', Class="objavi-subsection", id=ID)
+                    heading = etree.SubElement(section, 'div', Class="objavi-subsection-heading")
+                    heading.text = t['title']
+                    for child in t['children']:
+                        item = etree.SubElement(section, 'div', Class="objavi-chapter")
+                        if 'html_title' in child:
+                            item.text = child['html_title']
+                            heading = anchors.get(child['html_id'])
+                            if heading is not None:
+                                _add_initial_number(heading, chapter, localiser)
+                        else:
+                            item.text = child['title']
+                        _add_initial_number(item, chapter, localiser)
+                        log(item.text, debug='HTMLGEN')
+                        chapter += 1
+                    location = anchors[t['html_id']]
+                    log("#%s is %s" % (t['html_id'], location))
+                    container = location.getparent()
+                    if container.tag == 'div' and container[0] is location:
+                        location = container
+                    location.addprevious(section)
+
+        self.transform.add_handler(None, collect)
+        self.transform.add_finisher(insert_sections, TRANSFORM_ORDER_SECTIONS)
         self.notify_watcher()
 
 
@@ -914,16 +1125,13 @@ class Book(object):
     def _read_localised_template(self, template, fallbacks=['en']):
         """Try to get the template in the approriate language, otherwise in english."""
         for lang in [self.lang] + fallbacks:
+            fn = template % (lang)
             try:
-                fn = template % (lang)
-                f = open(fn)
-                break
+                return read_template(fn)
             except IOError, e:
-                log("couldn't open inside front cover for lang %s (filename %s)" % (lang, fn))
-                log(e)
-        template = f.read()
-        f.close()
-        return template
+                log("couldn't open inside front cover for lang %s (filename %s)" % (lang, fn),
+                    e, level=WARNING)
+        raise e
 
     def compose_inside_cover(self):
         """create the markup for the preamble inside cover."""
@@ -1004,7 +1212,8 @@ class Book(object):
             if mediatype == 'text/html':
                 #convert to application/xhtml+xml, and perhaps split
                 c = EpubChapter(self.server, self.book, ID, content,
-                                use_cache=use_cache)
+                                use_cache=use_cache,
+                                chapter_cache=self.chapter_cache)
                 c.remove_bad_tags()
 
                 if css:
@@ -1072,7 +1281,7 @@ class Book(object):
         #metadata -- no use of attributes (yet)
         # and fm: metadata disappears for now
         meta_info = []
-        log(pformat(self.metadata))
+        log(lambda: pformat(self.metadata), level=DEBUG)
         for ns in [DC]:
             for keyword, schemes in self.metadata[ns].items():
                 if ns:
@@ -1172,16 +1381,13 @@ class Book(object):
         generic_name = re.sub(r'-\d{4}\.\d\d\.\d\d\-\d\d\.\d\d\.\d\d', '', self.bookname)
         log(self.bookname, generic_name)
 
-        if not os.path.exists(groupdir):
-            os.mkdir(groupdir)
+        #another output of the same book may have just made it
+        ensure_dir(groupdir)
 
-        #change directory, for least symlink confusion
-        pwd = os.getcwd()
-        os.chdir(groupdir)
-        if os.path.exists(generic_name):
-            os.unlink(generic_name)
-        os.symlink(os.path.abspath(self.publish_file), generic_name)
-        os.chdir(pwd)
+        link = os.path.join(groupdir, generic_name)
+        if os.path.lexists(link):
+            os.unlink(link)
+        os.symlink(os.path.abspath(self.publish_file), link)
 
 
     def spawn_x(self):
@@ -1192,23 +1398,28 @@ class Book(object):
         Note that Xvfb doesn't interact well with dbus which is
         present on modern desktops.
         """
-        #Find an unused server number (in case two cgis are running at once)
-        while True:
-            servernum = random.randrange(50, 500)
-            if not os.path.exists('/tmp/.X%s-lock' % servernum):
-                break
-
+        #Find an unused server number (in case two cgis, or two
+        #books in this process, are running at once)
+        with _x_displays_lock:
+            while True:
+                servernum = random.randrange(50, 500)
+                if (servernum not in _x_displays and
+                    not os.path.exists('/tmp/.X%s-lock' % servernum)):
+                    break
+            _x_displays.add(servernum)
         self.xserver_no = ':%s' % servernum
 
+        #The display and its authority go in this book's environment,
+        #which is given to the programs that need X.
         authfile = self.filepath('Xauthority')
-        os.environ['XAUTHORITY'] = authfile
+        self.env['XAUTHORITY'] = authfile
 
         #mcookie(1) eats into /dev/random, so avoid that
         from hashlib import md5
-        m = md5("%r %r %r %r %r" % (self, os.environ, os.getpid(), time.time(), os.urandom(32)))
+        m = md5("%r %r %r %r %r" % (self, self.env, os.getpid(), time.time(), os.urandom(32)))
         mcookie = m.hexdigest()
 
-        check_call(['xauth', 'add', self.xserver_no, '.', mcookie])
+        check_call(['xauth', 'add', self.xserver_no, '.', mcookie], env=self.env)
 
         self.xvfb = Popen(['Xvfb', self.xserver_no,
                            '-screen', '0', '1024x768x24',
@@ -1219,14 +1430,14 @@ class Book(object):
                            '-dpi', '96',
                            #'-kb',
                            '-nolisten', 'tcp',
-                           ])
+                           ], env=self.env)
 
         # We need to wait a bit before the Xvfb is ready.  but the
         # downloads are so slow that that probably doesn't matter
 
         self.xvfb_ready_time = time.time() + 2
 
-        os.environ['DISPLAY'] = self.xserver_no
+        self.env['DISPLAY'] = self.xserver_no
         log(self.xserver_no)
 
     def wait_for_xvfb(self):
@@ -1244,7 +1455,7 @@ class Book(object):
         escaped Xvfb instances and kill those too."""
         if not hasattr(self, 'xvfb'):
             return
-        check_call(['xauth', 'remove', self.xserver_no])
+        check_call(['xauth', 'remove', self.xserver_no], env=self.env)
         p = self.xvfb
         log("trying to kill Xvfb %s" % p.pid)
         try_to_kill(p.pid, 15)
@@ -1261,6 +1472,9 @@ class Book(object):
             except OSError, e:
                 log(e)
 
+        with _x_displays_lock:
+            _x_displays.discard(int(self.xserver_no[1:]))
+
         if random.random() < 0.1:
             # occasionally kill old xvfbs and soffices, if there are any.
             self.kill_old_processes()
@@ -1303,18 +1517,16 @@ class Book(object):
     def cleanup(self):
         self.cleanup_x()
         if not config.KEEP_TEMP_FILES:
-            for fn in os.listdir(self.workdir):
-                os.remove(os.path.join(self.workdir, fn))
-            os.rmdir(self.workdir)
+            shutil.rmtree(self.workdir)
         else:
             log("NOT removing '%s', containing the following files:" % self.workdir)
-            log(*os.listdir(self.workdir))
+            log(*os.listdir(self.workdir), level=DEBUG)
 
         self.notify_watcher()
 
 
-def use_cache():
-    return (os.environ.get('HTTP_HOST') in config.USE_ZIP_CACHE_ALWAYS_HOSTS)
+def use_cache(http_host):
+    return (http_host in config.USE_ZIP_CACHE_ALWAYS_HOSTS)
 
 def _read_cached_zip(server, book, max_age):
     #find a recent zip if possible
@@ -1337,19 +1549,21 @@ def _read_cached_zip(server, book, max_age):
         log("%s is too old, must reload" % zipname)
         return None
     except (IOError, IndexError, ValueError), e:
-        log('could not make sense of %s: got exception %s' % (zipname, e))
+        log('could not make sense of %s: got exception %s' % (zipname, e), level=WARNING)
         return None
 
 
-def fetch_zip(server, book, save=False, max_age=-1, filename=None):
+def fetch_zip(server, book, save=False, max_age=-1, filename=None, http_host=None):
+    if http_host is None:
+        http_host = os.environ.get('HTTP_HOST', '')
     interface = config.SERVER_DEFAULTS[server].get('interface', 'Booki')
     try:
-        url = config.ZIP_URLS[interface] % {'HTTP_HOST': HTTP_HOST,
+        url = config.ZIP_URLS[interface] % {'HTTP_HOST': http_host,
                                             'server': server, 'book':book}
     except KeyError:
         raise NotImplementedError("Can't handle '%s' interface" % interface)
 
-    if use_cache() and max_age < 0:
+    if use_cache(http_host) and max_age < 0:
         #default to 12 hours cache on objavi.halo.gen.nz
         max_age = 12 * 60
 
@@ -1358,6 +1572,7 @@ def fetch_zip(server, book, save=False, max_age=-1, filename=None):
             'If you are debugging booki-zip creation, you will go CRAZY'
             ' unless you switch this off')
         blob_and_name = _read_cached_zip(server, book, max_age)
+        note_cache('zip', blob_and_name is not None)
         if blob_and_name is not None:
             return blob_and_name
 
@@ -42,10 +42,20 @@ CGI_MODES = { # arguments are: (publication, extension, mimetype)
     'bookizip': (True, '.zip', config.BOOKIZIP_MIMETYPE),
     'templated_html':  (True, '', 'text/html'),
 #    'templated_html_zip':  (True, '.zip', 'application/zip'),
+    'multi': (False, '.json', 'application/json'),
 }
 
 PUBLIC_CGI_MODES = tuple(k for k, v in CGI_MODES.items() if v[0])
 
+#modes that can be made together by the multi mode
+MULTI_FORMATS = ('book', 'newspaper', 'web', 'openoffice', 'epub',
+                 'bookizip', 'templated_html')
+
+def is_format_list(s):
+    formats = s.split(',')
+    return (len(formats) == len(set(formats)) and
+            all(x in MULTI_FORMATS for x in formats))
+
 
 CGI_METHODS = ('sync', 'async', 'poll')
 
@@ -232,12 +242,18 @@ FORM_INPUTS = (
     ("pdf_type", "", None, '', "", '',             #for css mode
      lambda x: CGI_MODES.get(x, [False])[0], DEFAULT_PDF_TYPE,
      ),
+    ("formats", "", None, '', "", '',             #for multi mode
+     is_format_list, None,
+     ),
     ("method", '', None, '', "", '',
      CGI_METHODS.__contains__, None,
      ),
     ("callback", '', None, '', "", '',
      is_url, None,
      ),
+    ("profile", '', None, '', "", '',           #see objavi/profiling.py
+     u"yes".__eq__, None,
+     ),
     ("engine", "", None, "", "", "", config.ENGINES.__contains__, config.DEFAULT_ENGINE,
      ),
     ("destination", "", None, None, "", "",
@@ -259,10 +275,11 @@ FORM_ELEMENT_TYPES = {
 
 
 PROGRESS_POINTS = (
-    ("start", "wake up", PUBLIC_CGI_MODES),
-    ("fetch_zip", "Load data", PUBLIC_CGI_MODES),
-    ("__init__", "Initialise the book", PUBLIC_CGI_MODES),
-    ("load_book", "Fetch the book", ('book', 'newspaper', 'web', 'openoffice')),
+    ("start", "wake up", PUBLIC_CGI_MODES + ('multi',)),
+    ("fetch_zip", "Load data", PUBLIC_CGI_MODES + ('multi',)),
+    ("__init__", "Initialise the book", PUBLIC_CGI_MODES + ('multi',)),
+    ("admit", "Wait for a turn", PUBLIC_CGI_MODES + ('multi',)),
+    ("load_book", "Fetch the book", ('book', 'newspaper', 'web', 'openoffice', 'multi')),
     ("add_css", "Add css", ('book', 'newspaper', 'web', 'openoffice')),
     ("add_section_titles", "Add section titles", ('book', 'newspaper', 'web', 'openoffice')),
     ("make_epub", "Make the epub file", ('epub',)),
@@ -276,6 +293,7 @@ PROGRESS_POINTS = (
     ("concatenated_pdfs", "concatenate the pdfs", ('book',)),
     ("make_templated_html", "Make templated HTML", ('templated_html',)),
     #("publish_pdf", "Publish the pdf", ('book', 'newspaper', 'web')),
-    (config.FINISHED_MESSAGE, "Finished!", PUBLIC_CGI_MODES),
+    ("make_multi", "Make each format", ('multi',)),
+    (config.FINISHED_MESSAGE, "Finished!", PUBLIC_CGI_MODES + ('multi',)),
 )
 
@@ -0,0 +1,228 @@
+# Part of Objavi2, which turns html manuals into books.  This module
+# keeps a record of the jobs that have been done.
+#
+# Copyright (C) 2009 Douglas Bagnall
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""A record of every finished job, in the sqlite database
+config.JOB_STORE.
+
+objavi.cgi gives each job a JobRecorder, which watches the book's
+progress messages to time its stages, and writes a row when the job
+is finished (or has failed).  The rows are read by admission control,
+to estimate what jobs will cost, and by bin/job-report.
+
+Subprocess times and cache counts come from objavi.book_utils, which
+keeps them for the whole process, so they are only right for one job
+per process (as in objavi.cgi)."""
+
+import os
+import time
+import sqlite3
+import resource
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from objavi.book_utils import log, job_counters, ensure_dir
+from objavi.pdf import count_pdf_pages
+from objavi import config
+
+COLUMNS = (
+    ('finished', 'REAL'),
+    ('bookname', 'TEXT'),
+    ('book', 'TEXT'),
+    ('server', 'TEXT'),
+    ('mode', 'TEXT'),
+    ('status', 'TEXT'),
+    ('options', 'TEXT'),           #json
+    ('pages', 'INTEGER'),
+    ('chapters', 'INTEGER'),
+    ('bytes_in', 'INTEGER'),
+    ('html_bytes', 'INTEGER'),
+    ('image_bytes', 'INTEGER'),
+    ('columns', 'INTEGER'),
+    ('bytes_out', 'INTEGER'),
+    ('wall_time', 'REAL'),         #the whole job
+    ('run_time', 'REAL'),          #since it was admitted
+    ('cpu_time', 'REAL'),
+    ('peak_memory', 'INTEGER'),
+    ('estimated_memory', 'INTEGER'),
+    ('stages', 'TEXT'),            #json {message: seconds}
+    ('subprocesses', 'TEXT'),      #json {command: [runs, seconds]}
+    ('cache', 'TEXT'),             #json {cache: [hits, misses]}
+    )
+JSON_COLUMNS = ('options', 'stages', 'subprocesses', 'cache')
+
+#request arguments that are recorded elsewhere or could be huge
+UNRECORDED_ARGS = ('book', 'server', 'mode', 'callback', 'css')
+MAX_OPTION_LENGTH = 200
+
+def connect():
+    ensure_dir(os.path.dirname(config.JOB_STORE))
+    db = sqlite3.connect(config.JOB_STORE, timeout=30)
+    db.row_factory = sqlite3.Row
+    db.execute('CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, %s)' %
+               ', '.join('%s %s' % x for x in COLUMNS))
+    db.execute('CREATE INDEX IF NOT EXISTS jobs_mode ON jobs (mode, finished)')
+    return db
+
+def save_job(job):
+    """Add the job (a dict with keys from COLUMNS) to the store, and
+    forget the oldest jobs if there are too many."""
+    job = dict(job)
+    for k in JSON_COLUMNS:
+        if k in job:
+            job[k] = json.dumps(job[k])
+    names = [x[0] for x in COLUMNS if x[0] in job]
+    db = connect()
+    try:
+        db.execute('INSERT INTO jobs (%s) VALUES (%s)' % (', '.join(names),
+                                                          ', '.join('?' * len(names))),
+                   [job[x] for x in names])
+        db.execute('DELETE FROM jobs WHERE id <= (SELECT MAX(id) FROM jobs) - ?',
+                   (config.JOB_STORE_MAX_JOBS,))
+        db.commit()
+    finally:
+        db.close()
+
+def load_jobs(where='1', params=(), order='id DESC', limit=None):
+    """Return the jobs matching the sql condition <where>, as dicts."""
+    if not os.path.exists(config.JOB_STORE):
+        return []
+    sql = 'SELECT * FROM jobs WHERE %s ORDER BY %s' % (where, order)
+    if limit is not None:
+        sql += ' LIMIT %d' % limit
+    db = connect()
+    try:
+        jobs = []
+        for row in db.execute(sql, params):
+            job = dict(zip(row.keys(), row))
+            for k in JSON_COLUMNS:
+                if job[k] is not None:
+                    job[k] = json.loads(job[k])
+            jobs.append(job)
+        return jobs
+    finally:
+        db.close()
+
+
+def _size(path):
+    """The size of a file, or of all the files in a directory."""
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(d, f))
+                   for d, dirs, files in os.walk(path) for f in files)
+    return os.path.getsize(path)
+
+def _cpu_time():
+    r = resource.getrusage(resource.RUSAGE_SELF)
+    c = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return r.ru_utime + r.ru_stime + c.ru_utime + c.ru_stime
+
+def _diff_counters(before, after):
+    diff = {}
+    for k, v in after.iteritems():
+        old = before.get(k, [0] * len(v))
+        d = [a - b for a, b in zip(v, old)]
+        if any(d):
+            diff[k] = d
+    return diff
+
+
+class JobRecorder(object):
+    """Collects the details of one job.  Its notifier method is a
+    Book watcher."""
+    def __init__(self, args, bookname):
+        self.args = args
+        self.bookname = bookname
+        self.book = None
+        self.failed = False
+        self.saved = False
+        self.start = self.last = time.time()
+        self.start_cpu = _cpu_time()
+        self.counters = job_counters()
+        self.stages = {}
+
+    def notifier(self, message):
+        """Time the stage that ends with <message>, and notice errors.
+        Once the book has finished, record it if nobody has."""
+        now = time.time()
+        if message == config.FINISHED_MESSAGE:
+            if not self.saved:
+                self.failed = True
+                self.save()
+            return
+        if message.startswith('ERROR'):
+            self.failed = True
+            message = 'ERROR'
+        self.stages[message] = self.stages.get(message, 0) + now - self.last
+        self.last = now
+
+    def save(self, publish_file=None, ticket_metrics=None):
+        """Write the job's record.  <ticket_metrics> are the measures
+        taken by admission control once the job was admitted."""
+        if self.saved or not config.JOB_STORE:
+            return
+        self.saved = True
+        try:
+            self.save_job(publish_file, ticket_metrics or {})
+        except Exception, e:
+            log("could not record job %s: %s" % (self.bookname, e))
+
+    def save_job(self, publish_file, ticket_metrics):
+        args = self.args
+        r = resource.getrusage(resource.RUSAGE_SELF)
+        c = resource.getrusage(resource.RUSAGE_CHILDREN)
+        wall_time = time.time() - self.start
+        job = {
+            'finished': time.time(),
+            'bookname': self.bookname,
+            'book': args.get('book'),
+            'server': args.get('server'),
+            'mode': args.get('mode', 'book'),
+            'status': self.failed and 'failed' or 'ok',
+            'options': dict((k, v[:MAX_OPTION_LENGTH]) for k, v in args.iteritems()
+                            if k not in UNRECORDED_ARGS),
+            'wall_time': wall_time,
+            'run_time': wall_time,
+            'cpu_time': _cpu_time() - self.start_cpu,
+            #ru_maxrss is in kilobytes; for children it is the biggest one
+            'peak_memory': (r.ru_maxrss + c.ru_maxrss) * 1024,
+            'stages': self.stages,
+            }
+        counters = job_counters()
+        job['subprocesses'] = _diff_counters(self.counters['subprocess'],
+                                             counters['subprocess'])
+        job['cache'] = _diff_counters(self.counters['cache'], counters['cache'])
+
+        book = self.book
+        if book is not None:
+            from objavi.admission import book_bytes
+            job['html_bytes'], job['image_bytes'] = book_bytes(book)
+            job['chapters'] = len(book.spine)
+            job['columns'] = getattr(getattr(book, 'maker', None), 'columns', 1)
+            if book.bookizip_file and os.path.exists(book.bookizip_file):
+                job['bytes_in'] = os.path.getsize(book.bookizip_file)
+        if publish_file is not None and os.path.exists(publish_file):
+            job['bytes_out'] = _size(publish_file)
+            if publish_file.endswith('.pdf'):
+                try:
+                    job['pages'] = count_pdf_pages(publish_file)
+                except Exception, e:
+                    log("could not count pages of %s: %s" % (publish_file, e))
+        job.update(ticket_metrics)
+        save_job(job)
@@ -5,9 +5,8 @@ import json
 
 from urllib2 import urlopen, HTTPError, Request
 
-from config import WKHTMLTOPDF
-from constants import POINT_2_MM
-from book_utils import log, run
+from book_utils import log
+from simplepdf import blank_pdf
 
 endpoint_template = "https://apps.lulu.com/api/create/v1/getcoversize/?api_key=%(api_key)s"
 
@@ -57,18 +56,7 @@ def calculate_cover_size(api_key, booksize, page_count):
 
 # XXX the real one is in pdf.py make_cover_pdf
 def create_cover_pdf(width, height, spine_width, outputname):
-    width = width * POINT_2_MM
-    height = height * POINT_2_MM
-    spine_width = spine_width * POINT_2_MM
-
-    cmd = [WKHTMLTOPDF,
-           "-q",
-           "--page-width", str(2 * width + spine_width),
-           "--page-height", str(height),
-           "--load-error-handling", "ignore",
-           "/dev/zero", outputname
-    ]
-    run(cmd)
+    blank_pdf(outputname, 2 * width + spine_width, height)
 
 def create_project(api_key, user, password, cover, contents, booksize, projectid, title, metadata={}):
 
@@ -25,8 +25,10 @@ from subprocess import Popen, PIPE
 import urllib
 
 from objavi import config
-from objavi.book_utils import log, run
+from objavi.book_utils import log, run, DEBUG, WARNING
 from objavi.cgi_utils import path2url
+from objavi.simplepdf import blank_pdf, barcode_pdf, nup_pdf
+from objavi.embedfonts import embed_fonts
 from constants import POINT_2_MM
 
 PDFNUP = 'bin/pdfnup'
@@ -35,10 +37,12 @@ PDFNUP = 'bin/pdfnup'
 class PageSettings(object):
     """Calculates and wraps commands for the generation and processing
     of PDFs"""
-    def __init__(self, tmpdir, pointsize, **kwargs):
+    def __init__(self, tmpdir, pointsize, env=None, **kwargs):
         # the formulas for default gutters, margins and column margins
         # are quite ad-hoc and certainly improvable.
         self.tmpdir = tmpdir
+        #the environment (with DISPLAY) for wkhtmltopdf and pdfedit
+        self.env = env
         self.width, self.height = pointsize
         self.grey_scale = 'grey_scale' in kwargs
 
@@ -143,10 +147,10 @@ class PageSettings(object):
             html_url = path2url(html, full=True)
             func = getattr(self, '_%s_command' % self.engine)
             cmd = func(html_url, pdf, outline=outline, outline_file=outline_file, page_num=page_num)
-            run(cmd)
+            run(cmd, env=self.env)
         else:
             #For multiple columns, generate a narrower single column pdf, and
-            #paste it into columns using pdfnup.
+            #paste it into columns.
             printable_width = self.width - 2.0 * self.side_margin - self.gutter
             column_width = (printable_width - (self.columns - 1) * self.column_margin) / self.columns
             page_width = column_width + self.column_margin
@@ -163,44 +167,58 @@ class PageSettings(object):
                                        side_margin=side_margin,
                                        bottom_margin=self.bottom_margin,
                                        grey_scale=self.grey_scale,
-                                       engine=self.engine
+                                       engine=self.engine,
+                                       env=self.env
                                        )
 
             column_pdf = pdf[:-4] + '-single-column.pdf'
             columnmaker.make_raw_pdf(html, column_pdf, outline=outline,
                                      outline_file=outline_file, page_num=None)
-            columnmaker.reshape_pdf(column_pdf)
-
-            # pdfnup seems to round down to an even number of output
-            # pages.  For example, if a book fills 13 pages, it will
-            # clip it to 12.  So it is necessary to add blank pages to
-            # round it up to an even number of output pages, which is
-            # to say a multiple of (self.columns * 2) input pages.
-
-            column_pages = count_pdf_pages(column_pdf)
-            overflow_pages = column_pages % (self.columns * 2)
-            if overflow_pages:
-                extra_pages = self.columns * 2 - overflow_pages
-            else:
-                extra_pages = 0
-
-            cmd = [PDFNUP,
-                   '--nup', '%sx1' % int(self.columns),
-                   #'--paper', papersize.lower() + 'paper',
-                   '--outfile', pdf,
-                   '--noautoscale', 'true',
-                   '--orient', 'portrait',
-                   '--paperwidth', '%smm' % int(self.width * POINT_2_MM),
-                   '--paperheight', '%smm' % int(self.height * POINT_2_MM),
-                   #'--tidy', 'false',
-                   '--pages', '1-last%s' % (',{}' * extra_pages,),
-                   #'--columnstrict', 'true',
-                   #'--column', 'true',
-                   column_pdf
-                   ]
 
-            run(cmd)
+            #The column pages sit edge to edge, each with half a
+            #column margin on either side, so the first one starts
+            #half a column margin left of the printable area.
+            left = self.side_margin + 0.5 * self.gutter - side_margin
+            try:
+                nup_pdf(column_pdf, pdf, self.width, self.height, self.columns,
+                        left, page_width)
+            except Exception, e:
+                log("could not put %s into columns (%s); trying pdfnup" % (column_pdf, e),
+                    level=WARNING)
+                self._pdfnup(column_pdf, pdf)
+
+    def _pdfnup(self, column_pdf, pdf):
+        """Paste the pages of column_pdf into columns using pdfnup,
+        which is slow, but copes with anything."""
+        # pdfnup seems to round down to an even number of output
+        # pages.  For example, if a book fills 13 pages, it will
+        # clip it to 12.  So it is necessary to add blank pages to
+        # round it up to an even number of output pages, which is
+        # to say a multiple of (self.columns * 2) input pages.
+
+        column_pages = count_pdf_pages(column_pdf)
+        overflow_pages = column_pages % (self.columns * 2)
+        if overflow_pages:
+            extra_pages = self.columns * 2 - overflow_pages
+        else:
+            extra_pages = 0
+
+        cmd = [PDFNUP,
+               '--nup', '%sx1' % int(self.columns),
+               #'--paper', papersize.lower() + 'paper',
+               '--outfile', pdf,
+               '--noautoscale', 'true',
+               '--orient', 'portrait',
+               '--paperwidth', '%smm' % int(self.width * POINT_2_MM),
+               '--paperheight', '%smm' % int(self.height * POINT_2_MM),
+               #'--tidy', 'false',
+               '--pages', '1-last%s' % (',{}' * extra_pages,),
+               #'--columnstrict', 'true',
+               #'--column', 'true',
+               column_pdf
+               ]
 
+        run(cmd)
 
 
     def reshape_pdf(self, pdf, dir=config.DEFAULT_DIR, centre_start=False,
@@ -229,47 +247,21 @@ class PageSettings(object):
                'centre_start=%s' % centre_start,
                'centre_end=%s' % centre_end,
                ]
-        run(cmd)
+        run(cmd, env=self.env)
 
 
     def make_barcode_pdf(self, isbn, pdf, corner='br'):
         """Put an ISBN barcode in a corner of a single blank page."""
-
-        position = '%s,%s,%s,%s,%s' % (corner, self.width, self.height, self.side_margin, self.bottom_margin)
-        cmd1 = [config.BOOKLAND,
-                '--position', position,
-                str(isbn)]
-        cmd2 = ['ps2pdf',
-                '-dFIXEDMEDIA',
-                '-dDEVICEWIDTHPOINTS=%s' % self.width,
-                '-dDEVICEHEIGHTPOINTS=%s' % self.height,
-                '-', pdf]
-
-        p1 = Popen(cmd1, stdout=PIPE)
-        p2 = Popen(cmd2, stdin=p1.stdout, stdout=PIPE, stderr=PIPE)
-        out, err = p2.communicate()
-
-        log('ran:\n%s | %s' % (' '.join(cmd1), ' '.join(cmd2)))
-        log("return: %s and %s \nstdout:%s \nstderr:%s" % (p1.poll(), p2.poll(), out, err))
+        barcode_pdf(pdf, isbn, self.width, self.height, corner,
+                    self.side_margin, self.bottom_margin)
 
     def calculate_cover_size(self, api_key, booksize, page_count):
         import lulu
         return lulu.calculate_cover_size(api_key, booksize, page_count)
 
     def make_cover_pdf(self, pdf, spine_width):
-        width = self.width * POINT_2_MM
-        height = self.height * POINT_2_MM
-        spine_width = spine_width * POINT_2_MM
-
         # XXX for now makes a blank cover
-        cmd = [config.WKHTMLTOPDF,
-               "-q",
-               "--page-width", str(2 * width + spine_width),
-               "--page-height", str(height),
-               "--load-error-handling", "ignore",
-               "/dev/zero", pdf
-               ]
-        run(cmd)
+        blank_pdf(pdf, 2 * self.width + spine_width, self.height)
 
     def upload_to_lulu(self, api_key, user, password, cover, contents, booksize, project, title, metadata={}):
         import lulu
@@ -353,7 +345,7 @@ def parse_extracted_outline(outline_file, depth=config.CONTENTS_DEPTH):
     for x in tree.getroot().iterchildren(config.WKTOCNS + 'item'):
         parse_item(x, 0)
 
-    log(contents)
+    log(contents, level=DEBUG)
     return contents
 
 
@@ -413,6 +405,21 @@ def parse_outline(pdf, level_threshold, debug_filename=None):
     return contents, page_count
 
 def embed_all_fonts(pdf_file):
+    """Embed the fonts that the PDF uses but lacks.  Normally the
+    missing font programs are added to the file as it is; if that
+    can't be done (or some fonts can't be found), Ghostscript rewrites
+    the whole PDF, substituting for the fonts it can't find."""
+    try:
+        missing = embed_fonts(pdf_file)
+        if not missing:
+            return
+        log("still missing fonts %s; using ghostscript" % ', '.join(missing), level=WARNING)
+    except Exception, e:
+        log("could not embed fonts in %s (%s); using ghostscript" % (pdf_file, e),
+            level=WARNING)
+    ghostscript_embed_fonts(pdf_file)
+
+def ghostscript_embed_fonts(pdf_file):
     tmp_file = pdf_file + '.pre-embed.pdf'
     os.rename(pdf_file, tmp_file)
     cmd = ['gs', '-q',                  # no messages to stdout
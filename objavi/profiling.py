@@ -0,0 +1,131 @@
+# Part of Objavi2, which turns html manuals into books.  This module
+# profiles jobs.
+#
+# Copyright (C) 2009 Douglas Bagnall
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Run a job under cProfile, when asked to or at random.
+
+The stats are saved as <PROFILE_DIR>/<bookname>.prof (readable with
+pstats), along with <bookname>.prof.txt, which lists the top functions
+by each of config.PROFILE_SORT.  They are also added to the totals
+for the job's mode in config.PROFILE_AGGREGATE_DIR: <mode>.prof,
+<mode>.prof.txt, and <mode>.jobs, which names the jobs counted.
+
+The book name is not known until the job has started, so objavi.cgi
+calls name_job() once it is.
+
+Only the process that finishes the job saves a profile.  In
+asynchronous modes that is the forked child (the parent leaves with
+os._exit), whose profile includes the parent's part.  The processes
+started by the multi mode also leave with os._exit, so each format's
+work shows up only as the time the job spent waiting for it."""
+
+import os
+import time
+import fcntl
+import random
+
+from objavi.book_utils import log, ensure_dir, atomic_write
+from objavi import config
+
+_current = None
+
+def wanted(args):
+    """Should the job with these arguments be profiled?"""
+    if config.PROFILE_ON_REQUEST and args.get('profile'):
+        return True
+    return random.random() * 100 < config.PROFILE_SAMPLE_PERCENT
+
+def name_job(name):
+    """Name the profile of the job being run, if it is being profiled."""
+    if _current is not None:
+        _current.name = name
+
+
+def write_summary(stats, fn, title):
+    f = open(fn, 'w')
+    f.write('%s\n\n' % title)
+    stats.stream = f
+    for order in config.PROFILE_SORT:
+        f.write('=== top %s by %s ===\n' % (config.PROFILE_TOP_N, order))
+        stats.sort_stats(order).print_stats(config.PROFILE_TOP_N)
+    f.close()
+
+
+class JobProfile(object):
+    def __init__(self, mode):
+        self.mode = mode
+        self.name = '%s-%s-%s' % (mode, time.strftime('%Y.%m.%d-%H.%M.%S'), os.getpid())
+        #objavi.cgi imports this module for most requests, few of which
+        #aren't profiled, so cProfile and pstats are imported here.
+        import cProfile
+        self.profiler = cProfile.Profile()
+
+    def run(self, fn, *args):
+        """Call fn(*args) under the profiler, and save the profile
+        however it ends (output_and_exit and friends raise
+        SystemExit)."""
+        global _current
+        _current = self
+        start = time.time()
+        self.profiler.enable()
+        try:
+            return fn(*args)
+        finally:
+            self.profiler.disable()
+            _current = None
+            try:
+                self.save(time.time() - start)
+            except Exception, e:
+                log("could not save the profile of %s: %s" % (self.name, e))
+
+    def save(self, elapsed):
+        import pstats
+        ensure_dir(config.PROFILE_DIR)
+        fn = os.path.join(config.PROFILE_DIR, self.name + '.prof')
+        self.profiler.dump_stats(fn)
+        stats = pstats.Stats(fn)
+        write_summary(stats, fn + '.txt', '%s (%s mode): %.2f seconds' %
+                      (self.name, self.mode, elapsed))
+        log("saved profile as %s" % fn)
+        self.aggregate(fn)
+
+    def aggregate(self, fn):
+        """Add the stats in <fn> to the totals for this mode."""
+        ensure_dir(config.PROFILE_AGGREGATE_DIR)
+        total = os.path.join(config.PROFILE_AGGREGATE_DIR, self.mode + '.prof')
+        import pstats
+        lock = open(total + '.lock', 'w')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            stats = pstats.Stats(fn)
+            jobs_mode = 'w'
+            if os.path.exists(total):
+                try:
+                    stats.add(total)
+                    jobs_mode = 'a'
+                except Exception, e:
+                    log("starting new profile totals; could not read %s: %s" % (total, e))
+            atomic_write(total, stats.dump_stats)
+            f = open(total[:-5] + '.jobs', jobs_mode + '+')
+            f.write(self.name + '\n')
+            f.seek(0)
+            n = len(f.readlines())
+            f.close()
+            write_summary(stats, total + '.txt', '%s mode: %d profiled jobs' % (self.mode, n))
+        finally:
+            lock.close()
@@ -0,0 +1,212 @@
+# Part of Objavi2, which turns html manuals into books.  This module
+# sends and serves progress messages.
+#
+# Copyright (C) 2009 Douglas Bagnall
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Progress messages, going out to callback urls and to clients
+watching via progress.cgi.
+
+A CallbackSender posts a job's messages to its callback url from one
+background thread, over one kept-alive connection.  Messages that
+arrive while a post is under way are sent together in the next one:
+'message' is the latest, and 'messages' has them all, one per line.
+Failed posts are retried with increasing delays.
+
+Messages for pollers are appended, one per line, to a file in
+htdocs/progress/, which progress.cgi reads and serves either as a
+long poll or as a stream of server-sent events.  The files are
+removed once they are config.PROGRESS_MAX_AGE seconds old."""
+
+import os
+import sys
+import time
+import atexit
+import httplib
+import threading
+from Queue import Queue, Empty
+from urllib import urlencode
+from urlparse import urlsplit
+
+from objavi.book_utils import log, remove_old_files, ensure_dir
+from objavi import config
+
+_STOP = object()
+
+class CallbackSender(object):
+    """Posts progress messages to <url> from a background thread."""
+    def __init__(self, url):
+        self.url = url
+        parts = urlsplit(url)
+        self.scheme = parts.scheme
+        self.netloc = parts.netloc
+        self.path = parts.path or '/'
+        if parts.query:
+            self.path += '?' + parts.query
+        self.conn = None
+        #the process that opened self.conn
+        self.conn_pid = None
+        self.queue = Queue()
+        self.pid = None
+        self.thread = None
+
+    def send(self, message):
+        if self.pid != os.getpid():
+            if self.pid is not None:
+                #a forked child (e.g. in multi mode) has no sender
+                #thread, and may never run atexit, so it waits.
+                self.post([message])
+                return
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self.run)
+            self.thread.setDaemon(True)
+            self.thread.start()
+            atexit.register(self.close)
+        self.queue.put(message)
+
+    def close(self, timeout=None):
+        """Send whatever is queued, waiting no longer than <timeout>
+        (default config.CALLBACK_FLUSH_TIMEOUT) seconds."""
+        if self.thread is None or self.pid != os.getpid():
+            return
+        self.queue.put(_STOP)
+        if timeout is None:
+            timeout = config.CALLBACK_FLUSH_TIMEOUT
+        self.thread.join(timeout)
+        if self.thread.isAlive():
+            log("gave up sending callbacks to %s" % self.url)
+        self.thread = None
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            messages = [self.queue.get()]
+            #gather the rest of the burst
+            time.sleep(config.CALLBACK_COALESCE_DELAY)
+            while True:
+                try:
+                    messages.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            if _STOP in messages:
+                stopping = True
+                messages = [x for x in messages if x is not _STOP]
+            if messages:
+                self.post(messages)
+        if self.conn is not None:
+            self.conn.close()
+
+    def _connect(self):
+        if self.scheme == 'https':
+            return httplib.HTTPSConnection(self.netloc, timeout=config.CALLBACK_TIMEOUT)
+        return httplib.HTTPConnection(self.netloc, timeout=config.CALLBACK_TIMEOUT)
+
+    def post(self, messages):
+        """Post the messages, retrying after delays of
+        CALLBACK_RETRY_DELAYS seconds if need be."""
+        data = urlencode({'message': messages[-1],
+                          'messages': '\n'.join(messages)})
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        if self.conn_pid != os.getpid():
+            #a forked child must leave the parent's connection to the
+            #parent's thread, neither using nor closing it.
+            self.conn = None
+        for delay in (0,) + tuple(config.CALLBACK_RETRY_DELAYS):
+            time.sleep(delay)
+            try:
+                if self.conn is None:
+                    self.conn = self._connect()
+                    self.conn_pid = os.getpid()
+                self.conn.request('POST', self.path, data, headers)
+                response = self.conn.getresponse()
+                response.read()
+                if response.status < 500:
+                    if response.status >= 400:
+                        log("callback to %s got %s %s" %
+                            (self.url, response.status, response.reason))
+                    return
+                log("callback to %s got %s %s, will retry" %
+                    (self.url, response.status, response.reason))
+            except (httplib.HTTPException, IOError), e:
+                log("ERROR in callback to %s: %r, will retry" % (self.url, e))
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+        log("giving up on callback %r to %s" % (messages, self.url))
+
+
+def progress_file(bookname):
+    return config.POLL_NOTIFY_PATH % bookname
+
+def open_progress_file(bookname):
+    """Open the job's progress file for appending, first removing
+    those of jobs long finished."""
+    fn = progress_file(bookname)
+    d = os.path.dirname(fn)
+    ensure_dir(d)
+    ext = os.path.splitext(fn)[1]
+    remove_old_files(d, config.PROGRESS_MAX_AGE, ext and (ext,) or None)
+    return open(fn, 'a')
+
+def read_progress(bookname, since=0):
+    """Return the messages after the first <since>, and whether the
+    job has finished."""
+    try:
+        f = open(progress_file(bookname))
+    except IOError:
+        return [], False
+    messages = [x for x in f.read().split('\n') if x]
+    f.close()
+    return messages[since:], config.FINISHED_MESSAGE in messages
+
+def wait_for_progress(bookname, since=0, timeout=None):
+    """Like read_progress, but wait up to <timeout> seconds for new
+    messages if there are none."""
+    if timeout is None:
+        timeout = config.PROGRESS_LONGPOLL_TIMEOUT
+    deadline = time.time() + timeout
+    fn = progress_file(bookname)
+    size = None
+    while True:
+        try:
+            new_size = os.stat(fn).st_size
+        except OSError:
+            new_size = -1
+        if new_size != size:
+            size = new_size
+            messages, finished = read_progress(bookname, since)
+            if messages or finished or time.time() > deadline:
+                return messages, finished
+        elif time.time() > deadline:
+            return [], False
+        time.sleep(config.PROGRESS_CHECK_INTERVAL)
+
+def stream_progress(bookname, since=0, out=sys.stdout, timeout=None):
+    """Write the job's messages after the first <since> to <out> as
+    server-sent events, until it finishes or nothing happens for
+    <timeout> seconds.  The event ids count messages, so a client
+    that reconnects with Last-Event-ID carries on where it was."""
+    while True:
+        messages, finished = wait_for_progress(bookname, since, timeout)
+        if not messages and not finished:
+            return
+        for m in messages:
+            since += 1
+            out.write('id: %s\n' % since)
+            out.write(''.join('data: %s\n' % x for x in m.split('\n')) + '\n')
+        out.flush()
+        if finished:
+            return
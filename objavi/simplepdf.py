@@ -0,0 +1,802 @@
+# Part of Objavi2, which turns html manuals into books.  This module
+# reads and writes simple PDFs without outside help.
+#
+# Copyright (C) 2009 Douglas Bagnall
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Write one page PDFs directly: blank pages of any size (for lulu.com
+covers), and pages with an ISBN barcode in a corner.  These used to
+take a wkhtmltopdf run on /dev/zero, and bookland piped through
+ps2pdf.
+
+The barcode's bars come from the bit patterns in bookland's
+productcode.py, and are laid out as bookland lays them out.  The
+digits are set in Courier, which every PDF reader has, so no font is
+embedded.
+
+Finished pages are kept in config.PDF_PAGE_CACHE_DIR, keyed by
+everything that goes into them.
+
+There is also just enough of a PDF reader to take the pages out of
+another PDF and lay them side by side in columns (nup_pdf), which
+newspapers used to do with pdfnup and pdflatex."""
+
+import os
+import re
+import imp
+import zlib
+import struct
+import shutil
+from hashlib import sha1
+
+from objavi.book_utils import log, note_cache, atomic_write
+from objavi import config
+
+#change this when the pages change, so old cached ones aren't used
+VERSION = 1
+
+#bookland's default sizes, in points
+MODULE_WIDTH = 0.0130 * 72
+MODULE_HEIGHT = 1.00 * 72
+GUARD_DEPTH = 5
+LABEL_SIZE = 9
+
+#Courier's advance width and (roughly) the height of its digits and
+#capitals, as fractions of the font size
+COURIER_WIDTH = 0.6
+COURIER_HEIGHT = 0.6
+
+_productcode = None
+
+def productcode():
+    """bookland's productcode module, which lives beside bookland."""
+    global _productcode
+    if _productcode is None:
+        fn = os.path.join(os.path.dirname(config.BOOKLAND), 'productcode.py')
+        _productcode = imp.load_source('productcode', fn)
+    return _productcode
+
+
+def _n(x):
+    """Format a number for a PDF content stream."""
+    s = ('%.3f' % x).rstrip('0').rstrip('.')
+    if s == '-0':
+        return '0'
+    return s
+
+def _string(s):
+    return '(%s)' % s.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+def write_pdf(fn, pages):
+    """Write a PDF to <fn> with <pages>, a list of (width, height,
+    content stream) tuples.  The content can use Courier as /F1."""
+    objects = ['<< /Type /Catalog /Pages 2 0 R >>',
+               None,
+               '<< /Type /Font /Subtype /Type1 /BaseFont /Courier >>']
+    kids = []
+    for width, height, content in pages:
+        objects.append('<< /Length %d >>\nstream\n%s\nendstream' % (len(content), content))
+        objects.append('<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %s %s] '
+                       '/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>' %
+                       (_n(width), _n(height), len(objects)))
+        kids.append('%d 0 R' % len(objects))
+    objects[1] = '<< /Type /Pages /Kids [%s] /Count %d >>' % (' '.join(kids), len(kids))
+    _write_objects(fn, objects)
+
+def _write_objects(fn, objects):
+    """Write a PDF to <fn> consisting of <objects> (strings, numbered
+    from 1).  The first is the catalog."""
+    out = ['%PDF-1.4\n%\xe2\xe3\xcf\xd3\n']
+    size = len(out[0])
+    offsets = []
+    for i, obj in enumerate(objects):
+        offsets.append(size)
+        s = '%d 0 obj\n%s\nendobj\n' % (i + 1, obj)
+        out.append(s)
+        size += len(s)
+    out.append('xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1))
+    out.extend('%010d 00000 n \n' % x for x in offsets)
+    out.append('trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' %
+               (len(objects) + 1, size))
+    f = open(fn, 'wb')
+    f.write(''.join(out))
+    f.close()
+
+
+def barcode_content(isbn, width, height, corner='br', xmargin=0, ymargin=0):
+    """A content stream drawing the barcode for <isbn> (ISBN-10 or 13,
+    or another EAN-13) in the <corner> ('tl', 'tr', 'bl', or 'br') of
+    a page, just inside the margins."""
+    pc = productcode().makeProductCode(str(isbn), forceISBN13=True)
+    ean = pc.as13()
+    bars_width = len(ean.bits) * MODULE_WIDTH
+    #the 6 digit groups under the bars fill 40 modules, as in bookland
+    digit_size = 0.98 * 40 * MODULE_WIDTH / (6 * COURIER_WIDTH)
+    digit_width = digit_size * COURIER_WIDTH
+    digit_height = digit_size * COURIER_HEIGHT
+    label = '%s' % pc
+    label_width = len(label) * LABEL_SIZE * COURIER_WIDTH
+
+    #the bounding box, relative to the bottom left of the bars.  The
+    #quiet zone on the right is a digit wide.
+    llx = min(-2 - digit_width, (bars_width - label_width) / 2)
+    lly = -1 - digit_height
+    urx = max(bars_width + digit_width, (bars_width + label_width) / 2)
+    ury = MODULE_HEIGHT + 2 + LABEL_SIZE * COURIER_HEIGHT
+    if corner[1] == 'l':
+        x0 = xmargin - llx
+    else:
+        x0 = width - xmargin - urx
+    if corner[0] == 'b':
+        y0 = ymargin - lly
+    else:
+        y0 = height - ymargin - ury
+
+    ops = ['q', '1 0 0 1 %s %s cm' % (_n(x0), _n(y0)), '0 0 0 1 k']
+    bits = ean.bits
+    i = 0
+    while i < len(bits):
+        bit = bits[i]
+        n = 1
+        while i + n < len(bits) and bits[i + n] == bit:
+            n += 1
+        if bit != '0':
+            y = (bit == 'L') and -GUARD_DEPTH or 0
+            ops.append('%s %s %s %s re' % (_n(i * MODULE_WIDTH), _n(y), _n(n * MODULE_WIDTH),
+                                           _n(MODULE_HEIGHT - y)))
+        i += n
+    ops.append('f')
+
+    def text(s, size, x, y):
+        ops.append('BT /F1 %s Tf %s %s Td %s Tj ET' % (_n(size), _n(x), _n(y), _string(s)))
+
+    #the digits hang 1 point below the bars; the first is out on the left
+    baseline = -1 - digit_height
+    text(ean.leftDigits, digit_size, 24 * MODULE_WIDTH - 3 * digit_width, baseline)
+    text(ean.rightDigits, digit_size, 70 * MODULE_WIDTH - 3 * digit_width, baseline)
+    text(str(ean.digits[0]), digit_size, -2 - digit_width, baseline)
+    text(label, LABEL_SIZE, (bars_width - label_width) / 2, MODULE_HEIGHT + 2)
+    ops.append('Q')
+    return '\n'.join(ops)
+
+
+def _cached(fn, key, make):
+    """Copy the PDF for <key> to <fn>, first making it with make(path)
+    if it isn't in the cache."""
+    if not config.PDF_PAGE_CACHE_DIR:
+        make(fn)
+        return
+    cached = os.path.join(config.PDF_PAGE_CACHE_DIR,
+                          sha1(repr((VERSION,) + key)).hexdigest() + '.pdf')
+    hit = os.path.exists(cached)
+    note_cache('pdf_page', hit)
+    if not hit:
+        atomic_write(cached, make)
+    shutil.copyfile(cached, fn)
+
+def blank_pdf(fn, width, height):
+    """Write a PDF of one blank page, <width> by <height> points."""
+    log("making a blank %s x %s page in %s" % (width, height, fn))
+    _cached(fn, ('blank', float(width), float(height)),
+            lambda path: write_pdf(path, [(width, height, '')]))
+
+def barcode_pdf(fn, isbn, width, height, corner='br', xmargin=0, ymargin=0):
+    """Write a PDF of one page, <width> by <height> points, with the
+    barcode for <isbn> in a corner."""
+    log("making a barcode for %s in %s" % (isbn, fn))
+    key = ('barcode', str(isbn), float(width), float(height), corner,
+           float(xmargin), float(ymargin))
+    _cached(fn, key, lambda path: write_pdf(path, [
+        (width, height, barcode_content(isbn, width, height, corner, xmargin, ymargin))]))
+
+
+#Reading PDFs.  This is only as much as is needed to take pages out of
+#the PDFs that wkhtmltopdf and pdfedit make (and most others).  Names
+#are Name strings (without the slash), strings are String strings,
+#dictionaries and arrays are dicts and lists.
+
+class PDFError(Exception):
+    pass
+
+class Name(str):
+    pass
+
+class String(str):
+    pass
+
+class Ref(object):
+    __slots__ = ('num', 'gen')
+    def __init__(self, num, gen=0):
+        self.num = num
+        self.gen = gen
+
+    def __eq__(self, other):
+        return isinstance(other, Ref) and (self.num, self.gen) == (other.num, other.gen)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.num, self.gen))
+
+    def __repr__(self):
+        return 'Ref(%d, %d)' % (self.num, self.gen)
+
+class Stream(object):
+    """A stream's dictionary and its undecoded data."""
+    def __init__(self, dict, data):
+        self.dict = dict
+        self.data = data
+
+WHITESPACE = '\x00\t\n\x0c\r '
+_ws_re = re.compile(r'(?:[\x00\t\n\x0c\r ]+|%[^\r\n]*)*')
+_token_re = re.compile(r'[^\x00\t\n\x0c\r ()<>\[\]{}/%]*')
+_int_re = re.compile(r'[+-]?\d+$')
+_ref_re = re.compile(r'[\x00\t\n\x0c\r ]+(\d+)[\x00\t\n\x0c\r ]+R(?![^\x00\t\n\x0c\r ()<>\[\]{}/%])')
+_obj_re = re.compile(r'(\d+)[\x00\t\n\x0c\r ]+(\d+)[\x00\t\n\x0c\r ]+obj\b')
+_xref_section_re = re.compile(r'(\d+)[\x00\t\n\x0c\r ]+(\d+)')
+_xref_entry_re = re.compile(r'[\x00\t\n\x0c\r ]*(\d+)[\x00\t\n\x0c\r ]+(\d+)[\x00\t\n\x0c\r ]+([nf])')
+_hash_re = re.compile(r'#([0-9a-fA-F]{2})')
+
+_ESCAPES = {'n': '\n', 'r': '\r', 't': '\t', 'b': '\b', 'f': '\f'}
+
+#page attributes that pages get from their ancestors
+INHERITABLE = ('Resources', 'MediaBox', 'CropBox', 'Rotate')
+
+
+def _unpredict(data, parms):
+    """Undo the PNG predictor of a (Flate) stream."""
+    predictor = parms.get('Predictor', 1)
+    if predictor == 1:
+        return data
+    if predictor < 10:
+        raise PDFError("TIFF predictors are not supported")
+    bpp = max(1, parms.get('Colors', 1) * parms.get('BitsPerComponent', 8) // 8)
+    rowlen = (parms.get('Colors', 1) * parms.get('BitsPerComponent', 8) *
+              parms.get('Columns', 1) + 7) // 8
+    out = []
+    prev = [0] * rowlen
+    for i in range(0, len(data), rowlen + 1):
+        kind = ord(data[i])
+        row = [ord(c) for c in data[i + 1:i + 1 + rowlen]]
+        row += [0] * (rowlen - len(row))
+        for j in range(rowlen):
+            left = j >= bpp and row[j - bpp] or 0
+            if kind == 1:
+                row[j] = (row[j] + left) & 255
+            elif kind == 2:
+                row[j] = (row[j] + prev[j]) & 255
+            elif kind == 3:
+                row[j] = (row[j] + (left + prev[j]) // 2) & 255
+            elif kind == 4:
+                upleft = j >= bpp and prev[j - bpp] or 0
+                p = left + prev[j] - upleft
+                pa, pb, pc = abs(p - left), abs(p - prev[j]), abs(p - upleft)
+                if pa <= pb and pa <= pc:
+                    row[j] = (row[j] + left) & 255
+                elif pb <= pc:
+                    row[j] = (row[j] + prev[j]) & 255
+                else:
+                    row[j] = (row[j] + upleft) & 255
+        out.append(''.join(chr(x) for x in row))
+        prev = row
+    return ''.join(out)
+
+
+def _ascii85(data):
+    data = re.sub('[%s]' % WHITESPACE, '', data)
+    if data.startswith('<~'):
+        data = data[2:]
+    data = data.split('~>')[0].replace('z', '!!!!!')
+    out = []
+    for i in range(0, len(data), 5):
+        group = data[i:i + 5]
+        n = 0
+        for c in group + 'u' * (5 - len(group)):
+            n = n * 85 + ord(c) - 33
+        out.append(struct.pack('>I', n & 0xffffffff)[:len(group) - 1])
+    return ''.join(out)
+
+
+class PDFReader(object):
+    """Reads the objects and pages of a PDF, following its cross
+    reference tables (or streams) and any incremental updates.  If the
+    tables are broken, it looks for the objects itself."""
+    def __init__(self, fn):
+        f = open(fn, 'rb')
+        self.data = f.read()
+        f.close()
+        self.fn = fn
+        self.cache = {}
+        self.object_streams = {}
+        self.xref = {}
+        self.startxref = None
+        try:
+            self.trailer = self._read_xrefs()
+            self.trailer['Root']
+        except (PDFError, ValueError, KeyError, IndexError, TypeError, zlib.error), e:
+            log("%s has broken cross references (%s); looking for its objects" % (fn, e))
+            self.startxref = None
+            self.trailer = self._find_objects()
+
+    def _skip(self, pos):
+        return _ws_re.match(self.data, pos).end()
+
+    def parse(self, pos):
+        """Parse the object at <pos>, returning it and the position
+        after it."""
+        data = self.data
+        pos = self._skip(pos)
+        c = data[pos:pos + 1]
+        if c == '/':
+            m = _token_re.match(data, pos + 1)
+            name = _hash_re.sub(lambda x: chr(int(x.group(1), 16)), m.group())
+            return Name(name), m.end()
+        if c == '<':
+            if data[pos + 1] == '<':
+                d = {}
+                pos += 2
+                while True:
+                    pos = self._skip(pos)
+                    if data.startswith('>>', pos):
+                        return d, pos + 2
+                    k, pos = self.parse(pos)
+                    if not isinstance(k, Name):
+                        raise PDFError("%r is not a name (at %d)" % (k, pos))
+                    d[str(k)], pos = self.parse(pos)
+            end = data.index('>', pos)
+            h = re.sub(r'[^0-9a-fA-F]', '', data[pos + 1:end])
+            if len(h) % 2:
+                h += '0'
+            return String(h.decode('hex')), end + 1
+        if c == '[':
+            a = []
+            pos += 1
+            while True:
+                pos = self._skip(pos)
+                if data[pos] == ']':
+                    return a, pos + 1
+                x, pos = self.parse(pos)
+                a.append(x)
+        if c == '(':
+            return self._parse_string(pos + 1)
+        m = _token_re.match(data, pos)
+        token = m.group()
+        pos = m.end()
+        if token == 'true':
+            return True, pos
+        if token == 'false':
+            return False, pos
+        if token == 'null':
+            return None, pos
+        if _int_re.match(token):
+            m = _ref_re.match(data, pos)
+            if m:
+                return Ref(int(token), int(m.group(1))), m.end()
+            return int(token), pos
+        try:
+            return float(token), pos
+        except ValueError:
+            raise PDFError("unexpected %r at %d" % (token or c, pos))
+
+    def _parse_string(self, pos):
+        data = self.data
+        out = []
+        depth = 0
+        while True:
+            c = data[pos]
+            pos += 1
+            if c == '\\':
+                c = data[pos]
+                pos += 1
+                if c in '01234567':
+                    m = re.compile('[0-7]{1,3}').match(data, pos - 1)
+                    out.append(chr(int(m.group(), 8) & 255))
+                    pos = m.end()
+                elif c == '\r':
+                    if data[pos] == '\n':
+                        pos += 1
+                elif c != '\n':
+                    out.append(_ESCAPES.get(c, c))
+                continue
+            if c == '(':
+                depth += 1
+            elif c == ')':
+                if not depth:
+                    return String(''.join(out)), pos
+                depth -= 1
+            out.append(c)
+
+    def parse_object(self, pos):
+        """Parse the indirect object ('n g obj ... endobj') at <pos>,
+        returning its number and value."""
+        data = self.data
+        m = _obj_re.match(data, self._skip(pos))
+        if m is None:
+            raise PDFError("no object at %d" % pos)
+        value, pos = self.parse(m.end())
+        pos = self._skip(pos)
+        if isinstance(value, dict) and data.startswith('stream', pos):
+            pos += 6
+            if data.startswith('\r\n', pos):
+                pos += 2
+            elif data[pos] in '\r\n':
+                pos += 1
+            try:
+                length = self.resolve(value.get('Length'))
+                end = pos + length
+                if not re.compile(r'[\x00\t\n\x0c\r ]*endstream').match(data, end):
+                    raise PDFError("bad stream length")
+            except (PDFError, TypeError):
+                end = data.index('endstream', pos)
+                if data[end - 1] == '\n':
+                    end -= 1
+                if data[end - 1] == '\r':
+                    end -= 1
+            value = Stream(value, data[pos:end])
+        return int(m.group(1)), value
+
+    def _read_xrefs(self):
+        data = self.data
+        i = data.rindex('startxref')
+        pos = int(_token_re.match(data, self._skip(i + 9)).group())
+        startxref = pos
+        trailer = None
+        seen = set()
+        while pos is not None and pos not in seen:
+            seen.add(pos)
+            if data.startswith('xref', self._skip(pos)):
+                t = self._read_xref_table(self._skip(pos) + 4)
+                if 'XRefStm' in t:
+                    self._read_xref_stream(t['XRefStm'])
+            else:
+                t = self._read_xref_stream(pos)
+            if trailer is None:
+                trailer = t
+            pos = t.get('Prev')
+        self.startxref = startxref
+        return trailer
+
+    def _read_xref_table(self, pos):
+        #the newest sections are read first, and take precedence
+        data = self.data
+        while True:
+            pos = self._skip(pos)
+            if data.startswith('trailer', pos):
+                return self.parse(pos + 7)[0]
+            m = _xref_section_re.match(data, pos)
+            if m is None:
+                raise PDFError("bad xref table at %d" % pos)
+            start, count = int(m.group(1)), int(m.group(2))
+            pos = m.end()
+            for num in range(start, start + count):
+                m = _xref_entry_re.match(data, pos)
+                if m is None:
+                    raise PDFError("bad xref entry at %d" % pos)
+                pos = m.end()
+                if m.group(3) == 'n':
+                    self.xref.setdefault(num, ('offset', int(m.group(1))))
+                else:
+                    self.xref.setdefault(num, None)
+
+    def _read_xref_stream(self, pos):
+        num, stream = self.parse_object(pos)
+        d = stream.dict
+        widths = d['W']
+        index = d.get('Index', [0, d['Size']])
+        rows = self.decode(stream)
+        rowlen = sum(widths)
+        i = 0
+        for j in range(0, len(index), 2):
+            for num in range(index[j], index[j] + index[j + 1]):
+                row = rows[i:i + rowlen]
+                i += rowlen
+                fields = []
+                k = 0
+                for w in widths:
+                    n = 0
+                    for c in row[k:k + w]:
+                        n = n * 256 + ord(c)
+                    fields.append(n)
+                    k += w
+                kind = widths[0] and fields[0] or 1
+                if kind == 1:
+                    self.xref.setdefault(num, ('offset', fields[1]))
+                elif kind == 2:
+                    self.xref.setdefault(num, ('stream', fields[1], fields[2]))
+                else:
+                    self.xref.setdefault(num, None)
+        return d
+
+    def _find_objects(self):
+        """Find the objects and the catalog without any cross
+        references.  Later objects replace earlier ones."""
+        self.xref = {}
+        self.cache = {}
+        for m in _obj_re.finditer(self.data):
+            if m.start() == 0 or self.data[m.start() - 1] in WHITESPACE:
+                self.xref[int(m.group(1))] = ('offset', m.start())
+        for num in sorted(self.xref):
+            try:
+                obj = self.get(num)
+            except (PDFError, ValueError, IndexError):
+                continue
+            if isinstance(obj, dict) and obj.get('Type') == 'Catalog':
+                return {'Root': Ref(num)}
+            if isinstance(obj, Stream) and obj.dict.get('Type') == 'ObjStm':
+                for i, x in enumerate(self._object_stream(num)[1][::2]):
+                    self.xref.setdefault(x, ('stream', num, i))
+        raise PDFError("%s has no catalog" % self.fn)
+
+    def _object_stream(self, num):
+        if num not in self.object_streams:
+            stream = self.get(num)
+            data = self.decode(stream)
+            first = stream.dict['First']
+            header = [int(x) for x in data[:first].split()]
+            self.object_streams[num] = (data, header, first)
+        return self.object_streams[num]
+
+    def get(self, num):
+        """The object numbered <num> (or None, if there is none)."""
+        if num not in self.cache:
+            entry = self.xref.get(num)
+            if entry is None:
+                obj = None
+            elif entry[0] == 'offset':
+                n, obj = self.parse_object(entry[1])
+                if n != num:
+                    raise PDFError("object %d is not at %d" % (num, entry[1]))
+            else:
+                data, header, first = self._object_stream(entry[1])
+                offset = header[2 * entry[2] + 1]
+                reader = PDFReader.__new__(PDFReader)
+                reader.data = data
+                obj = reader.parse(first + offset)[0]
+            self.cache[num] = obj
+        return self.cache[num]
+
+    def generation(self, num):
+        entry = self.xref.get(num)
+        if entry is None or entry[0] != 'offset':
+            return 0
+        return int(_obj_re.match(self.data, self._skip(entry[1])).group(2))
+
+    def resolve(self, x):
+        seen = set()
+        while isinstance(x, Ref):
+            if x.num in seen:
+                raise PDFError("reference loop at object %d" % x.num)
+            seen.add(x.num)
+            x = self.get(x.num)
+        return x
+
+    def decode(self, stream):
+        """The decoded data of <stream>.  Flate compression and the
+        ASCII encodings are understood, which is enough for content
+        streams and cross reference streams."""
+        filters = self.resolve(stream.dict.get('Filter', []))
+        parms = self.resolve(stream.dict.get('DecodeParms', []))
+        if not isinstance(filters, list):
+            filters, parms = [filters], [parms]
+        data = stream.data
+        for i, f in enumerate(filters):
+            f = self.resolve(f)
+            if f in ('FlateDecode', 'Fl'):
+                #allow for trailing junk
+                data = zlib.decompressobj().decompress(data)
+                p = i < len(parms) and self.resolve(parms[i]) or None
+                if p:
+                    data = _unpredict(data, dict((k, self.resolve(v)) for k, v in p.iteritems()))
+            elif f in ('ASCIIHexDecode', 'AHx'):
+                h = re.sub(r'[^0-9a-fA-F]', '', data.split('>')[0])
+                data = (h + '0' * (len(h) % 2)).decode('hex')
+            elif f in ('ASCII85Decode', 'A85'):
+                data = _ascii85(data)
+            else:
+                raise PDFError("can't decode %s streams" % f)
+        return data
+
+    def pages(self):
+        """The pages, as dictionaries with their inherited attributes
+        filled in."""
+        pages = []
+        def walk(node, inherited, seen):
+            if isinstance(node, Ref):
+                if node.num in seen:
+                    raise PDFError("page tree loop at object %d" % node.num)
+                seen = seen | set([node.num])
+            node = self.resolve(node)
+            attrs = dict(inherited)
+            attrs.update((k, node[k]) for k in INHERITABLE if k in node)
+            if 'Kids' in node:
+                for kid in self.resolve(node['Kids']):
+                    walk(kid, attrs, seen)
+            else:
+                page = dict(node)
+                page.update(attrs)
+                pages.append(page)
+        walk(self.resolve(self.trailer['Root'])['Pages'], {}, set())
+        return pages
+
+
+def _name(s):
+    return '/' + re.sub(r'[^!-~]|[()<>\[\]{}/%#]', lambda m: '#%02x' % ord(m.group()), s)
+
+def serialise(x):
+    """The PDF form of <x>, which is made of the types PDFReader
+    returns (but not Stream)."""
+    if x is None:
+        return 'null'
+    if x is True:
+        return 'true'
+    if x is False:
+        return 'false'
+    if isinstance(x, Name):
+        return _name(x)
+    if isinstance(x, String):
+        return '<%s>' % x.encode('hex')
+    if isinstance(x, (int, long)):
+        return str(x)
+    if isinstance(x, float):
+        return _n(x)
+    if isinstance(x, Ref):
+        return '%d %d R' % (x.num, x.gen)
+    if isinstance(x, list):
+        return '[%s]' % ' '.join(serialise(v) for v in x)
+    if isinstance(x, dict):
+        return '<<%s>>' % ''.join('%s %s' % (_name(k), serialise(v)) for k, v in x.iteritems())
+    raise TypeError("can't put %r in a PDF" % (x,))
+
+def _serialise_object(x):
+    if isinstance(x, Stream):
+        d = dict(x.dict)
+        d['Length'] = len(x.data)
+        return '%s\nstream\n%s\nendstream' % (serialise(d), x.data)
+    return serialise(x)
+
+
+class _Copier(object):
+    """Copies objects from a PDFReader into a list of new objects,
+    renumbering them, and bringing along what they refer to.  Pages
+    are left behind, so only what a page's content needs comes."""
+    def __init__(self, reader, objects):
+        self.reader = reader
+        self.objects = objects
+        self.numbers = {}
+        self.queue = []
+
+    def copy(self, x):
+        if isinstance(x, Ref):
+            target = self.reader.resolve(x)
+            if isinstance(target, dict) and target.get('Type') in ('Page', 'Pages'):
+                return None
+            if x.num not in self.numbers:
+                self.objects.append(None)
+                self.numbers[x.num] = len(self.objects)
+                self.queue.append(x.num)
+            return Ref(self.numbers[x.num])
+        if isinstance(x, list):
+            return [self.copy(v) for v in x]
+        if isinstance(x, dict):
+            return dict((k, self.copy(v)) for k, v in x.iteritems())
+        if isinstance(x, Stream):
+            return Stream(self.copy(x.dict), x.data)
+        return x
+
+    def finish(self):
+        while self.queue:
+            num = self.queue.pop()
+            self.objects[self.numbers[num] - 1] = self.copy(self.reader.get(num))
+
+
+def nup_pdf(src, dest, width, height, columns, left, step):
+    """Lay the pages of <src> side by side on <width> by <height> point
+    pages in <dest>, <columns> to a page.  The first column's left
+    edge is <left> points from the left of the page, and each column
+    is <step> points right of the one before.  The columns are centred
+    vertically.  A short last page has empty columns on the right.
+
+    Each page of <src> becomes a form XObject, so its content is
+    copied as it is, not redrawn.  Links and outlines are dropped."""
+    reader = PDFReader(src)
+    pages = reader.pages()
+    log("putting %d pages of %s into %d columns" % (len(pages), src, columns))
+    objects = [{'Type': Name('Catalog'), 'Pages': Ref(2)}, None]
+    copier = _Copier(reader, objects)
+    forms = []
+    for page in pages:
+        resolve = reader.resolve
+        if resolve(page.get('Rotate', 0)) % 360:
+            raise PDFError("can't put rotated pages in columns")
+        box = [float(resolve(x)) for x in resolve(page.get('CropBox', page.get('MediaBox')))]
+        contents = resolve(page.get('Contents', []))
+        if not isinstance(contents, list):
+            contents = [contents]
+        contents = [resolve(c) for c in contents]
+        contents = [c for c in contents if c is not None]
+        if len(contents) == 1:
+            d = dict(contents[0].dict)
+            data = contents[0].data
+        else:
+            d = {'Filter': Name('FlateDecode')}
+            data = zlib.compress('\n'.join(reader.decode(x) for x in contents))
+        for k in ('Length', 'DL', 'Type', 'Subtype'):
+            d.pop(k, None)
+        d.update(Type=Name('XObject'), Subtype=Name('Form'), BBox=box,
+                 Resources=page.get('Resources', {}))
+        objects.append(copier.copy(Stream(d, data)))
+        forms.append((len(objects), box))
+    copier.finish()
+
+    kids = []
+    for i in range(0, len(forms), columns):
+        ops = []
+        xobjects = {}
+        for j, (num, box) in enumerate(forms[i:i + columns]):
+            x = left + j * step - box[0]
+            y = (height - (box[3] - box[1])) * 0.5 - box[1]
+            ops.append('q 1 0 0 1 %s %s cm /C%d Do Q' % (_n(x), _n(y), j))
+            xobjects['C%d' % j] = Ref(num)
+        objects.append(Stream({}, '\n'.join(ops)))
+        objects.append({'Type': Name('Page'), 'Parent': Ref(2),
+                        'MediaBox': [0, 0, float(width), float(height)],
+                        'Resources': {'XObject': xobjects},
+                        'Contents': Ref(len(objects))})
+        kids.append(Ref(len(objects)))
+    objects[1] = {'Type': Name('Pages'), 'Kids': kids, 'Count': len(kids)}
+    _write_objects(dest, [_serialise_object(o) for o in objects])
+
+
+def append_objects(fn, reader, objects):
+    """Add <objects> (a dict of object numbers and values) to the PDF
+    <fn>, which <reader> has read, as an incremental update.  Objects
+    with existing numbers replace the old ones; everything else in the
+    file is left as it was.  New numbers should start at the trailer's
+    Size."""
+    if reader.startxref is None:
+        raise PDFError("%s has no usable cross references to update" % fn)
+    if 'Encrypt' in reader.trailer:
+        raise PDFError("%s is encrypted" % fn)
+    out = []
+    size = len(reader.data)
+    if not reader.data.endswith('\n'):
+        out.append('\n')
+        size += 1
+    offsets = {}
+    for num in sorted(objects):
+        offsets[num] = size
+        s = '%d %d obj\n%s\nendobj\n' % (num, reader.generation(num),
+                                         _serialise_object(objects[num]))
+        out.append(s)
+        size += len(s)
+    out.append('xref\n0 1\n0000000000 65535 f \n')
+    nums = sorted(objects)
+    start = 0
+    while start < len(nums):
+        end = start + 1
+        while end < len(nums) and nums[end] == nums[end - 1] + 1:
+            end += 1
+        out.append('%d %d\n' % (nums[start], end - start))
+        out.extend('%010d %05d n \n' % (offsets[n], reader.generation(n)) for n in nums[start:end])
+        start = end
+    trailer = dict((k, v) for k, v in reader.trailer.iteritems() if k in ('Root', 'Info', 'ID'))
+    trailer['Size'] = max(reader.trailer.get('Size', 0), nums[-1] + 1)
+    trailer['Prev'] = reader.startxref
+    out.append('trailer\n%s\nstartxref\n%d\n%%%%EOF\n' % (serialise(trailer), size))
+    f = open(fn, 'ab')
+    f.write(''.join(out))
+    f.close()
@@ -4,6 +4,7 @@ import os, sys, time, re
 import tempfile
 
 from objavi import config
+from objavi import booklist
 from objavi.book_utils import log, guess_lang, guess_text_dir, make_book_name, decode_html_entities, url_fetch
 from urllib2 import urlopen, HTTPError
 from urlparse import urlsplit
@@ -31,30 +32,11 @@ def get_book_list(server):
     """Ask the server for a list of books.  Floss Manual TWikis keep such a list at
     /bin/view/TWiki/WebLeftBarWebsList?skin=text but it needs a bit of processing
 
-    If BOOK_LIST_CACHE is non-zero, the book list won't be re-fetched
-    in that many seconds, rather it will be read from disk.
+    The lists are cached (see objavi/booklist.py): if BOOK_LIST_CACHE
+    is non-zero, a list older than that many seconds is still used,
+    but refreshed in the background.
     """
-    if config.BOOK_LIST_CACHE:
-        cache_name = os.path.join(config.CACHE_DIR, '%s.booklist' % server)
-        if (os.path.exists(cache_name) and
-            os.stat(cache_name).st_mtime + config.BOOK_LIST_CACHE > time.time()):
-            f = open(cache_name)
-            s = f.read()
-            f.close()
-            return s.split()
-
-    url = config.CHAPTER_URL % (server, 'TWiki', 'WebLeftBarWebsList')
-    #url = 'http://%s/bin/view/TWiki/WebLeftBarWebsList?skin=text' % server
-    #XXX should use lxml
-    log('getting booklist: %s' % url)
-    s = url_fetch(url)
-    items = sorted(x for x in re.findall(r'/bin/view/([\w/]+)/WebHome', s)
-                   if x not in config.IGNORABLE_TWIKI_BOOKS)
-    if config.BOOK_LIST_CACHE:
-        f = open(cache_name, 'w')
-        f.write('\n'.join(items))
-        f.close()
-    return items
+    return booklist.get_book_list(server, 'TWiki')
 
 
 def toc_iterator(server, book):
@@ -234,11 +216,13 @@ class TWikiBook(object):
             filename = self.filepath(self.bookname)
         bz = BookiZip(filename, self.metadata)
 
+        #one cache for this book's chapters, shared with no other book
+        image_cache = ImageCache()
         all_images = set()
         for chapter in self.metadata['spine']:
             contents = self.get_chapter_html(chapter, wrapped=True)
             c = TWikiChapter(self.server, self.book, chapter, contents,
-                             use_cache=use_cache)
+                             use_cache=use_cache, image_cache=image_cache)
             images = c.localise_links()
             c.fix_bad_structure()
             all_images.update(images)
@@ -248,7 +232,7 @@ class TWikiBook(object):
 
         # Add images afterwards, to sift out duplicates
         for image in all_images:
-            imgdata = c.image_cache.read_local_url(image)
+            imgdata = image_cache.read_local_url(image)
             bz.add_to_package(image, image, imgdata) #XXX img ownership: where is it?
 
         bz.finish()
@@ -343,16 +327,18 @@ class TWikiBook(object):
 
 
 class TWikiChapter(BaseChapter):
-    image_cache = ImageCache()
-
     def __init__(self, server, book, chapter_name, html, use_cache=False,
-                 cache_dir=None):
+                 cache_dir=None, image_cache=None):
         self.server = server
         self.book = book
         self.name = chapter_name
         self.use_cache = use_cache
-        if cache_dir:
-            self.image_cache = ImageCache(cache_dir)
+        if image_cache is None:
+            if cache_dir:
+                image_cache = ImageCache(cache_dir)
+            else:
+                image_cache = ImageCache()
+        self.image_cache = image_cache
         self._loadtree(html)
 
     def localise_links(self):
@@ -395,7 +381,7 @@ class Author(object):
 class ImportedChapter(TWikiChapter):
     """Used for git import"""
     def __init__(self, lang, book, chapter_name, text, author, email, date, server=None,
-                 use_cache=False, cache_dir=None):
+                 use_cache=False, cache_dir=None, image_cache=None):
         self.lang = lang
         self.book = book
         self.name = chapter_name
@@ -405,8 +391,12 @@ class ImportedChapter(TWikiChapter):
             server = '%s.flossmanuals.net' % lang
         self.server = server
         self.use_cache = use_cache
-        if cache_dir:
-            self.image_cache = ImageCache(cache_dir)
+        if image_cache is None:
+            if cache_dir:
+                image_cache = ImageCache(cache_dir)
+            else:
+                image_cache = ImageCache()
+        self.image_cache = image_cache
         #XXX is text html-wrapped?
         self._loadtree(text)
 
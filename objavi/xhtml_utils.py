@@ -6,12 +6,15 @@ from lxml import etree
 
 import os
 import re
+import zlib
+from hashlib import sha1
 
 from urlparse import urlsplit
+from urllib2 import HTTPError
 
 from objavi.constants import XHTMLNS, XHTML
-from objavi.config import IMG_CACHE, MARKER_CLASS_SPLIT, MARKER_CLASS_INFO
-from objavi.book_utils import log, url_fetch, HTTPError
+from objavi.config import IMG_CACHE, CHAPTER_CACHE, MARKER_CLASS_SPLIT, MARKER_CLASS_INFO
+from objavi.book_utils import log, url_fetch, note_cache, atomic_write, DEBUG
 
 ADJUST_HEADING_WEIGHT = False
 
@@ -36,6 +39,25 @@ XML_DEC = '<?xml version="1.0" encoding="UTF-8"?>\n'
 IMG_PREFIX = 'static/'
 
 utf8_html_parser = lxml.html.HTMLParser(encoding='utf-8')
+#for reloading trees that were serialised as xml; still makes HtmlElements
+cached_tree_parser = lxml.html.XHTMLParser(encoding='utf-8')
+
+#Change this whenever parsing or cleaning changes what a chapter tree
+#looks like, so that stale trees in the chapter cache are ignored.
+CHAPTER_CACHE_VERSION = '3'
+
+def normalise_newlines(root):
+    """Turn the CRLF and CR line endings in the text and attributes
+    under <root> into LF, in place.  Reloaded as xml, a tree keeps its
+    CRs but serialises them as &#13;, even as html."""
+    for e in root.iter():
+        if e.text and '\r' in e.text and not isinstance(e, etree._Entity):
+            e.text = e.text.replace('\r\n', '\n').replace('\r', '\n')
+        if e.tail and '\r' in e.tail:
+            e.tail = e.tail.replace('\r\n', '\n').replace('\r', '\n')
+        for k, v in e.items():
+            if '\r' in v:
+                e.set(k, v.replace('\r\n', '\n').replace('\r', '\n'))
 
 def empty_html_tree():
     return lxml.html.document_fromstring('<html><body></body></html>').getroottree()
@@ -86,7 +108,9 @@ class ImageCache(object):
 
         if use_cache and os.path.exists(self.cache_dir + target):
             log("used cache for %s" % target)
+            note_cache('image', True)
             return target
+        note_cache('image', False)
 
         try:
             data = url_fetch(url)
@@ -103,6 +127,95 @@ class ImageCache(object):
         return target
 
 
+class ChapterCache(object):
+    """Keep parsed chapter trees on disk, so that the same chapter
+    needn't be parsed (and cleaned) again by another output mode or
+    another job.
+
+    Entries are keyed by the SHA1 of the chapter's source html, the
+    name of the processing stage that produced the tree, and
+    CHAPTER_CACHE_VERSION.  They are stored as compressed xml, which
+    libxml2 reloads much faster than it parses html.  Writes go via a
+    temporary file and a rename, so concurrent jobs never see half an
+    entry.
+    """
+    def __init__(self, cache_dir=CHAPTER_CACHE, version=CHAPTER_CACHE_VERSION):
+        self.cache_dir = cache_dir
+        self.version = '%s-%s' % (version, '.'.join(str(x) for x in etree.LXML_VERSION))
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, html, stage):
+        if isinstance(html, unicode):
+            html = html.encode('utf-8')
+        digest = sha1(html).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2],
+                            '%s-%s-%s.xml.gz' % (digest, stage, self.version))
+
+    def load(self, html, stage):
+        """Return the root element of the cached tree for html at the
+        named stage, or None"""
+        fn = self._path(html, stage)
+        try:
+            f = open(fn)
+            s = f.read()
+            f.close()
+            root = etree.fromstring(zlib.decompress(s), parser=cached_tree_parser)
+        except IOError:
+            return None
+        except (zlib.error, etree.XMLSyntaxError), e:
+            log("ignoring damaged chapter cache entry %s (%s)" % (fn, e))
+            return None
+        return root
+
+    def save(self, html, stage, tree):
+        """Cache <tree>, first normalising its line endings (see
+        normalise_newlines) so that it is the same as the tree load()
+        will return."""
+        fn = self._path(html, stage)
+        try:
+            root = tree.getroot()
+        except AttributeError:
+            root = tree
+        normalise_newlines(root)
+        # the html parser keeps xmlns as an ordinary attribute, but
+        # reloaded as xml it would put the elements in a namespace.
+        for e in root.iter(tag=etree.Element):
+            for k in e.keys():
+                if k.startswith('xmlns'):
+                    log("not caching chapter %s: it has an %s attribute" % (fn, k))
+                    return
+        try:
+            data = zlib.compress(etree.tostring(root, encoding='utf-8'), 1)
+            # check it can be reloaded (stray control characters, for
+            # instance, survive html parsing but not xml).
+            etree.fromstring(zlib.decompress(data), parser=cached_tree_parser)
+        except (ValueError, etree.XMLSyntaxError), e:
+            log("not caching chapter %s: %s" % (fn, e))
+            return
+        try:
+            atomic_write(fn, data)
+        except (IOError, OSError), e:
+            log("could not save chapter cache entry %s (%s)" % (fn, e))
+
+    def get(self, html, stage, make_tree):
+        """Return the cached root element if there is one, otherwise
+        call make_tree() and cache and return its result."""
+        tree = self.load(html, stage)
+        if tree is not None:
+            self.hits += 1
+            note_cache('chapter', True)
+            return tree
+        self.misses += 1
+        note_cache('chapter', False)
+        tree = make_tree()
+        self.save(html, stage, tree)
+        try:
+            return tree.getroot()
+        except AttributeError:
+            return tree
+
+
 class BaseChapter(object):
     parser = utf8_html_parser
     def as_html(self):
@@ -151,7 +264,11 @@ class BaseChapter(object):
                                       add_nofollow=False
                                       )
 
+    cleaned = False
     def remove_bad_tags(self):
+        if self.cleaned:
+            return
+        self.cleaned = True
         #for e in self.tree.iter():
         #    if not e.tag in OK_TAGS:
         #        log('found bad tag %s' % e.tag)
@@ -243,11 +360,31 @@ class BaseChapter(object):
 
 class EpubChapter(BaseChapter):
     def __init__(self, server, book, chapter_name, html, use_cache=False,
-                 cache_dir=None):
+                 cache_dir=None, chapter_cache=None):
+        """If a ChapterCache is given, the tree is taken from it
+        already cleaned (i.e., remove_bad_tags() has been applied)."""
         self.server = server
         self.book = book
         self.name = chapter_name
+        if chapter_cache is not None:
+            self.tree = chapter_cache.get(html, 'epub-clean',
+                                          lambda: self._load_and_clean(html))
+            self.cleaned = True
+        else:
+            self._load(html)
+
+    def _load(self, html):
         self._loadtree(html)
+        #as the chapter cache would give it
+        root = self.tree
+        if hasattr(root, 'getroot'):
+            root = root.getroot()
+        normalise_newlines(root)
+
+    def _load_and_clean(self, html):
+        self._load(html)
+        self.remove_bad_tags()
+        return self.tree
 
     def prepare_for_epub(self):
         """Shift all headings down 2 places."""
@@ -310,6 +447,11 @@ def split_tree(tree):
         elif klass == MARKER_CLASS_INFO:
             hr.getparent().remove(hr)
 
+    ID = 'unidentified-front-matter'
+    title = None
+    if not stacks:
+        return [Section(root, ID, title)]
+
     iterstacks = iter(stacks)
 
     src = root
@@ -319,8 +461,6 @@ def split_tree(tree):
     marker = stack[-1]
 
     chapters = []
-    ID = 'unidentified-front-matter'
-    title = None
     try:
         while True:
             for e in src:
@@ -356,6 +496,60 @@ def split_tree(tree):
     return chapters
 
 
+class TreeTransform(object):
+    """Gather element handlers from several processing steps so that
+    they can all be applied in a single traversal of a tree.
+
+    Handlers are called with each matching element, in document
+    order.  They should not alter the structure of the tree, because
+    it is being iterated over.  Anything that does should be done by a
+    finisher, which is called with no arguments after the traversal.
+    Finishers run in increasing order of their <order> argument, and
+    in registration order when that is equal.
+    """
+    def __init__(self):
+        self.handlers = {}
+        self.any_handlers = []
+        self.finishers = []
+
+    def add_handler(self, tags, handler):
+        """Call handler(element) for elements with a tag in <tags>, or
+        for every element if <tags> is None."""
+        if tags is None:
+            self.any_handlers.append(handler)
+        else:
+            for tag in tags:
+                self.handlers.setdefault(tag, []).append(handler)
+
+    def add_finisher(self, finisher, order=0):
+        self.finishers.append((order, len(self.finishers), finisher))
+
+    def pending(self):
+        return bool(self.handlers or self.any_handlers or self.finishers)
+
+    def apply(self, tree):
+        """Walk the tree once, then run the finishers.  The registered
+        handlers and finishers are forgotten afterwards."""
+        try:
+            root = tree.getroot()
+        except AttributeError:
+            root = tree
+
+        handlers = self.handlers
+        any_handlers = self.any_handlers
+        if handlers or any_handlers:
+            for e in root.iter():
+                for h in any_handlers:
+                    h(e)
+                for h in handlers.get(e.tag, ()):
+                    h(e)
+
+        finishers = sorted(self.finishers)
+        self.__init__()
+        for order, n, finisher in finishers:
+            finisher()
+
+
 def localise_local_links(doc, old_filename=''):
     """Xinha produces document local links (e.g., for footnotes) in
     the form 'filename#local_anchor', which are broken if the filename
@@ -373,12 +567,33 @@ def localise_local_links(doc, old_filename=''):
     altering the ID of elements that aren't locally linked, as these
     might be used for CSS or external links.
     """
-    old_prefix = (old_filename + '#').encode('utf-8')
-    targets = []
-    transformed_ids = {}
+    try:
+        root = doc.getroot()
+    except AttributeError:
+        root = doc
+    transform = TreeTransform()
+    add_local_link_handlers(transform, {root: old_filename})
+    transform.apply(root)
+
 
-    #loop 1: find links and shortlist elements with ID
-    for e in doc.iter():
+def add_local_link_handlers(transform, chapters, order=0):
+    """Have <transform> do localise_local_links() for each of several
+    chapters that have been joined into one tree.  <chapters> maps the
+    first element of each chapter to its old filename, and a chapter
+    runs in document order until the next one starts.
+
+    Links are rewritten as they are found, but the targets they point
+    to may come earlier in the chapter, so the IDs are changed by a
+    finisher.
+    """
+    found = []
+    def collect(e):
+        old_filename = chapters.get(e)
+        if old_filename is not None:
+            found.append((old_filename, (old_filename + '#').encode('utf-8'), [], {}))
+        elif not found:
+            return
+        old_filename, old_prefix, targets, transformed_ids = found[-1]
         if e.tag == 'a':
             href = e.get('href')
             if href and href.startswith(old_prefix):
@@ -389,22 +604,24 @@ def localise_local_links(doc, old_filename=''):
             name = e.get('name')
             if name:
                 targets.append(e)
-                continue
+                return
         ID = e.get('id')
         if ID is not None:
             targets.append(e)
 
-    log("transforming these IDs in chapter %s: %s" % (old_filename, transformed_ids))
-
-    for e in targets:
-        old_id = e.get('id')
-        if old_id is None and e.tag == 'a':
-            old_id = e.get('name')
-        if old_id is None:
-            continue
-        if old_id in transformed_ids:
-            new_id = transformed_ids[old_id]
-            e.set('id', new_id)
-            if e.tag == 'a':
-                e.set('name', new_id)
-
+    def rename_targets():
+        for old_filename, old_prefix, targets, transformed_ids in found:
+            log(lambda: "transforming these IDs in chapter %s: %s" %
+                (old_filename, transformed_ids), level=DEBUG)
+            for e in targets:
+                old_id = e.get('id')
+                if old_id is None and e.tag == 'a':
+                    old_id = e.get('name')
+                if old_id in transformed_ids:
+                    new_id = transformed_ids[old_id]
+                    e.set('id', new_id)
+                    if e.tag == 'a':
+                        e.set('name', new_id)
+
+    transform.add_handler(None, collect)
+    transform.add_finisher(rename_targets, order)
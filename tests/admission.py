@@ -0,0 +1,75 @@
+#!/usr/bin/python
+
+"""Check that a job's place among the running jobs is given up when
+the job ends, whether it finishes or fails.
+
+A job admitted with admission.admitted() raises an exception part way
+through.  Afterwards the shared state must no longer list it as
+running: its process is still alive, so nothing else would notice
+that the job is over.  A job that finishes and releases its own
+ticket, as objavi.cgi's Context.finish does, must be released once.
+
+Run from the objavi root: python tests/admission.py
+"""
+
+from __future__ import with_statement
+
+import os, sys
+import tempfile
+import shutil
+sys.path.insert(0, os.path.abspath('.'))
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from objavi import config
+from objavi import admission
+
+class FakeBook(object):
+    bookname = 'test-book'
+    manifest = {}
+    store = None
+    def notify_watcher(self, message):
+        pass
+
+class Failure(Exception):
+    pass
+
+def running():
+    f = open(os.path.join(config.ADMISSION_DIR, 'jobs.json'))
+    state = json.load(f)
+    f.close()
+    return state['running']
+
+def main():
+    tmp = tempfile.mkdtemp()
+    try:
+        config.ADMISSION_DIR = os.path.join(tmp, 'admission')
+        config.JOB_STORE = os.path.join(tmp, 'jobs.sqlite')
+        config.ADMISSION_POLL_INTERVAL = 0.01
+        config.ADMISSION_MAX_WAIT = 0.5
+        pid = str(os.getpid())
+
+        try:
+            with admission.admitted(FakeBook(), 'book', 2) as ticket:
+                assert pid in running(), "the job was not admitted"
+                raise Failure()
+        except Failure:
+            pass
+        assert pid not in running(), "a failed job kept its place"
+        assert ticket.metrics is not None
+        print "failed job: ok"
+
+        with admission.admitted(FakeBook(), 'book', 2) as ticket:
+            assert pid in running(), "the next job was not admitted"
+            metrics = ticket.release()
+        assert pid not in running(), "a finished job kept its place"
+        assert ticket.release() is metrics, "releasing twice measured twice"
+        print "finished job: ok"
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,379 @@
+#!/usr/bin/python
+
+"""Time the stages of making books from the epubs in
+tests/epub-examples, and measure their peak memory.
+
+Each epub is imported as espri does it (Epub.load_file ->
+make_bookizip), then made into an epub, templated html, and a book
+pdf.  wkhtmltopdf, pdfedit, pdftk, gs and pdfinfo are replaced by the
+stand-ins in tests/fake_pdf_tools.py, so nothing is rendered or
+fetched and the pdf stages measure objavi's own work.
+
+The chapter cache is on, as it is in service, but starts empty for
+each run, so the first stage to parse a chapter pays for it and the
+later ones (and later repeats) find it cached.  --no-chapter-cache
+measures the parsing every time.
+
+Each of espri, epub, html and pdf runs in a fresh process, so one
+stage's garbage doesn't count against the next.  Peak memory is the
+process's high water mark (VmHWM), reset at the start of each stage
+where the kernel allows it.
+
+The results are JSON.  Save them as a baseline with --output, and
+later compare against it with --compare, which lists the stages that
+got slower or bigger and exits with status 1 if there are any.
+
+Run from the objavi root:
+
+  python tests/benchmark.py [options] [epub names]
+"""
+
+import os, sys
+import re
+import time
+import shutil
+import tempfile
+import platform
+import traceback
+from optparse import OptionParser
+sys.path.insert(0, os.path.abspath('.'))
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+import lxml.etree
+
+from objavi import config
+from objavi.espri import epub_to_bookizip
+from objavi.fmbook import Book
+from objavi.pdf import concat_pdfs
+from objavi.book_utils import make_book_name
+
+SERVER = 'booki.flossmanuals.net'
+EPUB_DIR = 'tests/epub-examples'
+FAKE_TOOLS = os.path.abspath('tests/fake_pdf_tools.py')
+TOOL_NAMES = ('wkhtmltopdf', 'pdfedit', 'pdftk', 'gs', 'pdfinfo')
+
+#a stage is reported as a regression if it is this much worse...
+TIME_TOLERANCE = 0.15
+MEMORY_TOLERANCE = 0.10
+#...and worse by at least this much (seconds, bytes)
+TIME_NOISE = 0.05
+MEMORY_NOISE = 2 * 1024 * 1024
+
+#set by run_benchmark, for the stages' books
+CHAPTER_CACHE_DIR = None
+
+
+def install_fake_tools(bindir):
+    """Put scripts that run the stand-ins at the front of PATH."""
+    for name in TOOL_NAMES:
+        fn = os.path.join(bindir, name)
+        f = open(fn, 'w')
+        f.write('#!/bin/sh\nexec "%s" "%s" %s "$@"\n' % (sys.executable, FAKE_TOOLS, name))
+        f.close()
+        os.chmod(fn, 0755)
+    os.environ['PATH'] = bindir + os.pathsep + os.environ.get('PATH', '')
+    config.WKHTMLTOPDF = 'wkhtmltopdf'
+    config.WKHTMLTOPDF_EXTRA_COMMANDS = []
+
+
+def reset_peak():
+    """Start a new memory high water mark, if the kernel lets us."""
+    try:
+        f = open('/proc/self/clear_refs', 'w')
+        f.write('5')
+        f.close()
+        return True
+    except IOError:
+        return False
+
+def peak_memory():
+    """The high water mark of this process, in bytes."""
+    try:
+        f = open('/proc/self/status')
+        for line in f:
+            if line.startswith('VmHWM:'):
+                f.close()
+                return int(line.split()[1]) * 1024
+        f.close()
+    except IOError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Stages(object):
+    """Collects the time and peak memory of a sequence of stages, and
+    the books they open, to be cleaned up afterwards."""
+    def __init__(self):
+        self.results = {}
+        self.books = []
+
+    def open_book(self, bookid, bookname, **kwargs):
+        book = Book(bookid, SERVER, bookname, max_age=1e9, **kwargs)
+        if book.chapter_cache is not None:
+            book.chapter_cache.cache_dir = CHAPTER_CACHE_DIR
+        self.books.append(book)
+        return book
+
+    def run(self, name, fn, *args):
+        reset_peak()
+        start = time.time()
+        ret = fn(*args)
+        self.results[name] = {'time': time.time() - start,
+                              'peak_memory': peak_memory()}
+        return ret
+
+
+def stage_espri(stages, epubfile, bookid):
+    zipname = stages.run('espri', epub_to_bookizip, epubfile, bookid)
+    #where fetch_zip will look for it
+    os.rename(os.path.join(config.BOOKI_BOOK_DIR, zipname),
+              os.path.join(config.BOOKI_BOOK_DIR, make_book_name(bookid, SERVER, '.zip')))
+
+def stage_epub(stages, epubfile, bookid):
+    def make():
+        book = stages.open_book(bookid, bookid + '.epub')
+        book.make_epub()
+    stages.run('epub', make)
+
+def stage_html(stages, epubfile, bookid):
+    def make():
+        book = stages.open_book(bookid, bookid + '-html')
+        book.make_templated_html()
+    stages.run('html', make)
+
+def stage_pdf(stages, epubfile, bookid):
+    """The steps of objavi.cgi's build_pdf in book mode."""
+    def load():
+        page_settings = dict(config.PAGE_SIZE_DATA[config.DEFAULT_SIZE])
+        book = stages.open_book(bookid, bookid + '.pdf', page_settings=page_settings)
+        book.load_book()
+        return book
+    def prepare():
+        book.fake_no_break_after()
+        book.add_css(None, 'book')
+        book.add_section_titles()
+        book.apply_transforms()
+    def concat():
+        concat_pdfs(book.pdf_file, book.preamble_pdf_file,
+                    book.body_pdf_file, book.tail_pdf_file,
+                    book.isbn_pdf_file)
+
+    book = stages.run('pdf_load', load)
+    stages.run('pdf_prepare', prepare)
+    stages.run('pdf_body', book.make_body_pdf)
+    stages.run('pdf_preamble', book.make_preamble_pdf)
+    stages.run('pdf_end_matter', book.make_end_matter_pdf)
+    stages.run('pdf_concat', concat)
+    stages.run('pdf_embed_fonts', book.embed_fonts)
+    book.publish_pdf()
+
+STAGE_GROUPS = (stage_espri, stage_epub, stage_html, stage_pdf)
+
+
+def run_in_child(fn, verbose, *args):
+    """Run fn(stages, *args) in a forked process and return the
+    stage results, or {'error': ...} if it failed."""
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        if not verbose:
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, 1)
+            os.dup2(devnull, 2)
+        stages = Stages()
+        try:
+            fn(stages, *args)
+        except Exception, e:
+            stages.results['error'] = '%s: %s' % (e.__class__.__name__, e)
+            if verbose:
+                traceback.print_exc()
+        for book in stages.books:
+            book.cleanup()
+        os.write(w, json.dumps(stages.results))
+        os.close(w)
+        os._exit(0)
+    os.close(w)
+    data = []
+    while True:
+        s = os.read(r, 65536)
+        if not s:
+            break
+        data.append(s)
+    os.close(r)
+    os.waitpid(pid, 0)
+    try:
+        return json.loads(''.join(data))
+    except ValueError:
+        return {'error': 'the benchmark process died'}
+
+def benchmark_book(epubfile, repeat, verbose):
+    """Time each stage <repeat> times, keeping the best of each.  If
+    a group of stages fails, the error is kept under 'errors' and the
+    other groups carry on (unless it is the import that failed)."""
+    bookid = re.sub(r'\W', '', os.path.basename(epubfile)[:-5])
+    results = {}
+    errors = {}
+    for i in range(repeat):
+        for group in STAGE_GROUPS:
+            if group.__name__ in errors:
+                continue
+            r = run_in_child(group, verbose, epubfile, bookid)
+            error = r.pop('error', None)
+            for name, v in r.items():
+                best = results.setdefault(name, v)
+                best['time'] = min(best['time'], v['time'])
+                best['peak_memory'] = min(best['peak_memory'], v['peak_memory'])
+            if error is not None:
+                errors[group.__name__] = error
+                results['errors'] = errors
+                if group is stage_espri:
+                    return results
+        for fn in os.listdir(config.BOOKI_BOOK_DIR):
+            os.unlink(os.path.join(config.BOOKI_BOOK_DIR, fn))
+    return results
+
+def run_benchmark(epubs, repeat=1, verbose=False, chapter_cache=True):
+    global CHAPTER_CACHE_DIR
+    tmp = tempfile.mkdtemp(prefix='objavi-benchmark-')
+    config.BOOKI_BOOK_DIR = os.path.join(tmp, 'zips')
+    config.PUBLISH_DIR = os.path.join(tmp, 'books')
+    config.KEEP_TEMP_FILES = False
+    config.USE_CHAPTER_CACHE = chapter_cache
+    CHAPTER_CACHE_DIR = os.path.join(tmp, 'chapters')
+    for d in ('zips', 'books', 'bin'):
+        os.mkdir(os.path.join(tmp, d))
+    install_fake_tools(os.path.join(tmp, 'bin'))
+    try:
+        books = {}
+        for fn in epubs:
+            name = os.path.basename(fn)
+            sys.stderr.write('%s... ' % name)
+            books[name] = benchmark_book(fn, repeat, verbose)
+            sys.stderr.write('%s\n' % ('errors' in books[name] and 'failed' or 'ok'))
+    finally:
+        shutil.rmtree(tmp)
+
+    totals = {}
+    for stages in books.values():
+        for name, v in stages.items():
+            if name == 'errors':
+                continue
+            t = totals.setdefault(name, {'time': 0.0, 'peak_memory': 0, 'books': 0})
+            t['time'] += v['time']
+            t['peak_memory'] = max(t['peak_memory'], v['peak_memory'])
+            t['books'] += 1
+
+    return {'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'host': platform.node(),
+            'python': platform.python_version(),
+            'lxml': lxml.etree.__version__,
+            'repeat': repeat,
+            'chapter_cache': chapter_cache,
+            'memory_reset': reset_peak(),
+            'books': books,
+            'totals': totals,
+            }
+
+
+def compare(baseline, current):
+    """Return a list of (book, stage, measure, old, new) for the
+    stages that are worse than in the baseline."""
+    worse = []
+    def check(book, stage, old, new):
+        for measure, tolerance, noise in (('time', TIME_TOLERANCE, TIME_NOISE),
+                                          ('peak_memory', MEMORY_TOLERANCE, MEMORY_NOISE)):
+            a, b = old[measure], new[measure]
+            if b > a * (1 + tolerance) and b - a > noise:
+                worse.append((book, stage, measure, a, b))
+
+    for book, stages in sorted(current['books'].items()):
+        old_stages = baseline['books'].get(book, {})
+        old_errors = old_stages.get('errors', {})
+        for group, error in sorted(stages.get('errors', {}).items()):
+            if group not in old_errors:
+                worse.append((book, group, 'error', None, error))
+        for stage, v in sorted(stages.items()):
+            if stage != 'errors' and stage in old_stages:
+                check(book, stage, old_stages[stage], v)
+    for stage, v in sorted(current['totals'].items()):
+        old = baseline['totals'].get(stage)
+        if old is not None and old['books'] == v['books']:
+            check('TOTAL', stage, old, v)
+    return worse
+
+def print_report(results, baseline=None):
+    totals = results['totals']
+    old_totals = (baseline or {}).get('totals', {})
+    print '%-16s %6s %10s %10s' % ('stage', 'books', 'seconds', 'peak MB'),
+    if baseline:
+        print '%10s %10s' % ('was', 'was'),
+    print
+    for stage in sorted(totals, key=lambda x: -totals[x]['time']):
+        t = totals[stage]
+        print '%-16s %6d %10.2f %10.1f' % (stage, t['books'], t['time'],
+                                           t['peak_memory'] / 1048576.0),
+        old = old_totals.get(stage)
+        if old and old['books'] == t['books']:
+            print '%10.2f %10.1f' % (old['time'], old['peak_memory'] / 1048576.0),
+        print
+    for book, v in sorted(results['books'].items()):
+        for group, error in sorted(v.get('errors', {}).items()):
+            print 'FAILED %s %s: %s' % (book, group, error)
+
+
+def main():
+    parser = OptionParser(usage=__doc__)
+    parser.add_option('-o', '--output', help='save the results (as JSON) in this file')
+    parser.add_option('-c', '--compare', metavar='BASELINE',
+                      help='compare the results with those in this file')
+    parser.add_option('-n', '--repeat', type='int', default=1,
+                      help='run each stage this many times and keep the best')
+    parser.add_option('-v', '--verbose', action='store_true',
+                      help="show objavi's log messages")
+    parser.add_option('--no-chapter-cache', action='store_false', dest='chapter_cache',
+                      default=True, help='parse every chapter in every stage')
+    options, args = parser.parse_args()
+
+    if args:
+        epubs = [os.path.join(EPUB_DIR, x) for x in args]
+    else:
+        epubs = [os.path.join(EPUB_DIR, x) for x in sorted(os.listdir(EPUB_DIR))
+                 if x.endswith('.epub')]
+
+    results = run_benchmark(epubs, options.repeat, options.verbose, options.chapter_cache)
+    if options.output:
+        f = open(options.output, 'w')
+        json.dump(results, f, indent=1, sort_keys=True)
+        f.close()
+    elif not options.compare:
+        print json.dumps(results, indent=1, sort_keys=True)
+
+    if options.compare:
+        f = open(options.compare)
+        baseline = json.load(f)
+        f.close()
+        if baseline.get('chapter_cache', False) != results['chapter_cache']:
+            print 'WARNING: the baseline was run with the chapter cache %s' % (
+                baseline.get('chapter_cache', False) and 'on' or 'off')
+        print_report(results, baseline)
+        worse = compare(baseline, results)
+        for book, stage, measure, old, new in worse:
+            if measure == 'error':
+                print 'NEW FAILURE %s %s: %s' % (book, stage, new)
+            elif measure == 'time':
+                print 'SLOWER %s %s: %.3fs -> %.3fs' % (book, stage, old, new)
+            else:
+                print 'BIGGER %s %s: %.1fMB -> %.1fMB' % (book, stage, old / 1048576.0,
+                                                          new / 1048576.0)
+        if worse:
+            sys.exit(1)
+    elif options.output:
+        print_report(results)
+
+if __name__ == '__main__':
+    main()
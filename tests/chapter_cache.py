@@ -0,0 +1,83 @@
+#!/usr/bin/python
+
+"""Check that a chapter from the chapter cache is the same as one
+freshly parsed, so that books don't depend on what is in the cache.
+
+Each html file in the epubs in tests/epub-examples, and a chapter
+full of carriage returns, is parsed (as Book.get_tree_by_id and
+EpubChapter do it) into an empty cache and then reloaded from it.
+The two trees must serialise the same way, as xml and as html.
+
+Run from the objavi root: python tests/chapter_cache.py
+"""
+
+import os, sys
+import zipfile
+import tempfile
+import shutil
+sys.path.insert(0, os.path.abspath('.'))
+
+import lxml.html
+from lxml import etree
+
+from objavi.xhtml_utils import ChapterCache, EpubChapter, utf8_html_parser
+from objavi.xhtml_utils import normalise_newlines
+
+EPUB_DIR = 'tests/epub-examples'
+
+CR_CHAPTER = ('<html><head><title>one\r\ntwo</title><style>p {}\r</style></head>\r\n'
+              '<body><h1 title="a\r\nb">Carriage\rreturns</h1>\r\n'
+              '<p>text\r\nand <b>tail</b>\r\n</p><pre>x\r\ny</pre></body></html>')
+
+def parse_html(html):
+    """As Book._parse_html does it."""
+    root = lxml.html.document_fromstring(html, parser=utf8_html_parser)
+    normalise_newlines(root)
+    return root
+
+def clean_epub_chapter(html):
+    """As EpubChapter does it for the 'epub-clean' stage."""
+    chapter = EpubChapter.__new__(EpubChapter)
+    chapter.server = chapter.book = None
+    chapter.name = 'test'
+    return chapter._load_and_clean(html)
+
+def compare(cache_dir, html, stage, make):
+    miss = ChapterCache(cache_dir).get(html, stage, lambda: make(html))
+    hit = ChapterCache(cache_dir).load(html, stage)
+    if hit is None:
+        #not cacheable (xmlns attributes, say); nothing to compare
+        return False
+    assert etree.tostring(hit) == etree.tostring(miss), "xml differs"
+    assert etree.tostring(hit, method='html') == etree.tostring(miss, method='html'), (
+        "html differs")
+    return True
+
+def main():
+    tmp = tempfile.mkdtemp()
+    try:
+        for stage, make in (('html', parse_html), ('epub-clean', clean_epub_chapter)):
+            assert compare(tmp, CR_CHAPTER, stage, make), "the CR chapter wasn't cached"
+        print "carriage returns: ok"
+
+        n = 0
+        for fn in sorted(os.listdir(EPUB_DIR)):
+            if not fn.endswith('.epub'):
+                continue
+            z = zipfile.ZipFile(os.path.join(EPUB_DIR, fn))
+            for name in z.namelist():
+                if name.rsplit('.', 1)[-1].lower() not in ('html', 'xhtml', 'htm'):
+                    continue
+                html = z.read(name)
+                for stage, make in (('html', parse_html), ('epub-clean', clean_epub_chapter)):
+                    try:
+                        n += compare(tmp, html, stage, make)
+                    except AssertionError, e:
+                        raise AssertionError("%s %s (%s): %s" % (fn, name, stage, e))
+            z.close()
+        print "%d chapters from the example epubs: ok" % n
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+#!/usr/bin/python
+
+"""Make several books at once, in threads in one process, and check
+that each comes out the same as when it is made alone, and that the
+process environment and working directory are left untouched.
+
+Bookizips are made from the html and images in the epubs in
+tests/epub-examples, and put where fetch_zip's cache will find them,
+so nothing is fetched.  Each is made into an epub, templated html and
+a book mode pdf.  The pdf tools are the stand-ins in
+tests/fake_pdf_tools.py, installed as tests/benchmark.py does.
+
+Run from the objavi root: python tests/concurrent_books.py [N]
+"""
+
+import os, sys
+import time
+import zipfile
+import gzip
+import tempfile
+import shutil
+import threading
+from hashlib import md5
+sys.path.insert(0, os.path.abspath('.'))
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+import lxml.html
+
+from objavi import config
+from objavi.constants import DC
+from objavi.fmbook import Book
+from objavi.book_utils import make_book_name
+from benchmark import install_fake_tools
+
+SERVER = 'booki.flossmanuals.net'
+EPUB_DIR = 'tests/epub-examples'
+
+def make_bookizips(n):
+    """Write bookizips in the form Booki exports them, using the html
+    and images of the first <n> example epubs."""
+    bookids = []
+    for i, fn in enumerate(sorted(os.listdir(EPUB_DIR))[:n]):
+        bookid = 'Concurrent%d' % i
+        src = zipfile.ZipFile(os.path.join(EPUB_DIR, fn))
+        zfn = os.path.join(config.BOOKI_BOOK_DIR, make_book_name(bookid, SERVER, '.zip'))
+        z = zipfile.ZipFile(zfn, 'w', zipfile.ZIP_DEFLATED)
+        z.writestr('mimetype', 'application/x-booki+zip')
+        manifest = {}
+        spine = []
+        toc = []
+        for name in src.namelist():
+            base = os.path.basename(name)
+            ext = base.rsplit('.', 1)[-1].lower()
+            if ext in ('html', 'xhtml', 'htm'):
+                try:
+                    tree = lxml.html.document_fromstring(src.read(name))
+                except Exception:
+                    continue
+                for c in tree.xpath('//comment()'):
+                    c.getparent().remove(c)
+                ID = 'chapter%d' % len(spine)
+                url = ID + '.html'
+                z.writestr(url, lxml.html.tostring(tree, encoding='utf-8'))
+                manifest[ID] = {'url': url, 'mimetype': 'text/html'}
+                spine.append(ID)
+                toc.append({'title': '%s %s' % (fn, base), 'url': url, 'type': 'chapter'})
+            elif ext in ('png', 'jpg', 'jpeg', 'gif'):
+                url = 'static/%s' % base
+                z.writestr(url, src.read(name))
+                manifest[base] = {'url': url, 'mimetype': 'image/' + ext}
+        z.writestr('info.json', json.dumps({
+            'version': 1,
+            'spine': spine,
+            'TOC': toc,
+            'manifest': manifest,
+            'metadata': {DC: {'title': {'': [fn]},
+                              'language': {'': ['en']},
+                              'identifier': {'': ['http://booki.cc/%s/' % bookid]},
+                              }},
+            }))
+        z.close()
+        src.close()
+        bookids.append(bookid)
+    return bookids
+
+def digest_epub(fn):
+    """Hashes of the epub's members, leaving out the ones that are
+    meant to differ each time (the identifier and dates)."""
+    z = zipfile.ZipFile(fn)
+    d = {}
+    for name in z.namelist():
+        if name.endswith('.opf') or name.endswith('.ncx'):
+            continue
+        d[name] = md5(z.read(name)).hexdigest()
+    z.close()
+    return d
+
+def digest_html(dirname):
+    d = {}
+    for root, dirs, files in os.walk(dirname):
+        for fn in files:
+            path = os.path.join(root, fn)
+            if fn.endswith('.gz'):
+                #the gzip header has a timestamp
+                f = gzip.open(path)
+            else:
+                f = open(path)
+            d[os.path.relpath(path, dirname)] = md5(f.read()).hexdigest()
+            f.close()
+    return d
+
+def digest_file(fn):
+    f = open(fn, 'rb')
+    d = md5(f.read()).hexdigest()
+    f.close()
+    return d
+
+def make(bookid, tag, results):
+    """Make an epub, templated html and book pdf of the book."""
+    out = {}
+    b = Book(bookid, SERVER, '%s-%s.epub' % (bookid, tag), max_age=1e9)
+    try:
+        b.make_epub()
+        out['epub'] = digest_epub(b.publish_file)
+    finally:
+        b.cleanup()
+
+    b = Book(bookid, SERVER, '%s-%s' % (bookid, tag), max_age=1e9)
+    try:
+        b.make_templated_html()
+        out['html'] = digest_html(b.publish_file)
+    finally:
+        b.cleanup()
+
+    #as objavi.cgi's build_pdf does it in book mode
+    page_settings = dict(config.PAGE_SIZE_DATA[config.DEFAULT_SIZE])
+    b = Book(bookid, SERVER, '%s-%s.pdf' % (bookid, tag), max_age=1e9,
+             page_settings=page_settings)
+    try:
+        b.load_book()
+        b.fake_no_break_after()
+        b.add_css(None, 'book')
+        b.add_section_titles()
+        b.make_book_pdf()
+        b.publish_pdf()
+        out['pdf'] = digest_file(b.publish_file)
+    finally:
+        b.cleanup()
+    results[bookid] = out
+
+def main(n=6):
+    tmp = tempfile.mkdtemp()
+    config.BOOKI_BOOK_DIR = os.path.join(tmp, 'zips')
+    config.PUBLISH_DIR = os.path.join(tmp, 'books')
+    config.KEEP_TEMP_FILES = False
+    config.USE_CHAPTER_CACHE = False
+    os.mkdir(config.BOOKI_BOOK_DIR)
+    os.mkdir(config.PUBLISH_DIR)
+    os.mkdir(os.path.join(tmp, 'bin'))
+    install_fake_tools(os.path.join(tmp, 'bin'))
+    try:
+        bookids = make_bookizips(n)
+        env = dict(os.environ)
+        cwd = os.getcwd()
+
+        alone = {}
+        start = time.time()
+        for bookid in bookids[:]:
+            try:
+                make(bookid, 'alone', alone)
+            except Exception, e:
+                #not what is being tested here
+                print "skipping %s, which fails on its own: %s" % (bookid, e)
+                bookids.remove(bookid)
+        alone_time = time.time() - start
+
+        together = {}
+        threads = [threading.Thread(target=make, args=(x, 'together', together))
+                   for x in bookids]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        together_time = time.time() - start
+
+        assert sorted(together) == bookids, "some threads failed"
+        for bookid in bookids:
+            assert alone[bookid] == together[bookid], "%s differs when made in a thread" % bookid
+        for i, a in enumerate(bookids):
+            for b in bookids[i + 1:]:
+                assert alone[a] != alone[b], "%s and %s are the same" % (a, b)
+        assert os.environ == env, "environment changed"
+        assert os.getcwd() == cwd, "working directory changed"
+        print "%d books: %.2fs one at a time, %.2fs in threads; outputs match" % (
+            len(bookids), alone_time, together_time)
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
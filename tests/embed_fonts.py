@@ -0,0 +1,104 @@
+#!/usr/bin/python
+
+"""Check that embedfonts.embed_fonts adds missing fonts to a PDF as an
+incremental update: the original bytes stay at the start of the file,
+the result reads back with its cross references intact and the fonts
+in place, and a second run leaves the file alone.
+
+fc-match isn't needed.  A small Type 1 font is written here, and the
+font index in a temporary FONT_CACHE_DIR says where it is.
+
+Run from the objavi root: python tests/embed_fonts.py
+"""
+
+import os, sys
+import tempfile
+import shutil
+sys.path.insert(0, os.path.abspath('.'))
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from objavi import config
+from objavi.simplepdf import write_pdf, PDFReader
+
+#write_pdf uses Courier, which is embedded as this
+FONT_NAME = 'NimbusMonoPS-Regular'
+
+CLEAR = ('%%!PS-AdobeFont-1.0: %s 1.0\n'
+         '/FontName /%s def\n'
+         '/FontBBox {-12 -237 650 811} readonly def\n'
+         '/ItalicAngle 0 def\n'
+         '/isFixedPitch true def\n'
+         'currentfile eexec\n' % (FONT_NAME, FONT_NAME))
+ENCRYPTED = ''.join(chr(x) for x in range(256)) * 2
+TRAILER = ('0' * 64 + '\n') * 8 + 'cleartomark\n'
+
+def write_font(fn):
+    h = ENCRYPTED.encode('hex')
+    f = open(fn, 'w')
+    f.write(CLEAR + '\n'.join(h[i:i + 64] for i in range(0, len(h), 64)) + '\n' + TRAILER)
+    f.close()
+
+def read(fn):
+    f = open(fn, 'rb')
+    data = f.read()
+    f.close()
+    return data
+
+def check_embedded(fn, contents):
+    reader = PDFReader(fn)
+    assert reader.startxref is not None, "the cross references were broken"
+    pages = reader.pages()
+    assert len(pages) == len(contents), "%d pages" % len(pages)
+    for i, page in enumerate(pages):
+        content = reader.decode(reader.resolve(page['Contents']))
+        assert content == contents[i], "page %d says %r" % (i + 1, content)
+        fonts = reader.resolve(reader.resolve(page['Resources'])['Font'])
+        font = reader.resolve(fonts['F1'])
+        assert font['BaseFont'] == 'Courier'
+        descriptor = reader.resolve(font['FontDescriptor'])
+        assert descriptor['FontName'] == 'Courier'
+        assert reader.resolve(descriptor['FontBBox']) == [-12, -237, 650, 811]
+        program = reader.resolve(descriptor['FontFile'])
+        assert reader.decode(program) == CLEAR + ENCRYPTED + TRAILER, "the font program differs"
+        assert ([reader.resolve(program.dict[k]) for k in ('Length1', 'Length2', 'Length3')] ==
+                [len(CLEAR), len(ENCRYPTED), len(TRAILER)])
+
+def main():
+    tmp = tempfile.mkdtemp()
+    try:
+        config.FONT_CACHE_DIR = os.path.join(tmp, 'fonts')
+        os.mkdir(config.FONT_CACHE_DIR)
+        font_file = os.path.join(tmp, 'mono.pfa')
+        write_font(font_file)
+        f = open(os.path.join(config.FONT_CACHE_DIR, 'font-files.json'), 'w')
+        json.dump({FONT_NAME: font_file}, f)
+        f.close()
+        #imported now, so it reads the font index from here
+        from objavi.embedfonts import embed_fonts
+
+        pdf = os.path.join(tmp, 'book.pdf')
+        contents = ['BT /F1 12 Tf 20 150 Td (page %d) Tj ET' % i for i in range(1, 4)]
+        write_pdf(pdf, [(200, 300, x) for x in contents])
+        original = read(pdf)
+
+        missing = embed_fonts(pdf)
+        assert missing == [], "still missing %s" % missing
+        embedded = read(pdf)
+        assert len(embedded) > len(original), "nothing was added"
+        assert embedded.startswith(original), "the original bytes changed"
+        check_embedded(pdf, contents)
+        print "embedding: ok"
+
+        missing = embed_fonts(pdf)
+        assert missing == [], "still missing %s" % missing
+        assert read(pdf) == embedded, "the second run changed the file"
+        print "second run: ok"
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/python
+
+"""Deterministic stand-ins for wkhtmltopdf, pdfedit, pdftk, gs and
+pdfinfo, for tests/benchmark.py and tests/concurrent_books.py.  They
+do no rendering: they write small PDFs of blank pages, with a page
+count that follows the size of the html, and answer questions about
+those PDFs in the form the real tools would.  The same inputs always
+give the same outputs.
+
+Usage: fake_pdf_tools.py <tool name> <the tool's usual arguments>
+"""
+
+import os, sys
+import re
+import shutil
+import urllib
+
+#bytes of html per page of "rendered" pdf
+HTML_BYTES_PER_PAGE = 3000
+
+def write_pdf(fn, pages):
+    objects = ['<< /Type /Catalog /Pages 2 0 R >>',
+               '<< /Type /Pages /Count %d /Kids [%s] >>' %
+               (pages, ' '.join('%d 0 R' % (i + 3) for i in range(pages)))]
+    for i in range(pages):
+        objects.append('<< /Type /Page /Parent 2 0 R /MediaBox [0 0 432 648] >>')
+    out = ['%PDF-1.4\n']
+    offsets = []
+    for i, obj in enumerate(objects):
+        offsets.append(sum(len(x) for x in out))
+        out.append('%d 0 obj\n%s\nendobj\n' % (i + 1, obj))
+    xref = sum(len(x) for x in out)
+    out.append('xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1))
+    out.extend('%010d 00000 n \n' % x for x in offsets)
+    out.append('trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' %
+               (len(objects) + 1, xref))
+    f = open(fn, 'w')
+    f.write(''.join(out))
+    f.close()
+
+def count_pages(fn):
+    f = open(fn)
+    m = re.search(r'/Type /Pages /Count (\d+)', f.read())
+    f.close()
+    return int(m.group(1))
+
+def url2path(url):
+    """wkhtmltopdf is given http urls for files under htdocs."""
+    if url.startswith('http://'):
+        return 'htdocs' + urllib.unquote('/' + url[7:].split('/', 1)[1])
+    if url.startswith('file://'):
+        return url[7:]
+    return url
+
+def wkhtmltopdf(args):
+    outline_file = None
+    positional = []
+    i = 0
+    while i < len(args):
+        a = args[i]
+        if a == '--dump-outline':
+            outline_file = args[i + 1]
+            i += 1
+        elif a.startswith('-'):
+            if a not in ('-q', '-g', '--outline'):
+                i += 1
+        else:
+            positional.append(a)
+        i += 1
+    src, pdf = positional[-2:]
+    path = url2path(src)
+    if os.path.isfile(path):
+        f = open(path)
+        html = f.read()
+        f.close()
+    else:
+        html = ''
+    pages = max(1, len(html) // HTML_BYTES_PER_PAGE)
+    write_pdf(pdf, pages)
+    if outline_file is not None:
+        items = []
+        for m in re.finditer(r'<h1[^>]*>(.*?)</h1>', html, re.S | re.I):
+            title = re.sub(r'<[^>]*>|\s+', ' ', m.group(1)).strip()
+            page = 1 + m.start() * pages // max(len(html), 1)
+            items.append('<item title="%s" page="%d"/>' % (urllib.quote(title), page))
+        f = open(outline_file, 'w')
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<outline xmlns="http://code.google.com/p/wkhtmltopdf/outline">'
+                '<item title="" page="0">%s</item></outline>\n' % ''.join(items))
+        f.close()
+
+def pdfedit(args):
+    settings = dict(x.split('=', 1) for x in args if '=' in x)
+    pages = count_pages(settings['filename'])
+    if 'even_pages' in settings.get('operation', '').split(',') and pages % 2:
+        pages += 1
+    write_pdf(settings['output_filename'], pages)
+
+def pdftk(args):
+    if args[-1] == 'dump_data':
+        print 'InfoKey: Creator\nInfoValue: fake_pdf_tools'
+        print 'NumberOfPages: %d' % count_pages(args[0])
+        return
+    op = args.index('cat')
+    inputs = args[:op]
+    out = args[args.index('output') + 1]
+    if args[op + 1] == '1-endD':
+        shutil.copy(inputs[0], out)
+    else:
+        write_pdf(out, sum(count_pages(x) for x in inputs))
+
+def gs(args):
+    out = [x.split('=', 1)[1] for x in args if x.startswith('-sOutputFile=')][0]
+    shutil.copy(args[-1], out)
+
+def pdfinfo(args):
+    print 'Producer:       fake_pdf_tools'
+    print 'Pages:          %d' % count_pages(args[-1])
+
+TOOLS = {
+    'wkhtmltopdf': wkhtmltopdf,
+    'pdfedit': pdfedit,
+    'pdftk': pdftk,
+    'gs': gs,
+    'pdfinfo': pdfinfo,
+}
+
+if __name__ == '__main__':
+    TOOLS[sys.argv[1]](sys.argv[2:])
@@ -0,0 +1,211 @@
+#!/usr/bin/python
+
+"""Check that simplepdf.PDFReader reads PDFs written in the ways
+objavi meets them, and that nup_pdf lays their pages out in columns.
+
+The PDFs are made here, each with three pages that say which they
+are: one with a plain cross reference table, one with a compressed
+cross reference stream, one with its objects packed in an object
+stream, one with an incremental update that replaces a page, and one
+whose cross references point nowhere.
+
+Run from the objavi root: python tests/nup_pdf.py
+"""
+
+import os, sys
+import zlib
+import tempfile
+import shutil
+sys.path.insert(0, os.path.abspath('.'))
+
+from objavi.simplepdf import write_pdf, nup_pdf, PDFReader
+
+WIDTH, HEIGHT = 200, 300
+N_PAGES = 3
+
+def page_content(i, note=''):
+    return 'BT /F1 12 Tf 20 150 Td (page %d%s) Tj ET' % (i, note)
+
+def make_plain(fn):
+    write_pdf(fn, [(WIDTH, HEIGHT, page_content(i)) for i in range(1, N_PAGES + 1)])
+
+def pdf_objects(compress=False):
+    """The objects of a three page PDF, as strings numbered from 1.
+    Returns them and the numbers of the ones that are streams."""
+    objects = ['<< /Type /Catalog /Pages 2 0 R >>',
+               None,
+               '<< /Type /Font /Subtype /Type1 /BaseFont /Courier >>']
+    kids = []
+    streams = []
+    for i in range(1, N_PAGES + 1):
+        content = page_content(i)
+        if compress:
+            content = zlib.compress(content)
+            objects.append('<< /Length %d /Filter /FlateDecode >>\nstream\n%s\nendstream' %
+                           (len(content), content))
+        else:
+            objects.append('<< /Length %d >>\nstream\n%s\nendstream' % (len(content), content))
+        streams.append(len(objects))
+        #the media box is inherited from the page tree
+        objects.append('<< /Type /Page /Parent 2 0 R '
+                       '/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>' %
+                       len(objects))
+        kids.append('%d 0 R' % len(objects))
+    objects[1] = ('<< /Type /Pages /Kids [%s] /Count %d /MediaBox [0 0 %d %d] >>' %
+                  (' '.join(kids), len(kids), WIDTH, HEIGHT))
+    return objects, streams
+
+def png_up(rows):
+    """Encode <rows> with the PNG Up predictor."""
+    out = []
+    prev = '\0' * len(rows[0])
+    for row in rows:
+        out.append('\x02' + ''.join(chr((ord(a) - ord(b)) % 256) for a, b in zip(row, prev)))
+        prev = row
+    return ''.join(out)
+
+def write_with_xref_stream(fn, objects, packed=()):
+    """Write <objects> with a cross reference stream.  The objects
+    numbered in <packed> go in an object stream."""
+    out = ['%PDF-1.5\n%\xe2\xe3\xcf\xd3\n']
+    size = len(out[0])
+    entries = {}
+    objstm = len(objects) + 1
+    xref_num = objstm + 1
+    header = []
+    body = []
+    for i, obj in enumerate(objects):
+        num = i + 1
+        if num in packed:
+            entries[num] = (2, objstm, len(header))
+            header.append('%d %d' % (num, sum(len(x) for x in body)))
+            body.append(obj + '\n')
+            continue
+        entries[num] = (1, size, 0)
+        s = '%d 0 obj\n%s\nendobj\n' % (num, obj)
+        out.append(s)
+        size += len(s)
+    header = ' '.join(header) + '\n'
+    data = zlib.compress(header + ''.join(body))
+    entries[objstm] = (1, size, 0)
+    s = ('%d 0 obj\n<< /Type /ObjStm /N %d /First %d /Filter /FlateDecode /Length %d >>\n'
+         'stream\n%s\nendstream\nendobj\n' % (objstm, len(packed), len(header), len(data), data))
+    out.append(s)
+    size += len(s)
+    entries[xref_num] = (1, size, 0)
+    rows = ['\0\0\0\0\0\xff\xff']
+    for num in range(1, xref_num + 1):
+        kind, a, b = entries[num]
+        rows.append(chr(kind) + ''.join(chr(a >> x & 255) for x in (24, 16, 8, 0)) +
+                    chr(b >> 8) + chr(b & 255))
+    data = zlib.compress(png_up(rows))
+    out.append('%d 0 obj\n<< /Type /XRef /Size %d /W [1 4 2] /Root 1 0 R '
+               '/Filter /FlateDecode /DecodeParms << /Predictor 12 /Columns 7 >> '
+               '/Length %d >>\nstream\n%s\nendstream\nendobj\n' %
+               (xref_num, xref_num + 1, len(data), data))
+    out.append('startxref\n%d\n%%%%EOF\n' % size)
+    f = open(fn, 'wb')
+    f.write(''.join(out))
+    f.close()
+
+def make_xref_stream(fn):
+    objects, streams = pdf_objects()
+    write_with_xref_stream(fn, objects)
+
+def make_object_stream(fn):
+    objects, streams = pdf_objects(compress=True)
+    packed = [i + 1 for i in range(len(objects)) if i + 1 not in streams]
+    write_with_xref_stream(fn, objects, packed)
+
+def make_incremental(fn):
+    """A plain PDF, with page 2's content replaced by an update."""
+    make_plain(fn)
+    f = open(fn, 'rb')
+    data = f.read()
+    f.close()
+    startxref = int(data[data.rindex('startxref') + 9:].split()[0])
+    #write_pdf puts page 2's content in object 6
+    content = page_content(2, ' revised')
+    s = '6 0 obj\n<< /Length %d >>\nstream\n%s\nendstream\nendobj\n' % (len(content), content)
+    update = (s + 'xref\n0 1\n0000000000 65535 f \n6 1\n%010d 00000 n \n'
+              'trailer\n<< /Size 10 /Root 1 0 R /Prev %d >>\nstartxref\n%d\n%%%%EOF\n' %
+              (len(data), startxref, len(data) + len(s)))
+    f = open(fn, 'ab')
+    f.write(update)
+    f.close()
+
+def make_broken(fn):
+    """A plain PDF whose startxref points into the middle of nowhere."""
+    make_plain(fn)
+    f = open(fn, 'rb')
+    data = f.read()
+    f.close()
+    i = data.rindex('startxref')
+    f = open(fn, 'wb')
+    f.write(data[:i] + 'startxref\n%d\n%%%%EOF\n' % (len(data) // 3))
+    f.close()
+
+CASES = (
+    ('plain', make_plain, {}),
+    ('xref stream', make_xref_stream, {}),
+    ('object stream', make_object_stream, {}),
+    ('incremental', make_incremental, {2: ' revised'}),
+    ('broken xref', make_broken, {}),
+    )
+
+def check_source(name, fn, notes):
+    reader = PDFReader(fn)
+    if name == 'broken xref':
+        assert reader.startxref is None, "%s: the broken xref was used" % name
+    else:
+        assert reader.startxref is not None, "%s: the xref was not used" % name
+    pages = reader.pages()
+    assert len(pages) == N_PAGES, "%s: %d pages" % (name, len(pages))
+    for i, page in enumerate(pages):
+        box = [reader.resolve(x) for x in reader.resolve(page['MediaBox'])]
+        assert box == [0, 0, WIDTH, HEIGHT], "%s: page %d is %s" % (name, i + 1, box)
+        content = reader.decode(reader.resolve(page['Contents']))
+        expected = page_content(i + 1, notes.get(i + 1, ''))
+        assert content == expected, "%s: page %d says %r" % (name, i + 1, content)
+
+def check_nup(name, fn, dest, notes):
+    left, step = 20, 240
+    nup_pdf(fn, dest, 500, 400, 2, left, step)
+    reader = PDFReader(dest)
+    assert reader.startxref is not None, "%s: nup_pdf wrote bad cross references" % name
+    pages = reader.pages()
+    assert len(pages) == 2, "%s: %d pages in columns" % (name, len(pages))
+    i = 0
+    for page in pages:
+        ops = reader.decode(reader.resolve(page['Contents']))
+        xobjects = reader.resolve(reader.resolve(page['Resources'])['XObject'])
+        for j in range(2):
+            if i == N_PAGES:
+                assert 'C%d' % j not in xobjects, "%s: extra column" % name
+                break
+            i += 1
+            assert 'q 1 0 0 1 %d 50 cm /C%d Do Q' % (left + j * step, j) in ops, (
+                "%s: column %d is misplaced: %r" % (name, j, ops))
+            form = reader.resolve(xobjects['C%d' % j])
+            assert form.dict['Subtype'] == 'Form'
+            assert [reader.resolve(x) for x in form.dict['BBox']] == [0, 0, WIDTH, HEIGHT]
+            content = reader.decode(form)
+            expected = page_content(i, notes.get(i, ''))
+            assert content == expected, "%s: column for page %d says %r" % (name, i, content)
+            font = reader.resolve(reader.resolve(form.dict['Resources'])['Font'])
+            assert reader.resolve(font['F1'])['BaseFont'] == 'Courier'
+
+def main():
+    tmp = tempfile.mkdtemp()
+    try:
+        for name, make, notes in CASES:
+            fn = os.path.join(tmp, name.replace(' ', '-') + '.pdf')
+            make(fn)
+            check_source(name, fn, notes)
+            check_nup(name, fn, fn[:-4] + '-nup.pdf', notes)
+            print "%s: ok" % name
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/python
+
+"""Check that progress callbacks from a job and from a child it forks
+(as objavi.cgi's multi mode does) all arrive, each once.
+
+The parent's CallbackSender has a kept-alive connection open when the
+child is forked.  Both then send messages at once to a local server,
+which keeps what it is sent.  The messages are big enough that
+requests written at once to one shared socket would be interleaved.
+
+Run from the objavi root: python tests/progress_callbacks.py [N]
+"""
+
+import os, sys
+import cgi
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+sys.path.insert(0, os.path.abspath('.'))
+
+from objavi import config
+from objavi.progress import CallbackSender
+
+received = []
+received_lock = threading.Lock()
+
+PADDING = ' ' + 'x' * 100000
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        form = cgi.parse_qs(self.rfile.read(length))
+        messages = [x.replace(PADDING, '')
+                    for x in form.get('messages', [''])[0].split('\n')]
+        received_lock.acquire()
+        received.extend(messages)
+        received_lock.release()
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write('ok')
+
+    def log_message(self, *args):
+        pass
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def main(n=30):
+    config.CALLBACK_COALESCE_DELAY = 0
+    config.CALLBACK_RETRY_DELAYS = (0.1,)
+    server = Server(('127.0.0.1', 0), Handler)
+    t = threading.Thread(target=server.serve_forever)
+    t.setDaemon(True)
+    t.start()
+
+    sender = CallbackSender('http://127.0.0.1:%d/callback' % server.server_address[1])
+    expected = ['parent start']
+    sender.send('parent start')
+    #wait for the connection to be open and used
+    while not received:
+        threading.Event().wait(0.01)
+
+    pid = os.fork()
+    if pid == 0:
+        for i in range(n):
+            sender.send('child %d' % i + PADDING)
+        os._exit(0)
+    for i in range(n):
+        sender.send('parent %d' % i + PADDING)
+    expected.extend('parent %d' % i for i in range(n))
+    expected.extend('child %d' % i for i in range(n))
+    os.waitpid(pid, 0)
+    sender.close()
+    server.shutdown()
+
+    missing = set(expected) - set(received)
+    assert not missing, "%d messages were lost, e.g. %s" % (len(missing), sorted(missing)[:3])
+    assert sorted(received) == sorted(expected), "some messages arrived twice, or garbled"
+    print "%d messages from parent and child: ok" % len(expected)
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,165 @@
+#!/usr/bin/python
+
+"""Time how long objavi.cgi takes to start up and answer in each of
+the light modes (form, css, and booklist), and list the heavy modules
+each one loads.
+
+Each request is a fresh python process running objavi.cgi, as a web
+server would, so the times include the interpreter's own startup
+(which is shown separately, for comparison).  The booklist mode asks a
+little web server in this process for the list, so nothing leaves the
+machine.  The list is cached in a temporary directory, so after the
+first run it comes from the cache, as it mostly would.
+
+Run from the objavi root:
+
+  python tests/startup_benchmark.py [options] [modes]
+"""
+
+#The child processes run this file too, so anything imported here
+#would be counted against objavi.cgi.  The parent's modules are
+#imported in the functions that use them.
+import os, sys
+import time
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+MODES = ('form', 'css', 'booklist')
+
+#modules that the light modes should not need
+HEAVY_MODULES = ('lxml', 'booki', 'objavi.fmbook', 'objavi.pdf', 'objavi.xhtml_utils',
+                 'urllib2', 'multiprocessing', 'sqlite3', 'cProfile')
+
+BOOK_LIST = json.dumps([{'fields': {'url_title': 'book-%d' % i, 'title': 'Book %d' % i}}
+                        for i in range(200)])
+
+def serve_book_list():
+    """Start a web server in a thread, answering every request with
+    BOOK_LIST, and return it."""
+    import threading
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+    class BookListHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json')
+            self.end_headers()
+            self.wfile.write(BOOK_LIST)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = HTTPServer(('127.0.0.1', 0), BookListHandler)
+    t = threading.Thread(target=httpd.serve_forever)
+    t.daemon = True
+    t.start()
+    return httpd
+
+
+def child(mode, server, cache_dir):
+    """Run objavi.cgi in this process, as the web server would, then
+    report on the modules it loaded (on the original stdout)."""
+    start = time.time()
+    report = os.fdopen(os.dup(1), 'w')
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    if not os.environ.get('STARTUP_BENCHMARK_VERBOSE'):
+        os.dup2(devnull, 2)
+    sys.path.insert(0, os.path.abspath('.'))
+    from objavi import config
+    config.SERVER_DEFAULTS[server] = dict(config.SERVER_DEFAULTS[config.DEFAULT_SERVER],
+                                          interface='Booki')
+    config.BOOK_LIST_CACHE_DIR = cache_dir
+    os.chdir('htdocs')
+    sys.argv = ['objavi.cgi']
+    cgi = {'__name__': 'objavi_cgi', '__file__': 'objavi.cgi'}
+    error = None
+    try:
+        execfile('objavi.cgi', cgi)
+        cgi['main']()
+    except SystemExit:
+        pass
+    except Exception, e:
+        #the time it took to fail is still its startup time
+        error = '%s: %s' % (e.__class__.__name__, e)
+    modules = [k for k, v in sys.modules.items() if v is not None]
+    json.dump({'seconds': time.time() - start,
+               'modules': len(modules),
+               'heavy': sorted(x for x in HEAVY_MODULES if x in modules),
+               'error': error,
+               }, report)
+    report.close()
+
+
+def run_mode(mode, server, cache_dir, repeat, verbose):
+    import subprocess
+    query = {
+        'form': 'mode=form',
+        'css': 'mode=css',
+        'booklist': 'mode=booklist&server=%s' % server,
+    }.get(mode, 'mode=%s' % mode)
+    env = dict(os.environ, REQUEST_METHOD='GET', QUERY_STRING=query)
+    if verbose:
+        env['STARTUP_BENCHMARK_VERBOSE'] = '1'
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        p = subprocess.Popen([sys.executable, __file__, '--child', mode, server, cache_dir],
+                             stdout=subprocess.PIPE, env=env)
+        out = p.communicate()[0]
+        times.append(time.time() - start)
+    result = json.loads(out)
+    times.sort()
+    result.update(best=times[0], median=times[len(times) // 2])
+    return result
+
+def python_startup(repeat):
+    import subprocess
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        subprocess.call([sys.executable, '-c', 'pass'])
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(usage=__doc__)
+    parser.add_option('-n', '--repeat', type='int', default=10,
+                      help='start each mode this many times (default 10)')
+    parser.add_option('-o', '--output', help='save the results (as JSON) in this file')
+    parser.add_option('-v', '--verbose', action='store_true',
+                      help="show objavi's log messages")
+    options, args = parser.parse_args()
+
+    import shutil, tempfile
+    httpd = serve_book_list()
+    server = '127.0.0.1:%d' % httpd.server_address[1]
+    cache_dir = tempfile.mkdtemp()
+
+    results = {'python': python_startup(options.repeat), 'modes': {}}
+    print 'python startup: %.1fms' % (results['python'] * 1000)
+    print '%-10s %8s %8s %8s  %s' % ('mode', 'best', 'median', 'modules', 'heavy modules loaded')
+    for mode in args or MODES:
+        r = run_mode(mode, server, cache_dir, options.repeat, options.verbose)
+        results['modes'][mode] = r
+        print '%-10s %6.1fms %6.1fms %8d  %s' % (mode, r['best'] * 1000, r['median'] * 1000,
+                                                r['modules'], ' '.join(r['heavy']) or '-')
+        if r['error']:
+            print '%10s (failed with %s)' % ('', r['error'])
+    httpd.shutdown()
+    shutil.rmtree(cache_dir)
+
+    if options.output:
+        f = open(options.output, 'w')
+        json.dump(results, f, indent=1, sort_keys=True)
+        f.close()
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--child']:
+        child(*sys.argv[2:5])
+    else:
+        main()
@@ -23,6 +23,7 @@ import os
 import shutil
 import tempfile
 import hashlib
+from multiprocessing.pool import ThreadPool
 try:
     import xml.etree.ElementTree as ET
 except:
@@ -37,6 +38,14 @@ from urllib import quote, unquote
 wikibooks_base = 'http://en.wikibooks.org'
 wikibooks_api = wikibooks_base + '/w/api.php'
 
+#how many titles to ask about in one query (the API's limit is 50)
+API_BATCH = 50
+#how many images to download at once
+IMAGE_DOWNLOADS = 8
+
+#parsed pages, kept until forgetPage()
+_parsed = {}
+
 def wikiApi(**args):
     _default_args = {
         'format': 'json',
@@ -67,10 +76,40 @@ def pageMarkup(title):
         txt = None
     return txt
 
-def pageHtml(title):
+def pageParse(title):
+    '''
+        parse a page, getting its html and links in one call.  The
+        result is kept, so later calls for the same page are free.
+    '''
     title = normalizeTitle(title)
-    data = wikiApi(action='parse', redirects='1', page=title)
-    txt = data['parse']['text']['*']
+    if title not in _parsed:
+        data = wikiApi(action='parse', redirects='1', page=title, prop='text|links')
+        _parsed[title] = data['parse']
+    return _parsed[title]
+
+def forgetPage(title):
+    _parsed.pop(normalizeTitle(title), None)
+
+def existingTitles(titles):
+    '''
+        return the titles that name existing pages, asking about
+        API_BATCH titles per query
+    '''
+    existing = set()
+    for i in range(0, len(titles), API_BATCH):
+        batch = titles[i:i + API_BATCH]
+        data = wikiApi(action='query', titles='|'.join(batch))
+        query = data.get('query', {})
+        #the API reports normalized titles; map them back
+        normalized = dict((n['to'], n['from']) for n in query.get('normalized', []))
+        for page in query.get('pages', {}).values():
+            if 'missing' in page or 'invalid' in page:
+                continue
+            existing.add(normalized.get(page['title'], page['title']))
+    return [t for t in titles if t in existing]
+
+def pageHtml(title):
+    txt = pageParse(title)['text']['*']
 
     #cleanup wiki stuff
     txt = re.sub('\[<a href.*?>.*?edit</a>\]','', txt)
@@ -132,12 +171,7 @@ def pageLinks(title):
     '''
         return all wiki links of a page in a list
     '''
-    links = []
-    title = normalizeTitle(title)
-    data = wikiApi(action='parse', redirects='1', page=title, prop='links')
-    for l in data['parse']['links']:
-        links.append(l['*'])
-    return links
+    return [l['*'] for l in pageParse(title)['links']]
 
 def bookLinks(title, bookTitle=None, recursive=False, _links=[]):
     '''
@@ -147,16 +181,25 @@ def bookLinks(title, bookTitle=None, recursive=False, _links=[]):
     if not bookTitle:
         bookTitle = title
 
-    links = pageLinks(title)
-    links = [l.startswith('/') and title + l or l for l in links]
-    links = filter(lambda link: link.startswith(bookTitle), links)
-    links = filter(lambda link: link not in _links, links)
-    if recursive:
-        __links = _links + links
-        for l in links:
-            new_links = bookLinks(l, bookTitle=bookTitle, recursive=True, _links=__links)
-            new_links = filter(lambda link: link not in __links, new_links)
-            links = links + new_links
+    #breadth first, so that each level's new links can be checked in
+    #batches, and links to missing pages are never parsed.
+    seen = set(_links)
+    links = []
+    todo = [title]
+    while todo:
+        new_links = []
+        for page in todo:
+            for l in pageLinks(page):
+                if l.startswith('/'):
+                    l = page + l
+                if l.startswith(bookTitle) and l not in seen:
+                    seen.add(l)
+                    new_links.append(l)
+        new_links = existingTitles(new_links)
+        links.extend(new_links)
+        if not recursive:
+            break
+        todo = new_links
     links = sorted(list(set(links)))
     return links
 
@@ -178,15 +221,33 @@ def savePage(title, base='/tmp/book', bookTitle=''):
     f.close()
     return filetitle
 
-def saveImages(title, base='/tmp/book'):
+def pageImageFiles(title, base='/tmp/book'):
+    '''
+        return (url, local filename) for each image in a page
+    '''
+    return [(image, os.path.join(base, unquote(localImageLink(image).replace('http:__', ''))))
+            for image in pageImages(title)]
+
+def saveImages(title, base='/tmp/book', pool=None, _pending=None):
+    '''
+        save the images of a page, and return their names relative to
+        base.  If a pool is given, downloads are started in it and the
+        AsyncResults are put in the _pending dictionary, keyed by
+        filename, so that each image is fetched once.
+    '''
     #use cache for now
     #from oxlib.net import saveUrl
-    images = pageImages(title)
     _images = []
-    for image in images:
-        f = os.path.join(base, unquote(localImageLink(image).replace('http:__', '')))
+    for image, f in pageImageFiles(title, base):
         _images.append(f.replace(base+'/', ''))
-        if not os.path.exists(f.encode('utf-8')):
+        if pool is not None:
+            if f not in _pending and not os.path.exists(f.encode('utf-8')):
+                #make the directory here, not racing in the threads
+                d = os.path.dirname(f)
+                if not os.path.exists(d.encode('utf-8')):
+                    os.makedirs(d.encode('utf-8'))
+                _pending[f] = pool.apply_async(saveUrl, (image, f))
+        elif not os.path.exists(f.encode('utf-8')):
             saveUrl(image, f)
     return _images
 
@@ -314,11 +375,19 @@ def createEpub(title, output=None):
     url = 'http://en.wikibooks.org/skins-1.5/common/commonPrint.css'
     saveUrl(url, base+'/stylesheet.css')
 
-    #write html pages and related images
+    #write html pages, while the related images download in a pool.
+    #Each page is parsed once (in bookLinks) and forgotten when saved.
+    pool = ThreadPool(IMAGE_DOWNLOADS)
+    downloads = {}
     items = []
     for page in pages:
         items.append(savePage(page, base, bookTitle=title))
-        items += saveImages(page, base)
+        items += saveImages(page, base, pool=pool, _pending=downloads)
+        forgetPage(page)
+    pool.close()
+    pool.join()
+    for r in downloads.values():
+        r.get() #raises any download error
 
     #write basic epub info and create epub
     content_opf, toc_ncx = epub_files(title, items)